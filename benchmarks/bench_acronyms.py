@@ -0,0 +1,72 @@
+"""Time the expansion of the acronyms in synthetic manuscripts of increasing
+length, and check that the output is the same as with the previous
+implementation (which searched the text from the start after each acronym).
+
+    python benchmarks/bench_acronyms.py [n_pages ...]
+"""
+from re import search
+from sys import argv
+from timeit import repeat
+
+from md2docx.document import parse_md
+from md2docx.prepare_md import _load_acronyms, _make_acronyms
+from md2docx.utils import var_dir
+
+from synthetic import make_acronym_text
+
+ACRONYM_FILE = var_dir / 'acronyms.txt'
+
+
+def old_make_acronyms(line, acronym_file):
+    acronym = dict(_load_acronyms(acronym_file))
+    full_acronym = dict(acronym)
+
+    while True:
+        m = search('\[\$[a-zA-Z]+\]', line)
+        if m is None:
+            break
+        key = m.group()[2:-1]
+        l0 = line[:m.start()]
+        l1 = line[m.end():]
+        if acronym[key] is not None:  # first time
+            line = l0 + acronym[key] + ' (' + key + ')' + l1
+            acronym[key] = None
+        else:
+            line = l0 + key + l1
+
+    s = []
+    for key in sorted(acronym, key=lambda x: x.lower()):
+        if acronym[key] is None:
+            s.append(key + ': ' + full_acronym[key])
+    line = line.replace('[ACRONYMS]', '; '.join(s))
+
+    return line
+
+
+def new_make_acronyms(md, acronym_file):
+    doc = parse_md(md)
+    _make_acronyms(doc, acronym_file)
+    return doc.to_md()
+
+
+def bench_acronyms(n_pages):
+    md = make_acronym_text(n_pages)
+    n_uses = md.count('[$')
+
+    assert (new_make_acronyms(md, ACRONYM_FILE) ==
+            old_make_acronyms(md, ACRONYM_FILE))
+
+    t_old = min(repeat(lambda: old_make_acronyms(md, ACRONYM_FILE),
+                       number=1, repeat=3))
+    t_new = min(repeat(lambda: new_make_acronyms(md, ACRONYM_FILE),
+                       number=1, repeat=3))
+
+    print('{:4d} pages ({:5d} acronyms, {:6.1f} kB): old {:8.1f} ms, new '
+          '{:5.1f} ms ({:5.2f} us per acronym, speed-up {:5.1f}x)'
+          ''.format(n_pages, n_uses, len(md) / 1e3, t_old * 1e3, t_new * 1e3,
+                    t_new / n_uses * 1e6, t_old / t_new))
+
+
+if __name__ == '__main__':
+    for n_pages in [int(x) for x in argv[1:]] or [10, 25, 50, 100]:
+        bench_acronyms(n_pages)
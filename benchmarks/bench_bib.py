@@ -0,0 +1,137 @@
+"""Time the conversion of synthetic .bib libraries to json and measure the
+peak memory of the python code.
+
+    python benchmarks/bench_bib.py [n_entries ...] [--save]
+    python benchmarks/bench_bib.py --jobs 50000
+
+The streaming conversion (prepare_bib) is compared with the conversion of the
+whole file at once (whole_file_bib), which is how prepare_bib worked before it
+read the entries one by one: it is the reference for the time and the memory.
+Both are run from scratch (without the cache). With --save, the timings
+(relative to the calibration of suite.py) and the peak memory of both are
+stored in benchmarks/baseline.json, under "bench_bib".
+
+With --jobs, the library is converted from scratch with 1, 2, 4, ... up to
+the number of CPUs, to show how the process pool scales.
+"""
+from json import dump
+from os import cpu_count
+from pathlib import Path
+from sys import argv
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+
+from re import findall, split
+
+from md2docx.prepare_bib import LATEX_SYMBOLS, fix_entry, prepare_bib
+
+from suite import BASELINE, _read_baseline, calibrate
+from synthetic import make_bib
+
+
+def whole_file_bib(old_bib, new_bib):
+    """Convert the .bib file after reading all of it, into a single json
+    object (the implementation of prepare_bib before the streaming one)"""
+    with old_bib.open(errors='ignore') as f:
+        bib_orig = f.read()
+    for latex_name, symbol in LATEX_SYMBOLS.items():
+        bib_orig = bib_orig.replace(latex_name, symbol)
+    keys = findall(r'@([a-z]+){([\w]*),', bib_orig)
+    entries = split(r'@[a-z]+{[\w]*,', bib_orig)[1:]
+    assert len(keys) == len(entries)
+    j_entries = {}
+    for key, entry in zip(keys, entries):
+        j_entries[key[1]] = fix_entry(key, entry)
+    with new_bib.open('w') as f:
+        dump(j_entries, f, indent=2)
+
+
+def bench_prepare_bib(n_entries):
+    """Time and peak memory of the streaming and of the whole-file conversion
+
+    Returns
+    -------
+    dict
+        for each conversion, the time (relative to the calibration) and the
+        peak memory (in MB)
+    """
+    with TemporaryDirectory() as tmp_dir:
+        bib_file = Path(tmp_dir) / 'library.bib'
+        make_bib(bib_file, n_entries)
+        size = bib_file.stat().st_size
+
+        results = {}
+        for name, convert, json_file in (
+                ('whole_file', whole_file_bib, Path(tmp_dir) / 'library.json'),
+                ('streaming', prepare_bib, Path(tmp_dir) / 'library.jsonl')):
+            calibration = calibrate()
+            t0 = perf_counter()
+            convert(bib_file, json_file)
+            duration = perf_counter() - t0
+
+            # the memory of the conversion from scratch, not of the cache
+            _remove_outputs(json_file)
+            start()
+            convert(bib_file, json_file)
+            peak = get_traced_memory()[1]
+            stop()
+
+            print('{:7d} entries ({:6.1f} MB), {:<10}: {:6.2f} s, '
+                  'peak memory {:7.1f} MB'.format(n_entries, size / 1e6, name,
+                                                  duration, peak / 1e6))
+            results[name] = {'time': duration / calibration,
+                             'peak_mb': peak / 1e6}
+
+    return results
+
+
+def bench_jobs(n_entries):
+    jobs = [1, ]
+    while jobs[-1] * 2 <= cpu_count():
+        jobs.append(jobs[-1] * 2)
+    if jobs[-1] != cpu_count():
+        jobs.append(cpu_count())
+
+    with TemporaryDirectory() as tmp_dir:
+        bib_file = Path(tmp_dir) / 'library.bib'
+        make_bib(bib_file, n_entries)
+
+        durations = []
+        for n_jobs in jobs:
+            json_file = Path(tmp_dir) / 'library_{}.jsonl'.format(n_jobs)
+            t0 = perf_counter()
+            prepare_bib(bib_file, json_file, n_jobs)
+            durations.append(perf_counter() - t0)
+
+            print('{:7d} entries, {:3d} jobs: {:6.2f} s (speed-up {:4.1f}x)'
+                  ''.format(n_entries, n_jobs, durations[-1],
+                            durations[0] / durations[-1]))
+
+
+def _remove_outputs(json_file):
+    """Remove the outputs of prepare_bib, including its cache"""
+    for suffix in ('.json', '.jsonl', '.idx', '.cache'):
+        try:
+            json_file.with_suffix(suffix).unlink()
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+    if argv[1:2] == ['--jobs']:
+        for n_entries in [int(x) for x in argv[2:]] or [50000, ]:
+            bench_jobs(n_entries)
+    else:
+        sizes = [x for x in argv[1:] if x != '--save']
+        results = {}
+        for n_entries in [int(x) for x in sizes] or [1000, 10000]:
+            results[str(n_entries)] = bench_prepare_bib(n_entries)
+
+        if '--save' in argv:
+            baseline = _read_baseline()
+            baseline.setdefault('bench_bib', {}).update(results)
+            with BASELINE.open('w') as f:
+                dump(baseline, f, indent=1, sort_keys=True)
+                f.write('\n')
+            print('baseline saved to ' + str(BASELINE))
@@ -0,0 +1,94 @@
+"""Time the extraction and the substitution of the citations in a synthetic
+review article, and check that the output is the same as with the previous
+implementation (one str.replace over the whole text for each citation).
+
+    python benchmarks/bench_citations.py [n_citations ...]
+"""
+from re import findall, split
+from sys import argv
+from timeit import repeat
+
+from md2docx.patterns import CITATION_SEPARATOR
+from md2docx.prepare_md import (_read_citations,
+                                _replace_citations,
+                                _split_citations,
+                                )
+
+from synthetic import make_review
+
+
+def old_read_citations(md):
+    md_citations = findall('(\[?@[@\w+0-9' + CITATION_SEPARATOR + ']+\]?)', md)
+
+    j_citations = []
+    for v in md_citations:
+        items = []
+        for x in split('[' + CITATION_SEPARATOR + ']+', v):
+            items.append({'id': x.strip('[@] ')})
+        j_cit = {'citationID': v,
+                 'citationItems': items,
+                 'properties': {}}
+        j_citations.append(j_cit)
+
+    citationsID = []
+    all_cit = []
+    for cit in j_citations:
+        if cit['citationID'] not in citationsID:
+            citationsID.append(cit['citationID'])
+            all_cit.append(cit)
+    return all_cit
+
+
+def old_replace(md, cite_pre, cite_post):
+    for i_pre, i_post in zip(cite_pre, cite_post):
+        md = md.replace(i_pre['citationID'], i_post)
+    return md
+
+
+def new_citations(md):
+    md_parts = _split_citations(md)
+    return md_parts, _read_citations(md_parts[1::2])
+
+
+def new_replace(md_parts, cite_pre, cite_post):
+    cite_post = {i_pre['citationID']: i_post
+                 for i_pre, i_post in zip(cite_pre, cite_post)}
+    return _replace_citations(md_parts, cite_post)
+
+
+def format_citations(citations):
+    """Fake output of citeproc.js (numbered citations, no references)"""
+    return {'citations': [' <sup>{}</sup>'.format(i + 1)
+                          for i in range(len(citations))],
+            'references': ''}
+
+
+def bench_citations(n_citations):
+    md = make_review(n_citations)
+
+    cite_old = old_read_citations(md)
+    md_parts, cite_new = new_citations(md)
+    assert cite_old == cite_new
+
+    formatted = format_citations(cite_new)
+    md_old = old_replace(md, cite_old, formatted['citations'])
+    md_old = md_old.replace(' <sup>', '^').replace('</sup>', '^')
+    md_new = new_replace(md_parts, cite_new, formatted['citations'])
+    assert md_new == md_old
+
+    t_old = min(repeat(lambda: old_replace(md, old_read_citations(md),
+                                           formatted['citations']),
+                       number=1, repeat=5))
+    t_new = min(repeat(lambda: new_replace(*new_citations(md),
+                                           formatted['citations']),
+                       number=1, repeat=5))
+
+    print('{:6d} citations ({:4d} unique, {:7.1f} kB): old {:8.2f} ms, new '
+          '{:6.2f} ms (speed-up {:5.1f}x)'
+          ''.format(n_citations, len(cite_new), len(md) / 1e3, t_old * 1e3,
+                    t_new * 1e3, t_old / t_new))
+
+
+if __name__ == '__main__':
+    for n_citations in [int(x) for x in argv[1:]] or [300, 3000]:
+        bench_citations(n_citations)
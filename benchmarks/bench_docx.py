@@ -0,0 +1,140 @@
+"""Time the conversion to docx of a long supplementary document with many
+tables and some figures (one of them twice), with python-docx and with the
+direct OOXML writer (--fast_docx), and check that the two docx files are the
+same.
+
+    python benchmarks/bench_docx.py [n_pages n_tables [n_figures]]
+
+The two files are the same if they have the same parts, with the same content
+type, the same relationships and the same xml (ignoring how the xml is
+formatted and where the namespaces are declared).
+"""
+from argparse import Namespace
+from pathlib import Path
+from sys import argv
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from zipfile import ZipFile
+
+from lxml.etree import XMLParser, fromstring, tostring
+
+from md2docx.build import MD_FILES
+from md2docx.document import parse_md
+from md2docx.main import REF_DOCX
+from md2docx.prepare_docx import convert_to_docx
+from md2docx.utils import journals_dir
+
+from synthetic import make_long_document
+
+PARSER = XMLParser(remove_blank_text=True)
+
+
+def compare_docx(docx_a, docx_b):
+    """Compare two docx files.
+
+    Returns
+    -------
+    list of str
+        names of the parts which are different (empty if the files are the
+        same)
+    """
+    with ZipFile(str(docx_a)) as za, ZipFile(str(docx_b)) as zb:
+        parts_a = _read_parts(za)
+        parts_b = _read_parts(zb)
+
+    types_a = _content_types(parts_a)
+    types_b = _content_types(parts_b)
+
+    different = []
+    for name in sorted(set(parts_a) | set(parts_b)):
+        if name not in parts_a or name not in parts_b:
+            different.append(name)
+        elif types_a(name) != types_b(name):
+            different.append(name + ' (content type)')
+        elif name.endswith('.rels'):
+            if _rels(parts_a[name]) != _rels(parts_b[name]):
+                different.append(name)
+        elif name.endswith('.xml'):
+            if _canonical(parts_a[name]) != _canonical(parts_b[name]):
+                different.append(name)
+        elif parts_a[name] != parts_b[name]:
+            different.append(name)
+
+    return different
+
+
+def _read_parts(z):
+    return {x: z.read(x) for x in z.namelist() if not x.endswith('/')}
+
+
+def _content_types(parts):
+    """Function returning the content type of each part"""
+    types = fromstring(parts.pop('[Content_Types].xml'))
+    defaults = {}
+    overrides = {}
+    for x in types:
+        if x.get('Extension') is not None:
+            defaults[x.get('Extension').lower()] = x.get('ContentType')
+        else:
+            overrides[x.get('PartName').lstrip('/')] = x.get('ContentType')
+
+    def content_type(name):
+        if name in overrides:
+            return overrides[name]
+        return defaults.get(name.split('.')[-1].lower())
+    return content_type
+
+
+def _rels(xml):
+    return {x.get('Id'): (x.get('Type'), x.get('Target'), x.get('TargetMode'))
+            for x in fromstring(xml)}
+
+
+def _canonical(xml):
+    """Canonical xml, where the namespaces are declared on the first element
+    which uses them (python-docx declares them on each picture when the root
+    of the reference docx does not)"""
+    return tostring(fromstring(xml, PARSER), method='c14n', exclusive=True)
+
+
+def time_conversion(output_dir, doc, md_file, fast_docx):
+    args = Namespace(journal_json=journals_dir / 'Neuron.json',
+                     ref_docx=REF_DOCX, embed=False, fast_docx=fast_docx)
+    t0 = perf_counter()
+    convert_to_docx(output_dir, doc, md_file, args)
+    return perf_counter() - t0
+
+
+def bench_docx(n_pages, n_tables, n_figures=3):
+    with TemporaryDirectory() as tmp:
+        md = make_long_document(n_pages, n_tables, img_dir=Path(tmp),
+                                n_figures=n_figures)
+        doc = parse_md(md)
+
+        dir_old = Path(tmp) / 'python-docx'
+        dir_new = Path(tmp) / 'ooxml'
+        dir_old.mkdir()
+        dir_new.mkdir()
+
+        md_file = MD_FILES[0]
+        t_old = min(time_conversion(dir_old, doc, md_file, False)
+                    for _ in range(3))
+        t_new = min(time_conversion(dir_new, doc, md_file, True)
+                    for _ in range(3))
+
+        docx_file = md_file.replace('.md', '.docx')
+        different = compare_docx(dir_old / docx_file, dir_new / docx_file)
+        assert not different, 'different parts: ' + ', '.join(different)
+
+    print('{:4d} pages, {:3d} tables, {:2d} figures ({:7.1f} kB): '
+          'python-docx {:7.1f} ms, ooxml {:6.1f} ms (speed-up {:5.1f}x)'.format(
+              n_pages, n_tables, n_figures, len(md) / 1e3, t_old * 1e3,
+              t_new * 1e3, t_old / t_new))
+
+
+if __name__ == '__main__':
+    if len(argv) in (3, 4):
+        bench_docx(*(int(x) for x in argv[1:]))
+    else:
+        bench_docx(20, 5)
+        bench_docx(200, 50)
@@ -0,0 +1,252 @@
+"""Reproducible benchmark suite: build synthetic articles at several scales and
+compare the time of each stage with the baseline (benchmarks/baseline.json).
+
+    python benchmarks/suite.py [small medium large] [--repeat N] [--save]
+
+The articles and the libraries are generated with a fixed seed (see
+synthetic.make_article). node, inkscape and libreoffice are replaced by the
+stubs in benchmarks/stubs, so that the timings depend only on the python code
+and not on which versions of these programs are installed.
+
+prepare_bib is timed in this process (from scratch, without its cache). The
+build is run with --profile in a separate process, with the stubs on PATH and
+an empty cache directory, and the time of the stages is read from the trace.
+Each stage keeps the fastest of the repeats.
+
+The timings are divided by the time of a fixed python workload, which is run
+on the same machine just before each repeat, so that the baseline can be
+compared across machines (and it's less affected by the load of the machine). A stage
+is a regression if it's slower than the baseline by more than the tolerance
+(and by more than 20 ms, for the short stages): the regressions are listed
+and the exit code is 1.
+"""
+from argparse import ArgumentParser
+from json import dump, dumps, load, loads
+from os import environ, pathsep
+from pathlib import Path
+from subprocess import run
+from sys import executable, exit
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from md2docx.prepare_bib import prepare_bib
+
+from synthetic import make_article
+
+BENCH_DIR = Path(__file__).resolve().parent
+STUBS_DIR = BENCH_DIR / 'stubs'
+BASELINE = BENCH_DIR / 'baseline.json'
+
+# sections, citations, acronyms, figures, tables, entries in the library
+SCALES = {
+    'small': (8, 50, 20, 2, 2, 1000),
+    'medium': (40, 400, 100, 8, 10, 10000),
+    'large': (160, 2000, 400, 30, 40, 100000),
+    }
+
+# stages in the trace, with the prefix of the names of the tasks which are
+# added together
+STAGES = {
+    'organize_md': 'organize_md',
+    'make_acronyms': 'make_acronyms',
+    'include_figures': 'include_figures',
+    'citeproc': 'citeproc',
+    'count_text': 'count_text',
+    'get_main_ref': 'get_main_ref',
+    'convert_to_docx': 'docx:',
+    'convert_to_tiff': 'tiff',
+    'convert_to_pdf': 'pdf:',
+    'build': 'build',
+    }
+# smaller differences (in s) are noise, such as when starting a process
+MIN_DIFFERENCE = 0.02
+
+
+def main():
+    parser = ArgumentParser(description='Time the stages of md2docx on '
+                            'synthetic articles and compare with the baseline')
+    parser.add_argument('scales', nargs='*', default=['small', 'medium'],
+                        help='scales to run (' + ', '.join(SCALES) +
+                        '; default: small medium)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of repeats (default: %(default)s)')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown which is a regression '
+                        '(default: %(default)s)')
+    parser.add_argument('--save', action='store_true',
+                        help='store the timings as the new baseline')
+    args = parser.parse_args()
+    unknown = set(args.scales) - set(SCALES)
+    if unknown:
+        parser.error('unknown scales: ' + ', '.join(sorted(unknown)))
+
+    timings = {}
+    for scale in args.scales:
+        timings[scale] = bench_scale(scale, args.repeat)
+
+    if args.save:
+        baseline = _read_baseline()
+        baseline.update(timings)
+        with BASELINE.open('w') as f:
+            dump(baseline, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to ' + str(BASELINE))
+        return
+
+    regressions = compare(timings, _read_baseline(), args.tolerance)
+    if regressions:
+        print('\nREGRESSION in ' + ', '.join(regressions))
+        exit(1)
+
+
+def calibrate(repeat=3):
+    """Time a fixed python workload (parsing json and sorting strings), to
+    compare the timings of different machines (or of the same machine, when
+    it's busy).
+
+    Returns
+    -------
+    float
+        fastest time of the workload (in s)
+    """
+    data = dumps([{'id': 'Key{:06d}'.format(i), 'title': str(i * 7919)}
+                  for i in range(50000)])
+    durations = []
+    for _ in range(repeat):
+        t0 = perf_counter()
+        entries = loads(data)
+        sorted(x['title'] for x in entries)
+        durations.append(perf_counter() - t0)
+    return min(durations)
+
+
+def bench_scale(scale, repeat):
+    """Time the stages of md2docx for one synthetic article.
+
+    Parameters
+    ----------
+    scale : str
+        one of SCALES
+    repeat : int
+        number of times each stage is run
+
+    Returns
+    -------
+    dict
+        fastest time of each stage, relative to the calibration which was
+        run just before
+    """
+    with TemporaryDirectory() as tmp_dir:
+        article_dir = Path(tmp_dir) / 'article'
+        article_dir.mkdir()
+        make_article(article_dir, *SCALES[scale])
+        bib_file = article_dir / 'library.bib'
+        print('{}: {} sections, {} citations, {} acronyms, {} figures, '
+              '{} tables, {} entries'.format(scale, *SCALES[scale]))
+
+        timings = {'prepare_bib': []}
+        for _ in range(repeat):
+            for old in article_dir.glob('library.*'):
+                if old != bib_file:
+                    old.unlink()
+            calibration = calibrate()
+            t0 = perf_counter()
+            prepare_bib(bib_file, bib_file.with_suffix('.jsonl'))
+            timings['prepare_bib'].append((perf_counter() - t0) / calibration)
+
+        for i in range(repeat):
+            calibration = calibrate()
+            trace = _build(article_dir, Path(tmp_dir) / 'cache{}'.format(i))
+            for stage, duration in trace.items():
+                timings.setdefault(stage, []).append(duration / calibration)
+
+    return {stage: min(durations) for stage, durations in timings.items()}
+
+
+def compare(timings, baseline, tolerance):
+    """Compare the timings with the baseline.
+
+    Parameters
+    ----------
+    timings : dict
+        for each scale, the time of each stage (relative to the calibration)
+    baseline : dict
+        content of baseline.json
+    tolerance : float
+        relative slowdown which is a regression
+
+    Returns
+    -------
+    list of str
+        scales and stages which are regressions
+    """
+    if not baseline:
+        print('no baseline in ' + str(BASELINE) + ', run with --save')
+        return []
+
+    # the times are shown in ms, on this machine
+    calibration = calibrate()
+    regressions = []
+    for scale, values in timings.items():
+        expected = baseline.get(scale, {})
+        print('\n{:<16} {:>10} {:>10} {:>8}'.format(scale, 'baseline', 'now',
+                                                   'change'))
+        for stage, value in values.items():
+            if stage not in expected:
+                print('{:<16} {:>10} {:7.1f} ms'.format(stage, '',
+                                                        value * calibration * 1e3))
+                continue
+            reference = expected[stage]
+            change = (value - reference) / reference if reference else 0
+            flag = ''
+            if (value > reference * (1 + tolerance) and
+                    (value - reference) * calibration > MIN_DIFFERENCE):
+                flag = '  REGRESSION'
+                regressions.append(scale + ':' + stage)
+            print('{:<16} {:7.1f} ms {:7.1f} ms {:+7.0%}{}'.format(
+                stage, reference * calibration * 1e3,
+                value * calibration * 1e3, change, flag))
+
+    return regressions
+
+
+def _build(article_dir, cache_dir):
+    """Run md2docx in a separate process and read the stages from the trace.
+
+    Returns
+    -------
+    dict
+        time of each stage (in s)
+    """
+    trace_json = article_dir / 'trace.json'
+    env = dict(environ)
+    env['PATH'] = str(STUBS_DIR) + pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = str(BENCH_DIR.parent)  # the code in this checkout
+    env['XDG_CACHE_HOME'] = str(cache_dir)
+
+    run([executable, '-c', 'from md2docx.main import main; main()',
+         '-j', 'Neuron', '--library', 'library.bib',
+         '--acronyms', 'acronyms.txt', '--pdf', '--jobs', '1',
+         '--profile', str(trace_json)],
+        cwd=str(article_dir), env=env, check=True, capture_output=True)
+
+    with trace_json.open() as f:
+        events = load(f)['traceEvents']
+
+    durations = {}
+    for stage, prefix in STAGES.items():
+        durations[stage] = sum(x['dur'] for x in events
+                               if x['cat'] == 'stage' and x['ph'] == 'X' and
+                               x['name'].startswith(prefix)) / 1e6
+    return durations
+
+
+def _read_baseline():
+    if not BASELINE.exists():
+        return {}
+    with BASELINE.open() as f:
+        return load(f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+"""Generate synthetic inputs for the benchmarks, always with the same seed so
+that the inputs (and the timings) are reproducible.
+"""
+from json import dump
+from random import Random
+from struct import pack
+from zlib import compress, crc32
+
+FAMILY = ['Smith', 'M{\\"{u}}ller', 'Fran{\\c{c}}ois', 'GARC{\\\'{I}}A',
+          'Nystr{\\"{o}}m', 'Dvo{\\v{r}}{\\\'{a}}k', 'van der Berg', 'LEE',
+          '{\\O}rsted', 'S{\\o}rensen', 'Ko{\\c{c}}', 'Jim{\\\'{e}}nez']
+GIVEN = ['John', 'Ren{\\\'{e}}e', 'J{\\"{o}}rg', 'MARIA', 'Zo{\\"{e}}', 'A. B.',
+         'Fran{\\c{c}}oise', 'Hans', 'Ji{\\v{r}}{\\\'{i}}']
+WORDS = ['sleep', 'cortex', 'oscillations', '$\\alpha$', '$\\beta$', 'memory',
+         'spindles', 'hippocampus', '$\\theta$', 'connectivity', 'EEG', 'fMRI',
+         '$\\gamma$', 'network', 'thalamus', 'plasticity']
+JOURNALS = ['Neuron', 'NeuroImage', 'Sleep', 'Cerebral Cortex',
+            'Journal of Neuroscience']
+SECTIONS = ['Introduction', 'Results', 'Discussion', 'Materials and Methods']
+ACRONYMS = ['EEG', 'BOLD', 'ANOVA', 'DTI', 'ECoG', 'CFC', 'CSD', 'BCI', 'cICA',
+            'CxTh']
+
+
+def make_bib(bib_file, n_entries, seed=0):
+    """Write a .bib library in the format exported by Mendeley.
+
+    Parameters
+    ----------
+    bib_file : path to file
+        .bib file to write
+    n_entries : int
+        number of entries
+    seed : int
+        seed for the random generator
+    """
+    rng = Random(seed)
+
+    with bib_file.open('w') as f:
+        f.write('Automatically generated by Mendeley Desktop 1.17\n'
+                'Any changes to this file will be lost if it is regenerated '
+                'by Mendeley.\n\n')
+        for i in range(n_entries):
+            f.write(_make_entry(rng, i))
+
+
+def make_keys(n_entries):
+    """Keys of the entries generated by make_bib"""
+    return ['Key{:06d}'.format(i) for i in range(n_entries)]
+
+
+def _make_entry(rng, i):
+    entry_type = rng.choice(['article', 'article', 'article', 'book',
+                             'incollection', 'inproceedings', 'phdthesis'])
+    authors = ' and '.join(rng.choice(FAMILY) + ', ' + rng.choice(GIVEN)
+                           for _ in range(rng.randint(1, 8)))
+    title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+    abstract = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(50, 200)))
+
+    fields = [
+        ('abstract', abstract),
+        ('author', authors),
+        ('file', ':home/user/Mendeley/Key{:06d}.pdf:pdf'.format(i)),
+        ('pages', '{}--{}'.format(rng.randint(1, 500), rng.randint(501, 999))),
+        ('title', '{' + title.capitalize() + '}'),
+        ('year', str(rng.randint(1950, 2020))),
+        ]
+    if entry_type == 'article':
+        fields += [('journal', rng.choice(JOURNALS)),
+                   ('number', str(rng.randint(1, 12))),
+                   ('volume', str(rng.randint(1, 100)))]
+    elif entry_type in ('incollection', 'inproceedings'):
+        fields += [('booktitle', 'Proceedings of ' + rng.choice(JOURNALS)),
+                   ('editor', rng.choice(FAMILY) + ', ' + rng.choice(GIVEN))]
+    else:
+        fields += [('address', 'Berlin'), ('publisher', 'Springer')]
+
+    return ('@' + entry_type + '{{Key{:06d},\n'.format(i) +
+            ',\n'.join(name + ' = {' + value + '}' for name, value in fields) +
+            '\n}\n')
+
+
+def make_review(n_citations, n_keys=1000, seed=0):
+    """Write the text of a review article, with many citations.
+
+    Parameters
+    ----------
+    n_citations : int
+        number of citations (clusters with one or more keys, some repeated)
+    n_keys : int
+        number of entries of the library (as in make_keys)
+    seed : int
+        seed for the random generator
+
+    Returns
+    -------
+    str
+        text of the manuscript in markdown
+    """
+    rng = Random(seed)
+    keys = make_keys(n_keys)
+
+    clusters = []
+    paragraphs = ['# Title\n', '## Introduction\n']
+    for i in range(n_citations):
+        if clusters and rng.random() < 0.2:
+            cluster = rng.choice(clusters)
+        else:
+            cluster = '[' + '; '.join('@' + x for x in rng.sample(
+                keys, rng.randint(1, 4))) + ']'
+            clusters.append(cluster)
+
+        sentence = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 30)))
+        paragraphs.append(sentence.capitalize() + ' ' + cluster + '.')
+        if i % 20 == 19:
+            paragraphs.append('\n## Section {}\n'.format(i // 20))
+
+    paragraphs.append('\n## References\n')
+    return '\n'.join(paragraphs) + '\n'
+
+
+def make_acronym_text(n_pages, uses_per_page=30, acronyms=ACRONYMS, seed=0):
+    """Write the text of a manuscript which uses many acronyms.
+
+    Parameters
+    ----------
+    n_pages : int
+        number of pages (about 500 words each)
+    uses_per_page : int
+        number of acronyms in each page
+    acronyms : list of str
+        acronyms to use (they should be in acronyms.txt)
+    seed : int
+        seed for the random generator
+
+    Returns
+    -------
+    str
+        text of the manuscript in markdown, with the list of acronyms at the
+        end
+    """
+    rng = Random(seed)
+
+    paragraphs = []
+    for _ in range(n_pages):
+        words = [rng.choice(WORDS) for _ in range(500)]
+        for _ in range(uses_per_page):
+            words[rng.randrange(len(words))] = '[$' + rng.choice(acronyms) + ']'
+        paragraphs.append(' '.join(words))
+
+    paragraphs.append('Acronyms: [ACRONYMS]')
+    return '\n\n'.join(paragraphs) + '\n'
+
+
+def make_long_document(n_pages, n_tables, n_rows=40, n_cols=6, img_dir=None,
+                       n_figures=0, seed=0):
+    """Write the text of a long supplementary document, with formatted text,
+    many large tables and optionally embedded figures.
+
+    Parameters
+    ----------
+    n_pages : int
+        number of pages of text (about 500 words each), in the sections of
+        the journal Neuron
+    n_tables : int
+        number of tables (in the section "Tables", at the end)
+    n_rows : int
+        number of rows of each table (after the header)
+    n_cols : int
+        number of columns of each table
+    img_dir : path to dir
+        directory where the png of the figures are written (it should exist
+        if n_figures > 0)
+    n_figures : int
+        number of figures (in the section "Figures", before the tables). The
+        last figure is a copy of the first one, with a different name, to
+        check that the same image is embedded only once.
+    seed : int
+        seed for the random generator
+
+    Returns
+    -------
+    str
+        text of the document in markdown, as it's converted to docx
+    """
+    rng = Random(seed)
+    formats = ['%', '*', '^', '~']
+
+    lines = ['# Supplementary Material', ]
+    for i in range(n_pages):
+        if i % 50 == 0:
+            lines.extend(['', '## ' + SECTIONS[i // 50 % len(SECTIONS)], ''])
+        if i % 5 == 0:
+            lines.extend(['### Subsection {}'.format(i // 5), ''])
+        for _ in range(5):
+            words = [rng.choice(WORDS) for _ in range(100)]
+            for _ in range(6):
+                k = rng.randrange(len(words) - 3)
+                marker = rng.choice(formats)
+                words[k] = marker + words[k]
+                words[k + 2] = words[k + 2] + marker
+            prefix = '> ' if rng.random() < 0.1 else ''
+            lines.append(prefix + ' '.join(words[:50]) + '\\')
+            lines.append(' '.join(words[50:]))
+            lines.append('')
+
+    if n_figures:
+        lines.extend(['', '## Figures', ''])
+    for i in range(n_figures):
+        png_file = img_dir / 'fig{}.png'.format(i)
+        if i == n_figures - 1 and i > 0:
+            png_file.write_bytes((img_dir / 'fig0.png').read_bytes())
+        else:
+            _make_png(png_file, rng)
+        lines.extend(['![](' + str(png_file) + ')', '',
+                      ' '.join(rng.choice(WORDS) for _ in range(40)), ''])
+
+    lines.extend(['', '## Tables', ''])
+    for i in range(n_tables):
+        lines.append('### Table [+tab{}]'.format(i))
+        lines.append('^ ' + ' ^ '.join('Column {}'.format(j) for j in range(n_cols)) + ' ^')
+        for _ in range(n_rows):
+            lines.append('| ' + ' | '.join('{:.3f}'.format(rng.random())
+                                           for _ in range(n_cols)) + ' |')
+        lines.append('')
+
+    return '\n'.join(lines) + '\n'
+
+
+def make_article(article_dir, n_sections, n_citations, n_acronyms, n_figures,
+                 n_tables, n_entries, seed=0):
+    """Write a complete article, as it's converted by md2docx: src/main.md and
+    src/review.md, the svg figures in img/, library.bib and acronyms.txt.
+
+    Parameters
+    ----------
+    article_dir : path to dir
+        directory of the article (it should exist)
+    n_sections : int
+        number of subsections (with three paragraphs each), divided among the
+        sections of the journal Neuron
+    n_citations : int
+        number of citations (clusters with one or more keys, some repeated)
+    n_acronyms : int
+        number of acronyms (each is used three times)
+    n_figures : int
+        number of figures
+    n_tables : int
+        number of tables (with 20 rows and 5 columns)
+    n_entries : int
+        number of entries of the library
+    seed : int
+        seed for the random generator
+    """
+    rng = Random(seed)
+    keys = make_keys(n_entries)
+    acronyms = [_letters(i) for i in range(n_acronyms)]
+
+    paragraphs = []
+    for i in range(n_sections * 3):
+        words = [rng.choice(WORDS) for _ in range(120)]
+        words[0] = words[0].capitalize()
+        paragraphs.append(words)
+
+    uses = ['[$' + x + ']' for x in acronyms for _ in range(3)]
+    uses += ['Figure [+fig{}]'.format(i) for i in range(n_figures)]
+    uses += ['Table [+tab{}]'.format(i) for i in range(n_tables)]
+    clusters = []
+    for _ in range(n_citations):
+        if clusters and rng.random() < 0.2:
+            uses.append(rng.choice(clusters))
+        else:
+            clusters.append('[' + '; '.join('@' + x for x in rng.sample(
+                keys, rng.randint(1, 4))) + ']')
+            uses.append(clusters[-1])
+    for use in uses:
+        words = rng.choice(paragraphs)
+        words.insert(rng.randrange(1, len(words)), use)
+
+    lines = ['# Synthetic article', '', '## Abstract', '',
+             ' '.join(rng.choice(WORDS) for _ in range(140)).capitalize()]
+    for i, words in enumerate(paragraphs):
+        section = i * len(SECTIONS) // len(paragraphs)
+        if i == 0 or section != (i - 1) * len(SECTIONS) // len(paragraphs):
+            lines.extend(['', '## ' + SECTIONS[section]])
+        if i % 3 == 0:
+            lines.extend(['', '### Subsection {}'.format(i // 3)])
+        lines.extend(['', ' '.join(words) + '.'])
+
+    lines.extend(['', '## References', '', '## Figures'])
+    img_dir = article_dir / 'img'
+    img_dir.mkdir(exist_ok=True)
+    for i in range(n_figures):
+        lines.extend(['', '### Figure [+fig{}]'.format(i),
+                      ' '.join(rng.choice(WORDS) for _ in range(60))])
+        _make_svg(img_dir / 'fig{}.svg'.format(i), rng)
+
+    lines.extend(['', '## Tables'])
+    for i in range(n_tables):
+        lines.extend(['', '### Table [+tab{}]'.format(i),
+                      '^ ' + ' ^ '.join('Column {}'.format(j) for j in range(5)) + ' ^'])
+        for _ in range(20):
+            lines.append('| ' + ' | '.join('{:.3f}'.format(rng.random())
+                                           for _ in range(5)) + ' |')
+
+    lines.extend(['', 'Acronyms: [ACRONYMS]'])
+
+    review = ['# Reply to the reviewers']
+    for cluster in clusters[:max(1, n_citations // 10)]:
+        review.extend(['', '> ' + ' '.join(rng.choice(WORDS) for _ in range(30)),
+                       '', 'We added ' + cluster + '.'])
+    review.extend(['', '## References'])
+
+    src_dir = article_dir / 'src'
+    src_dir.mkdir(exist_ok=True)
+    (src_dir / 'main.md').write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    (src_dir / 'review.md').write_text('\n'.join(review) + '\n',
+                                       encoding='utf-8')
+
+    with (article_dir / 'acronyms.txt').open('w') as f:
+        dump({x: ' '.join(rng.choice(WORDS) for _ in range(3)) for x in acronyms},
+             f, indent=4)
+
+    make_bib(article_dir / 'library.bib', n_entries, seed=seed)
+
+
+def _letters(i):
+    """Acronym made only of letters (as required by the pattern of acronyms)"""
+    letters = ''
+    while True:
+        letters = chr(ord('A') + i % 26) + letters
+        i = i // 26
+        if i == 0:
+            return 'X' + letters
+
+
+def _make_png(png_file, rng, width=120, height=90, dpi=300):
+    """Write a png with random gray rows (8 bit, with the resolution in the
+    pHYs chunk)"""
+    def chunk(chunk_type, data):
+        return (pack('>I', len(data)) + chunk_type + data +
+                pack('>I', crc32(chunk_type + data)))
+
+    rows = b''.join(b'\x00' + bytes([rng.randrange(256)]) * width
+                    for _ in range(height))
+    ppm = int(round(dpi / 0.0254))
+    png_file.write_bytes(
+        b'\x89PNG\r\n\x1a\n' +
+        chunk(b'IHDR', pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+        chunk(b'pHYs', pack('>IIB', ppm, ppm, 1)) +
+        chunk(b'IDAT', compress(rows)) + chunk(b'IEND', b''))
+
+
+def _make_svg(svg_file, rng):
+    shapes = ''.join('<rect x="{}" y="{}" width="{}" height="{}"/>'.format(
+        rng.randint(0, 300), rng.randint(0, 200), rng.randint(10, 100),
+        rng.randint(10, 100)) for _ in range(50))
+    svg_file.write_text('<svg xmlns="http://www.w3.org/2000/svg" width="400" '
+                        'height="300">' + shapes + '</svg>\n')
@@ -0,0 +1,124 @@
+"""Build many articles, each for one or more journals, in one python process.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from json import load
+from pathlib import Path
+from time import perf_counter
+
+from .build import build, journal_args
+from .manifest import file_digest
+from .prepare_bib import fix_biblio
+from .timing import propagate, stage
+from .utils import build_name
+
+
+def read_batch_file(batch_file, journals=()):
+    """Read the list of articles to build from a json file.
+
+    Parameters
+    ----------
+    batch_file : path to file
+        json file with a list of articles, such as:
+        [{"article": "paper1", "journals": ["Neuron", "Sleep"]},
+         {"article": "../paper2"}]
+        The paths are relative to the json file.
+    journals : list of str
+        journals of the articles which do not specify them
+
+    Returns
+    -------
+    list of tuple
+        directory of the article and name of the journal
+
+    Raises
+    ------
+    ValueError
+        if an article has no journals
+    """
+    batch_file = Path(batch_file).resolve()
+    with batch_file.open() as f:
+        articles = load(f)
+
+    jobs = []
+    for article in articles:
+        article_dir = batch_file.parent / article['article']
+        article_journals = article.get('journals', journals)
+        if not article_journals:
+            raise ValueError('no journals for ' + str(article_dir))
+        jobs.extend((article_dir, x) for x in article_journals)
+
+    return jobs
+
+
+def build_all(jobs, bib_file, args):
+    """Build the documents of many articles, sharing the resources which are
+    the same for all of them.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        directory of the article and name of the journal
+    bib_file : path to file
+        original .bib file
+    args : arguments
+        arguments to md2docx_batch (the paths should be absolute)
+
+    Returns
+    -------
+    list of tuple
+        jobs which failed
+
+    Notes
+    -----
+    The library is converted and hashed only once and citeproc reads the whole
+    library (not only the cited references), so there is one citeproc worker
+    for each csl style. The journals, the acronyms, the reference docx, the
+    libreoffice profiles and the worker pools are loaded once and shared by
+    all the articles.
+
+    Up to --jobs articles are built at the same time, but all their steps run
+    in the same pools (with --jobs threads and processes). The outputs of each
+    journal are in output/JOURNAL/ (and the temporary files in tmp/JOURNAL/),
+    in the directory of the article. The messages of each build start with
+    the article and the journal.
+    """
+    with stage('prepare_bib'):
+        args.library = fix_biblio(bib_file, args.jobs)
+        # the library is an input of every article, hash it only once
+        file_digest(args.library)
+
+    t0 = perf_counter()
+    with ThreadPoolExecutor(args.jobs) as pool:
+        errors = list(pool.map(propagate(lambda job: _build_one(job, args)),
+                               jobs))
+    duration = perf_counter() - t0
+
+    failed = [job for job, error in zip(jobs, errors) if error is not None]
+    for (article_dir, journal), error in zip(jobs, errors):
+        if error is not None:
+            print('ERROR: ' + str(article_dir) + ' (' + journal + '): ' +
+                  type(error).__name__ + ': ' + str(error))
+
+    n_built = len(jobs) - len(failed)
+    print('built {} of {} articles in {:.1f} s ({:.1f} articles per minute)'
+          ''.format(n_built, len(jobs), duration, n_built / duration * 60))
+    return failed
+
+
+def _build_one(job, args):
+    """Build one article for one journal.
+
+    Returns
+    -------
+    Exception
+        error of the build (None if it succeeded)
+    """
+    article_dir, journal = job
+
+    try:
+        args = journal_args(args, journal)
+        with stage('build', article=str(article_dir), journal=journal), \
+                build_name(str(article_dir) + ' (' + journal + ')'):
+            build(article_dir, args, sub_dir=journal, cited_library=False)
+    except Exception as err:  # report error and build the other articles
+        return err
@@ -0,0 +1,358 @@
+"""Build all the documents of one article, running only the steps which are
+necessary.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from functools import partial
+from shutil import rmtree
+
+from .document import parse_md
+from .journal import get_journal
+from .manifest import Manifest, Step
+from .prepare_md import (SRC_DIR,
+                         IMG_DIR,
+                         DPI,
+                         add_references,
+                         postproc_md,
+                         preproc_md,
+                         restore_figures,
+                         set_review_ref,
+                         write_cited_library,
+                         )
+from .prepare_docx import convert_to_docx
+from .prepare_pdf import convert_to_pdf
+from .prepare_tiff import Image, convert_to_tiff
+from .scheduler import Task, run_tasks
+from .timing import propagate, stage
+from .utils import build_name, csl_dir, journals_dir, report
+
+MD_FILES = ('main.md', 'review.md', 'editor.md')
+OUT_DIR = 'output'
+TMP_DIR = 'tmp'
+
+
+def build(article_dir, args, sub_dir=None, cited_library=True):
+    """Convert the markdown files of one article to docx (and pdf, tiff).
+
+    Parameters
+    ----------
+    article_dir : path to dir
+        directory with src/ and img/
+    args : arguments
+        arguments to md2docx
+    sub_dir : str
+        subdirectory of output/ and tmp/ (such as the name of the journal),
+        so that the builds of the same article do not overwrite each other
+    cited_library : bool
+        citeproc reads a library with only the references cited in the
+        article. Otherwise, it reads args.library as it is (such as the whole
+        library, so that the same citeproc worker can be used for many
+        articles).
+
+    Notes
+    -----
+    The hash of the inputs of each step is stored in tmp/manifest.json. With
+    --incremental, tmp/ is not removed and a step is run only if its inputs
+    changed or its outputs are missing. Otherwise all the steps are run.
+
+    If the journal requires tiff, the png of each file are converted as soon
+    as they are ready, while the other steps are running. The png are removed
+    at the end, once the docx are written. With --only_md, the png are kept
+    (and not converted), because --only_docx embeds them in the docx.
+
+    With --only_docx, the markdown files are read from tmp/, so they must
+    have been written by a previous run with --only_md or --debug.
+
+    Raises
+    ------
+    FileNotFoundError
+        with --only_docx, if there are no markdown files in tmp/
+    """
+    j = get_journal(args.journal_json)
+
+    to_tiff = (j.figure_format() == 'tiff' and not args.keep_png and
+               not args.only_md)
+    if to_tiff and Image is None:
+        raise ImportError('cannot convert png to tiff, install Pillow')
+    compression = args.tiff_compression or j.figure_compression()
+    converted = set()  # png which were converted to tiff
+
+    out_dir = article_dir / OUT_DIR
+    tmp_dir = article_dir / TMP_DIR
+    if sub_dir is not None:
+        out_dir = out_dir / sub_dir
+        tmp_dir = tmp_dir / sub_dir
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    if not args.only_docx and not args.incremental:
+        # remove tmp directory if we run prepare_md again
+        try:
+            rmtree(str(tmp_dir))
+        except OSError:
+            pass
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = Manifest(tmp_dir, args.incremental)
+
+    if not args.only_docx and cited_library:
+        # citeproc reads only the cited references
+        args = copy(args)
+        args.library = write_cited_library(article_dir, tmp_dir, MD_FILES,
+                                           args.library)
+
+    # files and arguments which affect every markdown file
+    common_inputs = [args.library, args.csl, args.journal_json, args.acronyms]
+    common_inputs = [article_dir / x for x in common_inputs]
+    common_values = [args.embed, args.skip_inkscape, args.fast_docx, DPI]
+
+    md_steps = {}
+    docs = {}  # structure of the markdown files, shared between the tasks
+    tasks = []
+    if not args.only_docx:
+
+        for md_file in MD_FILES:
+            src_files = [article_dir / SRC_DIR / md_file, ]
+            if md_file == 'review.md':
+                # cross-references from main.md
+                src_files.append(article_dir / SRC_DIR / 'main.md')
+
+            # the document is kept in memory, so the same step goes from
+            # src/ to the docx (tmp/ has the markdown only for debugging)
+            outputs = []
+            other_inputs = []
+            if args.debug or args.only_md:
+                outputs.append(tmp_dir / md_file)
+            if not args.only_md:
+                outputs.append(out_dir / md_file.replace('.md', '.docx'))
+                other_inputs.append(article_dir / args.ref_docx)
+
+            step = Step(manifest, 'md:' + md_file,
+                        _md_inputs(article_dir, src_files,
+                                   common_inputs + other_inputs),
+                        outputs=outputs,
+                        values=common_values)
+            md_steps[md_file] = step
+
+            # the step is recorded only once the docx is written (or, with
+            # only_md, once the markdown is complete)
+            tasks.append(Task('md:' + md_file, _preproc,
+                              (step, docs, article_dir, out_dir, md_file,
+                               args),
+                              step=step, record=False))
+            tasks.append(Task('fig:' + md_file, _restore_figures,
+                              (step, article_dir, out_dir, args),
+                              depends=('md:' + md_file, )))
+            if to_tiff:
+                tasks.append(Task('tiff:' + md_file, _convert_figures,
+                                  lambda step=step: (
+                                      manifest, _png_files(out_dir, step),
+                                      compression, converted, args.jobs),
+                                  depends=('fig:' + md_file, )))
+            tasks.append(Task('post:' + md_file, postproc_md,
+                              lambda md_file=md_file: (tmp_dir, md_file,
+                                                       docs.get(md_file), args),
+                              depends=('cite', ), step=step,
+                              record=args.only_md and md_file != 'review.md'))
+
+        # citeproc formats the citations of all the files at once
+        tasks.append(Task('cite', add_references, (docs, tmp_dir, args),
+                          depends=['md:' + x for x in MD_FILES]))
+
+        # review.md needs the cross-references from main.md, the rest can run
+        # in parallel
+        tasks.append(Task('crossref', set_review_ref,
+                          lambda: (tmp_dir, docs.get('review.md'), args),
+                          depends=('post:main.md', 'post:review.md'),
+                          step=md_steps['review.md'], record=args.only_md))
+
+    if args.only_docx:
+        _check_tmp_md(article_dir, tmp_dir)
+
+    if not args.only_md:
+        for md_file in MD_FILES:
+            docx_path = out_dir / md_file.replace('.md', '.docx')
+
+            if args.only_docx:
+                step = Step(manifest, 'docx:' + md_file,
+                            _docx_inputs(tmp_dir / md_file, out_dir,
+                                         [article_dir / args.ref_docx,
+                                          article_dir / args.journal_json]),
+                            outputs=[docx_path, ],
+                            values=[args.embed, args.fast_docx])
+                tasks.append(Task('docx:' + md_file, _convert_tmp_md,
+                                  (out_dir, tmp_dir, md_file, args),
+                                  in_process=True, step=step))
+
+            else:
+                if md_file == 'review.md':
+                    depends = ('crossref', 'fig:' + md_file)
+                else:
+                    depends = ('post:' + md_file, 'fig:' + md_file)
+
+                # the document is passed when the task starts
+                tasks.append(Task('docx:' + md_file, convert_to_docx,
+                                  lambda md_file=md_file: (
+                                      out_dir, docs.get(md_file), md_file,
+                                      args),
+                                  depends=depends, in_process=True,
+                                  step=md_steps[md_file]))
+
+            if args.pdf:
+                # each libreoffice has its own profile, so the pdf are
+                # converted at the same time, while the other docx are written
+                step = Step(manifest, 'pdf:' + md_file,
+                            lambda docx_path=docx_path: [docx_path, ],
+                            outputs=[docx_path.with_suffix('.pdf'), ])
+                tasks.append(Task('pdf:' + md_file, convert_to_pdf,
+                                  ([docx_path, ], args.jobs,
+                                   args.libreoffice_path),
+                                  depends=('docx:' + md_file, ), step=step))
+
+    run_tasks(tasks, args.jobs)
+
+    if to_tiff:
+        # the other png (such as with only_docx) are converted at the end
+        all_png = sorted(out_dir.glob('*.png'))
+        with stage('tiff'):
+            _convert_figures(manifest,
+                             [x for x in all_png if x not in converted],
+                             compression, converted, args.jobs)
+        for one_png in all_png:
+            one_png.unlink()
+
+
+def build_journals(article_dir, args):
+    """Convert the markdown files of one article for several journals.
+
+    Parameters
+    ----------
+    article_dir : path to dir
+        directory with src/ and img/
+    args : arguments
+        arguments to md2docx, with the list of journals in args.journal
+
+    Notes
+    -----
+    The outputs of each journal are in output/JOURNAL/ (and the temporary
+    files in tmp/JOURNAL/). The journals are built at the same time and they
+    share the steps which do not depend on the journal: the library with the
+    cited references is written once to tmp/, the markdown files are parsed
+    once, the acronyms are expanded once (for the journals with the same
+    order of the sections) and each figure is converted to png once. Only
+    organize_md, the citations (with the csl of each journal), the docx (and
+    its page breaks) and the figures (embedded or not, png or tiff) are done
+    for each journal. The messages of each build start with the journal.
+    """
+    if not args.only_docx:
+        tmp_dir = article_dir / TMP_DIR
+        tmp_dir.mkdir(exist_ok=True)
+        args = copy(args)
+        args.library = write_cited_library(article_dir, tmp_dir, MD_FILES,
+                                           args.library)
+
+    def build_one(journal):
+        with stage('build:' + journal), build_name(journal):
+            build(article_dir, journal_args(args, journal), sub_dir=journal,
+                  cited_library=False)
+
+    with ThreadPoolExecutor(args.jobs) as pool:
+        list(pool.map(propagate(build_one), args.journal))
+
+
+def journal_args(args, journal):
+    """Copy of the arguments for one journal, with its json and its csl"""
+    args = copy(args)
+    args.journal = journal
+    args.journal_json = journals_dir / (journal + '.json')
+    args.csl = csl_dir / get_journal(args.journal_json).csl
+    return args
+
+
+def _md_inputs(article_dir, src_files, common_inputs):
+    """Function returning the inputs of preproc_md"""
+    def inputs():
+        svg_files = sorted((article_dir / IMG_DIR).glob('*.svg'))
+        return src_files + svg_files + common_inputs
+    return inputs
+
+
+def _docx_inputs(md_path, out_dir, other_inputs):
+    """Function returning the inputs of convert_to_docx with only_docx,
+    including the png which are embedded"""
+    def inputs():
+        png_files = sorted(out_dir.glob('*.png'))
+        return [md_path, ] + png_files + other_inputs
+    return inputs
+
+
+def _preproc(step, docs, article_dir, out_dir, md_file, args):
+    doc, step.result = preproc_md(article_dir, out_dir, md_file, args)
+    if doc is not None:
+        docs[md_file] = doc
+
+
+def _restore_figures(step, article_dir, out_dir, args):
+    if step.current and step.result is not None:
+        restore_figures(article_dir, out_dir, step.result, args)
+
+
+def _png_files(out_dir, step):
+    """png of the figures of one markdown file (once they are converted)"""
+    if step.result is None:
+        return []
+    return [out_dir / x for x in step.result[1] if (out_dir / x).exists()]
+
+
+def _convert_figures(manifest, png_files, compression, converted, jobs):
+    """Convert png to tiff in parallel, unless the tiff are up to date.
+
+    Parameters
+    ----------
+    manifest : instance of Manifest
+        where the steps are stored
+    png_files : list of path to file
+        png images to convert
+    compression : str
+        compression of the tiff ('none', 'lzw' or 'deflate')
+    converted : set
+        png which were converted (it's modified in place)
+    jobs : int
+        number of figures to convert at the same time
+    """
+    todo = []
+    for one_png in png_files:
+        converted.add(one_png)
+        step = Step(manifest, 'tiff:' + one_png.name,
+                    lambda one_png=one_png: [one_png, ],
+                    outputs=[one_png.with_suffix('.tiff'), ],
+                    values=[compression, ])
+        if not step.is_current():
+            todo.append((one_png, step))
+
+    with ThreadPoolExecutor(jobs) as pool:
+        list(pool.map(partial(convert_to_tiff, compression=compression),
+                      [x[0] for x in todo]))
+    for _, step in todo:
+        step.record()
+
+
+def _check_tmp_md(article_dir, tmp_dir):
+    """Check that the markdown files for --only_docx exist in tmp_dir"""
+    missing = [x for x in MD_FILES if not (tmp_dir / x).exists()]
+    if len(missing) == len(MD_FILES):
+        raise FileNotFoundError('no markdown files in ' + str(tmp_dir) +
+                                ', run md2docx with --only_md or --debug '
+                                'before --only_docx')
+    for md_file in missing:
+        if (article_dir / SRC_DIR / md_file).exists():
+            report('WARNING: ' + str(tmp_dir / md_file) + ' is missing, '
+                   'no docx for ' + md_file + ' (run md2docx with --only_md '
+                   'or --debug first)')
+
+
+def _convert_tmp_md(out_dir, tmp_dir, md_file, args):
+    """Convert the markdown in tmp_dir (written with --debug or --only_md)"""
+    md_path = tmp_dir / md_file
+    if md_path.exists():
+        doc = parse_md(md_path.read_text(encoding='utf-8'))
+        convert_to_docx(out_dir, doc, md_file, args)
@@ -0,0 +1,148 @@
+"""Keep citeproc.js running in node, so that the engine, the style, the locale
+and the bibliography are loaded only once per run.
+"""
+from atexit import register
+from json import dumps, loads
+from pathlib import Path
+from subprocess import Popen, PIPE
+from threading import Lock
+
+from .timing import external
+from .utils import (loc_dir,
+                    node_dir,
+                    report,
+                    )
+
+
+_WORKERS = {}
+_WORKERS_LOCK = Lock()
+
+
+class CiteprocWorker:
+    """node process running processcite.js in worker mode.
+
+    Parameters
+    ----------
+    node : str
+        node executable
+    biblio : instance of Path
+        json library with the references
+    csl : path to file
+        csl style to use
+
+    Notes
+    -----
+    The citations are sent to the worker as one line of json per document on
+    stdin and it replies with one line of json per document on stdout, so no
+    files are written. Requests are serialized, so the same worker can be shared
+    between threads.
+    """
+    def __init__(self, node, biblio, csl):
+        cmd = [node,
+               'processcite.js',
+               '--worker',
+               str(biblio),
+               str(csl),
+               str(loc_dir)]
+        report(' '.join(cmd))
+
+        self.lock = Lock()
+        self.proc = Popen(cmd, cwd=str(node_dir), stdin=PIPE, stdout=PIPE,
+                          encoding='utf-8')
+
+    def process(self, documents):
+        """Format the citations of some documents
+
+        Parameters
+        ----------
+        documents : list of list of dict
+            for each document, the citations in the format of citeproc.js.
+            Each document has its own numbering.
+
+        Returns
+        -------
+        list of dict
+            for each document, 'citations' is the list of formatted citations
+            and 'references' is the formatted bibliography (html)
+
+        Raises
+        ------
+        RuntimeError
+            if node exits or cannot format the citations
+        """
+        replies = []
+        with self.lock, external('node'):
+            for citations in documents:
+                self.proc.stdin.write(dumps(citations) + '\n')
+                self.proc.stdin.flush()
+                line = self.proc.stdout.readline()
+
+                if not line:
+                    raise RuntimeError('citeproc worker exited with code {}'
+                                       ''.format(self.proc.poll()))
+                replies.append(loads(line))
+
+        for reply in replies:
+            if 'error' in reply:
+                raise RuntimeError('citeproc worker failed: ' + reply['error'])
+        return replies
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+def get_worker(biblio, csl, node_path=None):
+    """Return a running worker for this bibliography and style, starting one
+    if necessary.
+
+    Parameters
+    ----------
+    biblio : instance of Path
+        json library with the references
+    csl : path to file
+        csl style to use
+    node_path : str
+        path to directory containing node (if not on PATH already)
+
+    Returns
+    -------
+    instance of CiteprocWorker
+        worker which stays alive until the end of the python process
+
+    Notes
+    -----
+    The worker is restarted if the library was modified after the worker was
+    started.
+    """
+    if node_path is not None:
+        node = str(Path(node_path) / 'node')
+    else:
+        node = 'node'
+
+    biblio = Path(biblio).resolve()
+    mtime = biblio.stat().st_mtime
+    key = (node, str(biblio), str(csl))
+
+    with _WORKERS_LOCK:
+        worker_mtime, worker = _WORKERS.get(key, (None, None))
+        if worker is not None and (worker_mtime != mtime or
+                                   worker.proc.poll() is not None):
+            worker.close()
+            worker = None
+
+        if worker is None:
+            worker = CiteprocWorker(node, biblio, csl)
+            _WORKERS[key] = (mtime, worker)
+
+    return worker
+
+
+@register
+def close_workers():
+    """Stop all the running workers"""
+    with _WORKERS_LOCK:
+        for _, worker in _WORKERS.values():
+            worker.close()
+        _WORKERS.clear()
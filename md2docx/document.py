@@ -0,0 +1,323 @@
+"""Structure of a markdown file, parsed once from src/ and then modified in
+place by each step of the conversion, until it's written to docx.
+
+The structure follows the markdown used by md2docx: a document is made of
+sections ("## Name"), each section is made of blocks (headings, figures,
+images, tables, paragraphs and blank lines), and each block keeps its lines
+of text. The steps of the conversion change the text of the lines, without
+parsing the whole file again. The lines are kept as they are, so that the
+document can be written back to markdown (for debugging).
+"""
+from .patterns import ESCAPED_FORMAT, FIGURE_LINK, RUN_FORMAT, SECTION
+
+
+class Document:
+    """Markdown file, divided into sections.
+
+    Parameters
+    ----------
+    sections : list of instances of Section
+        sections of the document. The first section has no name and it
+        contains the text before the first section (such as the title).
+    """
+    __slots__ = ('sections', )
+
+    def __init__(self, sections):
+        self.sections = sections
+
+    def blocks(self):
+        """Iterate over all the blocks, in the order of the document"""
+        for section in self.sections:
+            yield from section.blocks
+
+    def lines(self):
+        """Iterate over all the lines of text, in the order of the document"""
+        for block in self.blocks():
+            yield from block.lines
+
+    def map_lines(self, func):
+        """Change each line of text, in the order of the document.
+
+        Parameters
+        ----------
+        func : function
+            function which takes one line and returns the new text. The new
+            text can contain new lines.
+        """
+        for block in self.blocks():
+            block.lines = [func(x) for x in block.lines]
+
+    def copy(self):
+        """Copy of the structure, which can be modified without changing this
+        document (the lines of text are shared, because they are strings)"""
+        return Document([Section(section.name,
+                                 [type(x)(list(x.lines)) for x in section.blocks])
+                         for section in self.sections])
+
+    def to_md(self):
+        """Write the document back to markdown"""
+        md = []
+        for section in self.sections:
+            if section.name is not None:
+                md.append('\n## ' + section.name + '\n')
+            md.append(section.to_md())
+        return ''.join(md)
+
+
+class Section:
+    """Part of the document which starts with "## Name".
+
+    Parameters
+    ----------
+    name : str
+        name of the section (None for the text before the first section)
+    blocks : list
+        blocks in the section
+    """
+    __slots__ = ('name', 'blocks')
+
+    def __init__(self, name, blocks):
+        self.name = name
+        self.blocks = blocks
+
+    def to_md(self):
+        """Text of the section (without the name)"""
+        return '\n'.join(x for block in self.blocks for x in block.lines)
+
+
+class Block:
+    """Consecutive lines of the same type.
+
+    Parameters
+    ----------
+    lines : list of str
+        lines of text of the block
+    """
+    __slots__ = ('lines', )
+
+    def __init__(self, lines):
+        self.lines = lines
+
+
+class Heading(Block):
+    """Line starting with "# ", "## " (when it's not the start of a section)
+    or "### "."""
+    __slots__ = ()
+
+    @property
+    def level(self):
+        return self.lines[0].index(' ') - 1
+
+    @property
+    def text(self):
+        return self.lines[0][self.level + 2:]
+
+
+class Figure(Heading):
+    """Heading of a figure ("### Figure [+name]"). Once the figures are
+    included, the second line is the link to the png."""
+    __slots__ = ()
+
+
+class Image(Block):
+    """Line with a link to an image ("![](path)")"""
+    __slots__ = ()
+
+    @property
+    def path(self):
+        return self.lines[0][4:-1]
+
+
+class Table(Block):
+    """Table, where the first line can be the header (between ^) and the
+    other lines are the rows (between |). If there is no header, the rows
+    belong to the previous table."""
+    __slots__ = ()
+
+    @property
+    def header(self):
+        """Text of each cell of the header (None if there is no header)"""
+        if _is_table_header(self.lines[0]):
+            return [remove_slash(x.strip()) for x in self.lines[0].split('^')[1:-1]]
+
+    @property
+    def rows(self):
+        """Text of each cell of each row"""
+        return [[remove_slash(x.strip()) for x in line.split('|')[1:-1]]
+                for line in self.lines if not _is_table_header(line)]
+
+
+class Paragraph(Block):
+    """Lines of text. Each paragraph ends with a blank line."""
+    __slots__ = ()
+
+
+class Blank(Block):
+    """Empty lines, which end the paragraph"""
+    __slots__ = ()
+
+
+class Run:
+    """Part of a line of text with the same format.
+
+    Parameters
+    ----------
+    text : str
+        text of the run (without the format markers)
+    bold, italic, superscript, subscript : bool
+        format of the text
+    line_break : bool
+        if the line ends after this run
+    """
+    __slots__ = ('text', 'bold', 'italic', 'superscript', 'subscript',
+                 'line_break')
+
+    def __init__(self, text, bold=False, italic=False, superscript=False,
+                 subscript=False, line_break=False):
+        self.text = text
+        self.bold = bold
+        self.italic = italic
+        self.superscript = superscript
+        self.subscript = subscript
+        self.line_break = line_break
+
+
+def parse_md(md):
+    """Parse the text of a markdown file.
+
+    Parameters
+    ----------
+    md : str
+        text of the markdown file
+
+    Returns
+    -------
+    instance of Document
+        structure of the markdown file
+    """
+    md_parts = SECTION.split(md)
+
+    sections = [Section(None, parse_lines(md_parts[0].split('\n'))), ]
+    for name, text in zip(md_parts[1::2], md_parts[2::2]):
+        sections.append(Section(name, parse_lines(text.split('\n'))))
+
+    return Document(sections)
+
+
+def parse_lines(lines):
+    """Group lines of markdown into blocks.
+
+    Parameters
+    ----------
+    lines : list of str
+        lines of markdown
+
+    Returns
+    -------
+    list
+        blocks of the section
+
+    Notes
+    -----
+    The figure heading is split, so that the link to the png can be added
+    right after "### Figure [+name]". Any text after it on the same line goes
+    to the next line.
+    """
+    blocks = []
+    for line in lines:
+        block_type = _line_type(line)
+
+        if block_type is Figure:
+            m = FIGURE_LINK.match(line)
+            blocks.append(Figure([m.group(), ]))
+            line = line[m.end():]
+            block_type = _line_type(line)
+
+        previous = type(blocks[-1]) if blocks else None
+        if block_type in (Paragraph, Blank) and previous is block_type:
+            blocks[-1].lines.append(line)
+        elif (block_type is Table and previous is Table and
+                not _is_table_header(line)):
+            blocks[-1].lines.append(line)
+        else:
+            blocks.append(block_type([line, ]))
+
+    return blocks
+
+
+def parse_runs(line):
+    """Divide a line of text into runs with the same format.
+
+    Parameters
+    ----------
+    line : str
+        line of text, with %bold%, *italics*, ^superscript^, ~subscript~
+        and a backslash at the end for a line break
+
+    Returns
+    -------
+    list of instances of Run
+        runs of text (including the empty ones, between two markers)
+    """
+    # the text of the runs and the format markers, in one pass
+    parts = RUN_FORMAT.split(line)
+    values = parts[1::2]
+    values.append('')
+
+    runs = []
+    italics = False
+    bold = False
+    superscript = False
+    subscript = False
+
+    for one_run, one_value in zip(parts[0::2], values):
+
+        one_run = remove_slash(one_run)
+
+        if one_run.endswith('\\'):
+            line_break = True
+            one_run = one_run[:-1]
+        else:
+            line_break = False
+
+        runs.append(Run(one_run, bold, italics, superscript, subscript,
+                        line_break))
+
+        if one_value == '%':
+            bold = not bold
+        if one_value == '*':
+            italics = not italics
+        if one_value == '^':
+            superscript = not superscript
+        if one_value == '~':
+            subscript = not subscript
+
+    return runs
+
+
+def remove_slash(s):
+    return ESCAPED_FORMAT.sub('\\g<1>', s)
+
+
+def _line_type(line):
+    """Type of block of one line (in the same order as they were read from
+    the markdown file)"""
+    if line.startswith('### '):
+        if FIGURE_LINK.match(line):
+            return Figure
+        return Heading
+    elif line.startswith('# ') or line.startswith('## '):
+        return Heading
+    elif line.startswith('![]('):
+        return Image
+    elif _is_table_header(line) or (len(line) > 0 and line[0] == '|' and
+                                    line[-1] == '|'):
+        return Table
+    elif line.strip() == '':
+        return Blank
+    else:
+        return Paragraph
+
+
+def _is_table_header(line):
+    return len(line) > 0 and line[0] == '^' and line[-1] == '^'
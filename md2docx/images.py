@@ -0,0 +1,193 @@
+"""Read the size and the resolution of the images which are embedded in the
+docx, without python-docx.
+
+The native size of the image (in EMU) is computed from the size in pixels and
+the dpi stored in the file, with the same rules as python-docx (72 dpi when
+the file does not specify it), so that the pictures have the same size with
+DocxWriter and OoxmlWriter.
+"""
+from pathlib import Path
+from struct import unpack_from
+
+EMUS_PER_INCH = 914400
+DEFAULT_DPI = 72
+
+# TIFF tags and field types
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+X_RESOLUTION = 282
+Y_RESOLUTION = 283
+RESOLUTION_UNIT = 296
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+
+# JPEG markers
+APP0 = 0xe0
+APP1 = 0xe1
+SOS = 0xda
+SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb,
+               0xcd, 0xce, 0xcf}
+STANDALONE_MARKERS = {0x01, 0xd8, 0xd9} | set(range(0xd0, 0xd8))
+
+
+class ImageFile:
+    """Image to embed in the docx.
+
+    Parameters
+    ----------
+    path : path to file
+        image file (png, jpeg, gif, tiff or bmp)
+
+    Attributes
+    ----------
+    blob : bytes
+        content of the file
+    filename : str
+        name of the file
+    ext : str
+        extension of the file (without the dot)
+    content_type : str
+        MIME type of the image
+    cx, cy : int
+        native width and height (in EMU)
+
+    Raises
+    ------
+    ValueError
+        if the format of the image is not supported
+    """
+    __slots__ = ('blob', 'filename', 'ext', 'content_type', 'cx', 'cy')
+
+    def __init__(self, path):
+        path = Path(path)
+        self.blob = path.read_bytes()
+        self.filename = path.name
+        self.ext = path.suffix[1:]
+
+        self.content_type, px_size, dpi = _read_header(self.blob)
+        if self.content_type is None:
+            raise ValueError('unknown image format: ' + str(path))
+        self.cx, self.cy = (int(px / one_dpi * EMUS_PER_INCH)
+                            for px, one_dpi in zip(px_size, dpi))
+
+
+def _read_header(blob):
+    """Content type, size in pixels and dpi of an image (the content type is
+    None for unknown formats)"""
+    if blob.startswith(b'\x89PNG\r\n\x1a\n'):
+        return ('image/png', ) + _png(blob)
+    if blob[6:10] in (b'JFIF', b'Exif'):
+        return ('image/jpeg', ) + _jpeg(blob, blob[6:10] == b'Exif')
+    if blob[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif', unpack_from('<HH', blob, 6), (DEFAULT_DPI, ) * 2
+    if blob[:4] in (b'MM\x00*', b'II*\x00'):
+        entries = _tiff_entries(blob)
+        return ('image/tiff',
+                (entries.get(IMAGE_WIDTH), entries.get(IMAGE_LENGTH)),
+                _tiff_dpi(entries))
+    if blob[:2] == b'BM':
+        width, height = unpack_from('<II', blob, 0x12)
+        dpi = tuple(int(round(x * 0.0254)) if x else 96
+                    for x in unpack_from('<II', blob, 0x26))
+        return 'image/bmp', (width, height), dpi
+    return None, None, None
+
+
+def _png(blob):
+    """Size from the IHDR chunk and dpi from the pHYs chunk"""
+    size = None
+    dpi = (DEFAULT_DPI, DEFAULT_DPI)
+    offset = 8
+    while offset + 8 <= len(blob):
+        length, chunk_type = unpack_from('>I4s', blob, offset)
+        if chunk_type == b'IHDR' and size is None:
+            size = unpack_from('>II', blob, offset + 8)
+        elif chunk_type == b'pHYs':
+            x, y, unit = unpack_from('>IIB', blob, offset + 8)
+            dpi = tuple(int(round(z * 0.0254)) if unit == 1 and z else
+                        DEFAULT_DPI for z in (x, y))
+            break
+        elif chunk_type == b'IEND':
+            break
+        offset += length + 12
+    return size, dpi
+
+
+def _jpeg(blob, exif):
+    """Size from the first SOF marker and dpi from the first APP0 (JFIF) or
+    APP1 (Exif) marker, until the start of the scan"""
+    size = None
+    dpi = None
+    offset = 0
+    while True:
+        # the marker is the first byte after one or more 0xff
+        offset = blob.index(b'\xff', offset)
+        while blob[offset] == 0xff:
+            offset += 1
+        marker = blob[offset]
+        offset += 1
+        if marker == 0:  # escaped 0xff, not a marker
+            continue
+        if marker == SOS:
+            break
+        if marker in STANDALONE_MARKERS:
+            continue
+
+        length = unpack_from('>H', blob, offset)[0]
+        if marker in SOF_MARKERS and size is None:
+            height, width = unpack_from('>HH', blob, offset + 3)
+            size = (width, height)
+        elif marker == APP0 and not exif and dpi is None:
+            unit, x, y = unpack_from('>BHH', blob, offset + 9)
+            if unit == 1:
+                dpi = (x, y)
+            elif unit == 2:
+                dpi = (int(round(x * 2.54)), int(round(y * 2.54)))
+            else:
+                dpi = (DEFAULT_DPI, DEFAULT_DPI)
+        elif marker == APP1 and exif and dpi is None:
+            if blob[offset + 2:offset + 8] == b'Exif\x00\x00':
+                dpi = _tiff_dpi(_tiff_entries(
+                    blob[offset + 8:offset + length]))
+            else:
+                dpi = (DEFAULT_DPI, DEFAULT_DPI)
+        offset += length
+
+    if size is None or dpi is None:
+        raise ValueError('no size or no resolution in the jpeg image')
+    return size, dpi
+
+
+def _tiff_entries(blob):
+    """Values of the first IFD of a TIFF file (only single numbers)"""
+    endian = '>' if blob[:2] == b'MM' else '<'
+    ifd = unpack_from(endian + 'I', blob, 4)[0]
+    n_entries = unpack_from(endian + 'H', blob, ifd)[0]
+
+    entries = {}
+    for i in range(n_entries):
+        tag, field_type, count, value = unpack_from(endian + 'HHII', blob,
+                                                    ifd + 2 + i * 12)
+        if count != 1:
+            continue
+        if field_type == SHORT:
+            entries[tag] = unpack_from(endian + 'H', blob, ifd + 10 + i * 12)[0]
+        elif field_type == LONG:
+            entries[tag] = value
+        elif field_type == RATIONAL:
+            numerator, denominator = unpack_from(endian + 'II', blob, value)
+            entries[tag] = numerator / denominator
+    return entries
+
+
+def _tiff_dpi(entries):
+    """Horizontal and vertical dpi from the resolution (inch by default)"""
+    unit = entries.get(RESOLUTION_UNIT, 2)
+    dpi = []
+    for tag in (X_RESOLUTION, Y_RESOLUTION):
+        if tag not in entries or unit == 1:
+            dpi.append(DEFAULT_DPI)
+        else:
+            dpi.append(int(round(entries[tag] * (1 if unit == 2 else 2.54))))
+    return tuple(dpi)
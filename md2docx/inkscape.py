@@ -0,0 +1,225 @@
+"""Run inkscape to convert svg to png, either once per figure or through a
+pool of inkscape processes running in shell mode.
+"""
+from atexit import register
+from os import read, stat
+from queue import Empty, Queue
+from subprocess import run, Popen, PIPE, DEVNULL
+from threading import Lock
+
+from .timing import external
+from .utils import report
+
+PROMPT = b'> '
+
+_POOLS = {}
+_POOLS_LOCK = Lock()
+
+
+class InkscapeShell:
+    """One inkscape process in shell mode (inkscape >= 1.0).
+
+    Parameters
+    ----------
+    inkscape : str
+        inkscape executable
+
+    Raises
+    ------
+    RuntimeError
+        if inkscape does not start in shell mode
+    """
+    def __init__(self, inkscape):
+        report(inkscape + ' --shell')
+        self.proc = Popen([inkscape, '--shell'], stdin=PIPE, stdout=PIPE,
+                          stderr=DEVNULL)
+        self._wait_prompt()
+
+    def _wait_prompt(self):
+        """Read the output of inkscape until it asks for the next command"""
+        output = b''
+        while not output.endswith(PROMPT):
+            chunk = read(self.proc.stdout.fileno(), 4096)
+            if not chunk:
+                self.proc.wait()
+                raise RuntimeError('inkscape --shell exited with code {}'
+                                   ''.format(self.proc.returncode))
+            output += chunk
+
+    def export(self, svg_file, png_file, dpi, background):
+        """Convert one svg to png.
+
+        Parameters
+        ----------
+        svg_file : path to file
+            svg image
+        png_file : path to file
+            png image to write
+        dpi : int
+            resolution of the png
+        background : str
+            color of the background
+        """
+        actions = [
+            'file-open:' + str(svg_file),
+            'export-dpi:' + str(dpi),
+            'export-background:' + background,
+            'export-filename:' + str(png_file),
+            'export-do',
+            'file-close',
+            ]
+        self.proc.stdin.write(('; '.join(actions) + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+        self._wait_prompt()
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.write(b'quit\n')
+                self.proc.stdin.close()
+            except OSError:
+                pass
+            self.proc.wait()
+
+
+class ShellPool:
+    """Pool of inkscape processes in shell mode, started only when needed.
+
+    Parameters
+    ----------
+    inkscape : str
+        inkscape executable
+    n_shells : int
+        maximum number of inkscape processes
+
+    Attributes
+    ----------
+    available : bool
+        False if inkscape could not be started in shell mode or if a shell
+        stopped responding
+
+    Notes
+    -----
+    The queue contains one item per slot: either an idle shell or None, if the
+    shell for that slot has not been started yet.
+    """
+    def __init__(self, inkscape, n_shells):
+        self.inkscape = inkscape
+        self.available = True
+
+        self.idle = Queue()
+        for _ in range(n_shells):
+            self.idle.put(None)
+
+    def export(self, svg_file, png_file, dpi, background):
+        """Convert one svg to png with the first inkscape which is free.
+
+        Raises
+        ------
+        OSError, RuntimeError
+            if inkscape cannot be started or it stops (and then the pool is
+            not available anymore)
+        """
+        shell = self.idle.get()
+        try:
+            if shell is None:
+                shell = InkscapeShell(self.inkscape)
+            shell.export(svg_file, png_file, dpi, background)
+
+        except (OSError, RuntimeError):
+            self.available = False
+            if shell is not None:
+                shell.close()
+            self.idle.put(None)
+            raise
+
+        self.idle.put(shell)
+
+    def close(self):
+        while True:
+            try:
+                shell = self.idle.get_nowait()
+            except Empty:
+                break
+            if shell is not None:
+                shell.close()
+
+
+def export_png(inkscape, svg_file, png_file, dpi, background, n_shells=0):
+    """Convert svg to png with inkscape.
+
+    Parameters
+    ----------
+    inkscape : str
+        inkscape executable
+    svg_file : path to file
+        svg image
+    png_file : path to file
+        png image to write
+    dpi : int
+        resolution of the png
+    background : str
+        color of the background
+    n_shells : int
+        if larger than zero, use a pool of this many inkscape in shell mode,
+        which stay open until the end of the python process. Otherwise, start
+        inkscape once for this figure.
+
+    Notes
+    -----
+    If inkscape does not support the shell mode or a shell stops responding,
+    the pool is not used anymore and it falls back to one inkscape per figure.
+    If the shell does not write the png (or the path contains ";", which
+    separates the commands in shell mode), only this figure is converted
+    without shell mode.
+    """
+    if n_shells > 0 and ';' not in str(svg_file) + str(png_file):
+        pool = _get_pool(inkscape, n_shells)
+        if pool.available:
+            try:
+                with external('inkscape'):
+                    pool.export(svg_file, png_file, dpi, background)
+                if stat(str(png_file)).st_size == 0:
+                    raise RuntimeError('no png for ' + str(svg_file))
+                return
+
+            except (OSError, RuntimeError) as err:
+                # the pool stops only if the shells do not work, otherwise
+                # only this figure is converted again
+                if pool.available:
+                    report('WARNING: inkscape shell mode could not convert ' +
+                           str(svg_file) + ' (' + str(err) + '), trying again '
+                           'without shell mode')
+                else:
+                    report('WARNING: inkscape shell mode failed (' + str(err) +
+                           '), converting one figure at a time')
+
+    cmd = [
+        inkscape,
+        str(svg_file),
+        '--export-dpi=' + str(dpi),
+        '--export-background=' + background,
+        '--export-filename=' + str(png_file),
+        ]
+    report(' '.join(cmd))
+    with external('inkscape'):
+        run(cmd, stdout=DEVNULL, stderr=DEVNULL)
+
+
+def _get_pool(inkscape, n_shells):
+    with _POOLS_LOCK:
+        pool = _POOLS.get(inkscape)
+        if pool is None:
+            pool = ShellPool(inkscape, n_shells)
+            _POOLS[inkscape] = pool
+    return pool
+
+
+@register
+def close_shells():
+    """Stop all the inkscape processes in shell mode"""
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+        _POOLS.clear()
+
@@ -1,4 +1,35 @@
 from json import load
+from pathlib import Path
+from threading import Lock
+
+_JOURNALS = {}
+_JOURNALS_LOCK = Lock()
+
+
+def get_journal(journal_json):
+    """Return the Journal for this json file, reading it only if it changed
+    since the last call.
+
+    Parameters
+    ----------
+    journal_json : instance of Path
+        path to journal .json file
+
+    Returns
+    -------
+    instance of Journal
+        information regarding the journal
+    """
+    journal_json = Path(journal_json).resolve()
+    mtime = journal_json.stat().st_mtime
+
+    with _JOURNALS_LOCK:
+        j_mtime, j = _JOURNALS.get(journal_json, (None, None))
+        if j_mtime != mtime:
+            j = Journal(journal_json)
+            _JOURNALS[journal_json] = (mtime, j)
+
+    return j
 
 
 class Journal:
@@ -71,3 +102,13 @@ class Journal:
             one of formats: "tiff",
         """
         return self.json['figures']['format']
+
+    def figure_compression(self):
+        """lossless compression of the tiff figures, if the journal accepts it
+
+        Returns
+        -------
+        str
+            one of "none", "lzw", "deflate"
+        """
+        return self.json['figures'].get('compression', 'none')
@@ -0,0 +1,141 @@
+"""Bibliography converted by prepare_bib, stored as one json entry per line
+(.jsonl) and an index with the position of each entry (.idx), so that only
+the cited entries are read.
+"""
+from json import dump, dumps, load, loads
+from pathlib import Path
+from os import replace
+from threading import Lock
+
+_LIBRARIES = {}
+_LIBRARIES_LOCK = Lock()
+
+
+class Library:
+    """Converted bibliography, where the entries are read only when needed.
+
+    Parameters
+    ----------
+    library_jsonl : path to file
+        .jsonl file written by prepare_bib (the index is in .idx)
+    """
+    def __init__(self, library_jsonl):
+        self.library_jsonl = Path(library_jsonl)
+
+        with self.library_jsonl.with_suffix('.idx').open() as f:
+            self.index = load(f)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def get_entries(self, keys):
+        """Read some entries from the library.
+
+        Parameters
+        ----------
+        keys : iterable of str
+            keys of the entries (they should all be in the library)
+
+        Returns
+        -------
+        dict
+            entries with the key as key, in the order of the library
+        """
+        return {key: loads(line.decode('utf-8'))
+                for key, line in self._read_lines(keys)}
+
+    def _read_lines(self, keys):
+        """Read the json lines of some entries, in the order of the library"""
+        positions = sorted((self.index[key], key) for key in set(keys))
+
+        with self.library_jsonl.open('rb') as f:
+            for (offset, length), key in positions:
+                f.seek(offset)
+                yield key, f.read(length)
+
+
+def get_library(library_jsonl):
+    """Return the library, reading the index only if the library changed since
+    the last call.
+
+    Parameters
+    ----------
+    library_jsonl : path to file
+        .jsonl file written by prepare_bib
+
+    Returns
+    -------
+    instance of Library
+        converted bibliography
+    """
+    library_jsonl = Path(library_jsonl).resolve()
+    mtime = library_jsonl.with_suffix('.idx').stat().st_mtime
+
+    with _LIBRARIES_LOCK:
+        lib_mtime, lib = _LIBRARIES.get(library_jsonl, (None, None))
+        if lib_mtime != mtime:
+            lib = Library(library_jsonl)
+            _LIBRARIES[library_jsonl] = (mtime, lib)
+
+    return lib
+
+
+def write_subset(library, keys, subset_jsonl):
+    """Write a library with only some entries (in the same format).
+
+    Parameters
+    ----------
+    library : instance of Library
+        complete library
+    keys : iterable of str
+        keys of the entries to keep
+    subset_jsonl : path to file
+        .jsonl file to write (the index is written to .idx)
+
+    Notes
+    -----
+    The files are not written if they would not change, so that their
+    modification time stays the same.
+    """
+    lines = []
+    index = {}
+    offset = 0
+    for key, line in library._read_lines(keys):
+        lines.append(line)
+        index[key] = [offset, len(line)]
+        offset += len(line)
+    content = b''.join(lines)
+
+    index_file = subset_jsonl.with_suffix('.idx')
+    if (subset_jsonl.exists() and index_file.exists() and
+            subset_jsonl.read_bytes() == content and
+            index_file.read_text() == dumps(index, separators=(',', ':'))):
+        return
+
+    tmp_file = subset_jsonl.with_suffix('.jsonl.tmp')
+    tmp_file.write_bytes(content)
+    replace(str(tmp_file), str(subset_jsonl))
+    write_index(index_file, index)
+
+
+def write_index(index_file, index):
+    """Write the position of each entry in the .jsonl file
+
+    Parameters
+    ----------
+    index_file : path to file
+        .idx file to write
+    index : dict
+        key is the key of the entry, value is a list with offset and length
+        in bytes
+    """
+    tmp_file = index_file.with_suffix('.idx.tmp')
+    with tmp_file.open('w') as f:
+        dump(index, f, separators=(',', ':'))
+    replace(str(tmp_file), str(index_file))
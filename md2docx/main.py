@@ -1,20 +1,16 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
-from os import getcwd
+from os import cpu_count, getcwd
 from pathlib import Path
-from shutil import rmtree
-from subprocess import run
-try:
-    from PIL import Image
-except ImportError:
-    Image = None
-
-from .prepare_md import preproc_md
-from .prepare_docx import convert_to_docx
+from sys import exit
+
+from .batch import build_all, read_batch_file
+from .build import build, build_journals
+from .timing import enable, stage, write_python_profile, write_trace
 from .prepare_bib import fix_biblio
-from .prepare_pdf import convert_to_pdf
 from .journal import Journal
+from .watch import watch
 from .utils import (bib_dir,
                     journals_dir,
                     ref_dir,
@@ -37,38 +33,136 @@ def main():
     """
     parser = ArgumentParser(prog='md2docx',
                             description='Convert Markdown to Office DOCX')
-    parser.add_argument('-j', '--journal', required=True,
-                        help='journal name (' + ', '.join(JOURNALS) + ')')
+    parser.add_argument('-j', '--journal', required=True, nargs='+',
+                        help='journal names (' + ', '.join(JOURNALS) + '). With more than one journal, the outputs of each journal are in output/JOURNAL/')
     parser.add_argument('--journal_json',
                         help='specify full path to custom journal .json file')
     parser.add_argument('--library', default=str(orig_bib_file),
                         help='bib library to use (default: %(default)s)')
     parser.add_argument('--csl',
                         help='path to csl file (default depends on journal)')
+    _add_options(parser)
+    parser.add_argument('--only_md', action='store_true',
+                        help='prepare only the intermediate md (for debugging)')
+    parser.add_argument('--only_docx', action='store_true',
+                        help='prepare only the docx from the intermediate md in tmp/, which must be written by a previous run with --only_md or --debug (for debugging)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and build again (incrementally) when the sources change')
+
+    args = parser.parse_args()
+    if len(args.journal) > 1:
+        unknown = set(args.journal) - set(JOURNALS)
+        if unknown:
+            parser.error('unknown journals: ' + ', '.join(sorted(unknown)))
+        if args.journal_json or args.csl or args.watch:
+            parser.error('--journal_json, --csl and --watch work with one '
+                         'journal only')
+    else:
+        args.journal = args.journal[0]
+
+    _run_profiled(_main, args)
+
+
+def batch():
+    parser = ArgumentParser(prog='md2docx_batch',
+                            description='Convert the Markdown of many articles, for one or more journals')
+    parser.add_argument('articles', nargs='*',
+                        help='directories of the articles')
+    parser.add_argument('-j', '--journal', nargs='+', default=[],
+                        help='journal names (' + ', '.join(JOURNALS) + ')')
+    parser.add_argument('--batch_file',
+                        help='json file with the articles and their journals (see md2docx.batch.read_batch_file)')
+    parser.add_argument('--library', default=str(orig_bib_file),
+                        help='bib library to use (default: %(default)s)')
+    _add_options(parser)
+    parser.set_defaults(journal_json=None, csl=None, only_md=False,
+                        only_docx=False)
+
+    args = parser.parse_args()
+    if args.articles and not args.journal:
+        parser.error('specify the journals of the articles with -j')
+
+    jobs = [(Path(x).resolve(), j) for x in args.articles for j in args.journal]
+    if args.batch_file:
+        jobs.extend(read_batch_file(args.batch_file, args.journal))
+    if not jobs:
+        parser.error('specify the articles or --batch_file')
+    unknown = {x[1] for x in jobs} - set(JOURNALS)
+    if unknown:
+        parser.error('unknown journals: ' + ', '.join(sorted(unknown)))
+
+    # the paths are relative to the current directory, not to the articles
+    for name in ('ref_docx', 'acronyms'):
+        setattr(args, name, Path(getattr(args, name)).resolve())
+
+    failed = _run_profiled(
+        lambda args: build_all(jobs, Path(args.library).resolve(), args), args)
+    if failed:
+        exit(1)
+
+
+def _add_options(parser):
+    """Options which are the same for md2docx and md2docx_batch"""
     parser.add_argument('--ref_docx', default=REF_DOCX,
                         help='path to docx used as reference (default: %(default)s)')
     parser.add_argument('--node_path',
                         help='path to directory containing node (if not on PATH already)')
     parser.add_argument('--inkscape_path',
                         help='path to directory containing inkscape (if not on PATH already)')
+    parser.add_argument('--libreoffice_path',
+                        help='path to directory containing libreoffice (if not on PATH already)')
     parser.add_argument('--acronyms', default=str(var_dir / 'acronyms.txt'),
                         help='acronyms to use (default: %(default)s)')
     parser.add_argument('--embed', action='store_true',
                         help='will embed png in the docx')
     parser.add_argument('--keep_png', action='store_true',
                         help='do not convert png to tiff, even if it is required by the journal')
+    parser.add_argument('--fast_docx', action='store_true',
+                        help='write the docx directly, without python-docx (faster for long documents)')
+    parser.add_argument('--tiff_compression', choices=('none', 'lzw', 'deflate'),
+                        help='lossless compression of the tiff figures (default depends on journal)')
     parser.add_argument('--pdf', action='store_true',
                         help='convert to PDF as well (you need libreoffice installed)')
     parser.add_argument('--skip_inkscape', action='store_true',
                         help='do not convert svg with inkscape')
-    parser.add_argument('--only_md', action='store_true',
-                        help='prepare only the intermediate md (for debugging)')
-    parser.add_argument('--only_docx', action='store_true',
-                        help='prepare only the docx from the already existing intermediate md (for debugging)')
-
-    args = parser.parse_args()
+    parser.add_argument('--inkscape_shell', action='store_true',
+                        help='send all the figures to inkscape in shell mode, instead of starting inkscape for each figure')
+    parser.add_argument('--debug', action='store_true',
+                        help='write the input and output of citeproc to tmp/ (for debugging)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep tmp/ and run only the steps whose inputs changed since the last run')
+    parser.add_argument('--jobs', type=int, default=cpu_count(),
+                        help='number of steps and of figures to convert in parallel (default: %(default)s)')
+    parser.add_argument('--profile',
+                        help='write the time of each stage to this json file (Chrome trace format)')
+    parser.add_argument('--profile_python',
+                        help='write the cProfile statistics of the python code to this file')
+
+
+def _run_profiled(func, args):
+    """Run func(args), recording the stages with --profile"""
+    if args.profile or args.profile_python:
+        enable(python=args.profile_python is not None)
+    try:
+        return func(args)
+    finally:
+        if args.profile:
+            write_trace(args.profile)
+        if args.profile_python:
+            write_python_profile(args.profile_python)
+
+
+def _main(args):
+    """Convert the article in the current directory (or watch it)"""
+    article_dir = Path(getcwd())
+    bib_file = Path(args.library).resolve()
 
-    MD_FILES = ('main.md', 'review.md', 'editor.md')
+    if isinstance(args.journal, list):
+        with stage('prepare_bib'):
+            args.library = fix_biblio(bib_file, args.jobs)
+        with stage('build'):
+            build_journals(article_dir, args)
+        return
 
     if not args.journal_json:
         args.journal_json = journals_dir / (args.journal + '.json')
@@ -77,42 +171,15 @@ def main():
     if not args.csl:
         args.csl = csl_dir / j.csl
 
-    article_dir = Path(getcwd())
-    out_dir = article_dir / 'output'
-    out_dir.mkdir(exist_ok=True)
-
-    args.library = fix_biblio(Path(args.library).resolve())
-
-    # copy files
-    tmp_dir = article_dir / 'tmp'
-
-    if not args.only_docx:
-        # remove tmp directory if we run prepare_md again
-        try:
-            rmtree(str(tmp_dir))
-        except OSError:
-            pass
-        tmp_dir.mkdir()
-
-        for md_file in MD_FILES:
-            preproc_md(article_dir, tmp_dir, md_file, args)
-
-    if not args.only_md:
-        for md_file in MD_FILES:
-            convert_to_docx(out_dir, tmp_dir, md_file, args)
-            if args.pdf:
-                convert_to_pdf(out_dir, md_file)
+    if args.watch:
+        watch(article_dir, bib_file, args)
+        return
 
-    # convert to tiff if necessary
-    if j.figure_format() == 'tiff' and not args.keep_png:
-        if Image is None:
-            raise ImportError('cannot convert png to tiff, install Pillow')
+    with stage('prepare_bib'):
+        args.library = fix_biblio(bib_file, args.jobs)
 
-        for one_png in out_dir.glob('*.png'):
-            one_tiff = one_png.with_suffix('.tiff')
-            img = Image.open(str(one_png))
-            img.save(str(one_tiff))  # uncompressed TIFF
-            one_png.unlink()
+    with stage('build'):
+        build(article_dir, args)
 
 
 def prepare_bib():
@@ -120,6 +187,8 @@ def prepare_bib():
                             description='Convert bibtex/mendeley to json library for citeproc.js')
     parser.add_argument('--library', default=str(orig_bib_file),
                         help='bib library to use (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=cpu_count(),
+                        help='number of processes to convert the entries (default: %(default)s)')
     args = parser.parse_args()
 
-    fix_biblio(Path(args.library))
+    fix_biblio(Path(args.library), args.jobs)
@@ -0,0 +1,172 @@
+"""Keep track of the inputs of each step of the conversion, so that the steps
+whose inputs did not change are not run again.
+"""
+from hashlib import sha256
+from json import dump, dumps, load
+from os import replace
+from pathlib import Path
+from threading import Lock
+
+MANIFEST_JSON = 'manifest.json'
+CHUNK_SIZE = 1 << 20
+
+_DIGESTS = {}
+_DIGESTS_LOCK = Lock()
+
+
+def hash_inputs(files=(), values=()):
+    """Compute one hash for the content of the files and the values.
+
+    Parameters
+    ----------
+    files : list of path to file
+        files to read (missing files are allowed)
+    values : list
+        any value that can be converted to json (such as command-line
+        arguments)
+
+    Returns
+    -------
+    str
+        sha256 in hexadecimal
+    """
+    h = sha256()
+    for one_file in files:
+        h.update(str(one_file).encode())
+        try:
+            h.update(file_digest(one_file))
+        except (FileNotFoundError, IsADirectoryError):
+            h.update(b'\0missing')
+    h.update(dumps(list(values), sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def file_digest(one_file):
+    """Hash of the content of one file, which is computed again only if the
+    file was modified.
+
+    Parameters
+    ----------
+    one_file : path to file
+        file to read
+
+    Returns
+    -------
+    bytes
+        sha256 of the content of the file
+
+    Notes
+    -----
+    The hash is kept in memory, with the modification time and the size of the
+    file, so that large files (such as the library, which is an input of each
+    step of each article) are read only once per process.
+    """
+    one_file = Path(one_file)
+    st = one_file.stat()
+    key = (str(one_file.resolve()), st.st_mtime_ns, st.st_size)
+    with _DIGESTS_LOCK:
+        digest = _DIGESTS.get(key)
+    if digest is not None:
+        return digest
+
+    h = sha256()
+    with one_file.open('rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    digest = h.digest()
+    with _DIGESTS_LOCK:
+        _DIGESTS[key] = digest
+    return digest
+
+
+class Manifest:
+    """Hash of the inputs of each step, stored in tmp_dir/manifest.json
+
+    Parameters
+    ----------
+    tmp_dir : path to dir
+        directory with temporary files
+    incremental : bool
+        if False, ignore the steps which were completed in previous runs (but
+        store the new steps anyway)
+    """
+    def __init__(self, tmp_dir, incremental=True):
+        self.manifest_json = tmp_dir / MANIFEST_JSON
+        self.lock = Lock()
+
+        self.steps = {}
+        if incremental:
+            try:
+                with self.manifest_json.open() as f:
+                    self.steps = load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def get(self, name):
+        with self.lock:
+            return self.steps.get(name, {})
+
+    def update(self, name, key, result=None):
+        """Store the hash of the inputs of a step, which was completed"""
+        with self.lock:
+            self.steps[name] = {'key': key, 'result': result}
+
+            tmp_json = self.manifest_json.with_suffix('.tmp')
+            with tmp_json.open('w') as f:
+                dump(self.steps, f, indent=2, sort_keys=True)
+            replace(str(tmp_json), str(self.manifest_json))
+
+
+class Step:
+    """Inputs and outputs of one step of the conversion.
+
+    Parameters
+    ----------
+    manifest : instance of Manifest
+        where the steps are stored
+    name : str
+        unique name of the step
+    inputs : function
+        function returning the list of files which the step reads. It's
+        called only when the step is about to run, so it can include files
+        created by previous steps.
+    outputs : list of path to file
+        files which the step writes
+    values : list
+        other values which change the output (such as command-line arguments)
+
+    Attributes
+    ----------
+    result
+        value returned by the step, also when the step was not run again
+    """
+    def __init__(self, manifest, name, inputs, outputs=(), values=()):
+        self.manifest = manifest
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.values = values
+
+        self.key = None
+        self.current = None
+        self.result = None
+
+    def is_current(self):
+        """Check if the step can be skipped, because the inputs did not change
+        and all the outputs exist. Only the first call computes the hash of
+        the inputs, the next calls return the same value."""
+        if self.current is None:
+            self.key = hash_inputs(self.inputs(), self.values)
+            previous = self.manifest.get(self.name)
+            self.current = (previous.get('key') == self.key and
+                            all(x.exists() for x in self.outputs))
+            if self.current:
+                self.result = previous.get('result')
+
+        return self.current
+
+    def record(self):
+        """Store that the step was completed"""
+        if self.key is None:
+            self.key = hash_inputs(self.inputs(), self.values)
+        self.manifest.update(self.name, self.key, self.result)
@@ -0,0 +1,455 @@
+"""Write the docx directly as OOXML, without python-docx.
+
+python-docx creates proxy objects and lxml elements for each paragraph, run
+and table cell, which is slow for long documents with large tables. Here the
+xml of each block is written as text and word/document.xml is streamed into
+the zip file, while all the other parts (styles, numbering, theme, settings)
+are copied from the reference docx. The output is semantically equal to the
+output of python-docx (the same elements, attributes, relationships and
+media, see benchmarks/bench_docx.compare_docx), but the files are not
+identical: the xml is formatted differently and the zip has different
+timestamps.
+"""
+from hashlib import sha1
+from posixpath import dirname, join, normpath
+from pathlib import Path
+from re import compile
+from threading import Lock
+from xml.sax.saxutils import escape, quoteattr
+from time import localtime
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+from lxml.etree import Comment, Element, SubElement, fromstring, tostring
+
+from .images import ImageFile
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+R = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_RELS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+CONTENT_TYPES = 'http://schemas.openxmlformats.org/package/2006/content-types'
+RT_IMAGE = R + '/image'
+
+EMUS_PER_TWIP = 635
+MEDIA_NAME = compile(r'word/media/image(\d+)\.')
+
+# page of Word when the reference docx does not specify it (letter, with
+# margins of 1 inch), in twips
+DEFAULT_PAGE_WIDTH = 12240
+DEFAULT_MARGIN = 1440
+
+# names of the styles in the user interface and in styles.xml, when they are
+# different (as in python-docx)
+STYLE_NAMES = {
+    'Caption': 'caption',
+    'Footer': 'footer',
+    'Header': 'header',
+    }
+STYLE_NAMES.update(('Heading ' + str(i), 'heading ' + str(i))
+                   for i in range(1, 10))
+
+TABLE_PROPERTIES = (
+    '<w:tblPr><w:tblW w:type="auto" w:w="0"/><w:tblLayout w:type="autofit"/>'
+    '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" '
+    'w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>')
+PAGE_BREAK = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+# declared on the root of word/document.xml, when the reference docx does not
+# declare them
+PICTURE_NAMESPACES = {
+    'wp': 'http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing',
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+    'pic': 'http://schemas.openxmlformats.org/drawingml/2006/picture',
+    'r': R,
+    }
+PICTURE = (
+    '<w:p><w:r><w:drawing><wp:inline>'
+    '<wp:extent cx="{cx}" cy="{cy}"/>'
+    '<wp:docPr id="{id}" name="Picture {id}"/>'
+    '<wp:cNvGraphicFramePr><a:graphicFrameLocks noChangeAspect="1"/>'
+    '</wp:cNvGraphicFramePr>'
+    '<a:graphic><a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:pic><pic:nvPicPr><pic:cNvPr id="0" name={name}/><pic:cNvPicPr/>'
+    '</pic:nvPicPr>'
+    '<pic:blipFill><a:blip r:embed="{rId}"/><a:stretch><a:fillRect/>'
+    '</a:stretch></pic:blipFill>'
+    '<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="{cx}" cy="{cy}"/>'
+    '</a:xfrm><a:prstGeom prst="rect"/></pic:spPr>'
+    '</pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing></w:r></w:p>')
+
+_TEMPLATES = {}
+_TEMPLATES_LOCK = Lock()
+
+
+class Template:
+    """Parts of the reference docx which are needed to write a new docx. They
+    are only read when writing, so the same template is used for all the
+    documents.
+
+    Parameters
+    ----------
+    ref_docx : path to file
+        docx used as reference (for the styles and the page layout)
+    """
+    def __init__(self, ref_docx):
+        with ZipFile(str(ref_docx)) as z:
+            names = set(z.namelist())
+            # only the parts which are related to the document (as python-docx)
+            self.parts = {}
+            to_read = ['_rels/.rels', ]
+            while to_read:
+                name = to_read.pop()
+                if name in self.parts or name not in names:
+                    continue
+                self.parts[name] = z.read(name)
+                if name.endswith('.rels'):
+                    rels = fromstring(self.parts[name])
+                    if len(rels) == 0:  # empty relationships are not written
+                        del self.parts[name]
+                    to_read.extend(_rels_targets(name, rels))
+                else:
+                    to_read.append(_rels_name(name))
+
+            self.content_types = fromstring(z.read('[Content_Types].xml'))
+
+        for override in self.content_types.findall('{%s}Override' % CONTENT_TYPES):
+            if override.get('PartName').lstrip('/') not in self.parts:
+                self.content_types.remove(override)
+
+        self.document_name = _main_document(self.parts['_rels/.rels'])
+        self.rels_name = _rels_name(self.document_name)
+        self._read_document(self.parts.pop(self.document_name))
+        self._read_styles()
+
+        self.rels = fromstring(self.parts.pop(self.rels_name,
+                                              b'<Relationships xmlns="' +
+                                              PKG_RELS.encode() + b'"/>'))
+
+        self.media_numbers = {int(m.group(1)) for m in map(MEDIA_NAME.match,
+                                                           self.parts) if m}
+
+    def _read_document(self, document_xml):
+        """Split word/document.xml where the new body starts and ends.
+
+        The new body goes after the content of the reference docx and before
+        the properties of the last section (sectPr), which must be the last
+        element of the body. If the reference docx has no sectPr (or its
+        sectPr has no page size or margins), the width of the text is computed
+        from the default page of Word.
+
+        Raises
+        ------
+        ValueError
+            if word/document.xml has no body
+        """
+        root = fromstring(document_xml)
+        missing = {k: v for k, v in PICTURE_NAMESPACES.items()
+                   if k not in root.nsmap}
+        if missing:
+            nsmap = dict(root.nsmap)
+            nsmap.update(missing)
+            new_root = Element(root.tag, dict(root.attrib), nsmap=nsmap)
+            new_root.extend(root)
+            root = new_root
+
+        body = root.find('{%s}body' % W)
+        if body is None:
+            raise ValueError('no body in ' + self.document_name)
+        sect_pr = body.find('{%s}sectPr' % W)
+        body.append(Comment('md2docx'))
+        if sect_pr is not None:
+            body.append(sect_pr)  # moves it after the comment
+
+        self.document_head, self.document_tail = tostring(
+            root, encoding='UTF-8', xml_declaration=True,
+            standalone=True).split(b'<!--md2docx-->')
+
+        # width of the text, to distribute among the columns of the tables
+        page_width = DEFAULT_PAGE_WIDTH
+        left = right = DEFAULT_MARGIN
+        if sect_pr is not None:
+            page_size = sect_pr.find('{%s}pgSz' % W)
+            if page_size is not None:
+                page_width = int(page_size.get('{%s}w' % W, page_width))
+            page_margin = sect_pr.find('{%s}pgMar' % W)
+            if page_margin is not None:
+                left = int(page_margin.get('{%s}left' % W, left))
+                right = int(page_margin.get('{%s}right' % W, right))
+        self.block_width = EMUS_PER_TWIP * (page_width - left - right)
+
+        ids = [int(x) for x in root.xpath('//@id') if x.isdigit()]
+        self.next_id = max(ids) + 1 if ids else 1
+
+    def _read_styles(self):
+        """Name, type and id of each style"""
+        self.styles = {}
+        self.default_styles = {}
+        styles_name = join(dirname(self.document_name), 'styles.xml')
+        if styles_name not in self.parts:
+            return
+
+        for style in fromstring(self.parts[styles_name]).iterfind('{%s}style' % W):
+            style_type = style.get('{%s}type' % W, 'paragraph')
+            style_id = style.get('{%s}styleId' % W)
+            name = style.find('{%s}name' % W)
+            if name is not None:
+                self.styles.setdefault(name.get('{%s}val' % W),
+                                       (style_type, style_id))
+            if style.get('{%s}default' % W) in ('1', 'true', 'on'):
+                self.default_styles[style_type] = style_id
+
+    def paragraph_style(self, style):
+        """Id of the paragraph style (None for the default style)"""
+        if style is None:
+            return None
+        try:
+            style_type, style_id = self.styles[STYLE_NAMES.get(style, style)]
+        except KeyError:
+            raise KeyError("no style with name '" + style + "'")
+        if style_type != 'paragraph':
+            raise ValueError('style "' + style + '" is not a paragraph style')
+        if self.default_styles.get(style_type) == style_id:
+            return None
+        return style_id
+
+
+class OoxmlWriter:
+    """Write the docx directly as xml, with the same interface as DocxWriter.
+
+    Parameters
+    ----------
+    ref_docx : path to file
+        docx used as reference (for the styles and the page layout)
+    """
+    def __init__(self, ref_docx):
+        self.template = get_template(ref_docx)
+        # paragraphs and tables are lists of xml, because text can be added to
+        # them after the following blocks have been written
+        self.body = []
+        self.next_id = self.template.next_id
+        self.rel_ids = {x.get('Id') for x in self.template.rels}
+        self.media = {}  # key is sha1 of the image, value is rId, partname, image
+        self.media_numbers = set(self.template.media_numbers)
+
+    def page_break(self):
+        self.body.append(PAGE_BREAK)
+
+    def heading(self, text, level):
+        style = 'Title' if level == 0 else 'Heading ' + str(level)
+        self.body.append(_paragraph_xml(self.template.paragraph_style(style)) +
+                         (_run_xml(text) if text else '') + '</w:p>')
+
+    def picture(self, path):
+        rId, image = self._add_image(ImageFile(path))
+        self.body.append(PICTURE.format(cx=image.cx, cy=image.cy,
+                                        id=self.next_id,
+                                        name=quoteattr(image.filename),
+                                        rId=rId))
+        self.next_id += 1
+
+    def table(self, header):
+        n_col = len(header)
+        width = self.template.block_width // n_col
+        twips = int(round(width / EMUS_PER_TWIP))
+        table = _Table([
+            '<w:tbl>', TABLE_PROPERTIES, '<w:tblGrid>',
+            '<w:gridCol w:w="{}"/>'.format(twips) * n_col, '</w:tblGrid>'])
+        table.cell = ('<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{}"/></w:tcPr>'
+                      .format(twips))
+        table.n_col = n_col
+        self._row(table, [_run_xml(txt, bold=True) for txt in header])
+        self.body.append(table)
+        return table
+
+    def row(self, table, row):
+        self._row(table, [_run_xml(txt) for txt in row])
+
+    def paragraph(self, style):
+        p = [_paragraph_xml(self.template.paragraph_style(style)), ]
+        self.body.append(p)
+        return p
+
+    def runs(self, p, runs):
+        p.extend(_run_xml(run.text, run.bold, run.italic, run.superscript,
+                          run.subscript, run.line_break) for run in runs)
+
+    def save(self, docx_path):
+        template = self.template
+        rels = fromstring(tostring(template.rels))
+        content_types = fromstring(tostring(template.content_types))
+        defaults = {x.get('Extension').lower() for x in content_types.findall(
+            '{%s}Default' % CONTENT_TYPES)}
+
+        for rId, partname, image in self.media.values():
+            SubElement(rels, '{%s}Relationship' % PKG_RELS, Id=rId,
+                       Type=RT_IMAGE, Target=_relative(partname,
+                                                       template.document_name))
+            if image.ext.lower() not in defaults:
+                defaults.add(image.ext.lower())
+                SubElement(content_types, '{%s}Default' % CONTENT_TYPES,
+                           Extension=image.ext, ContentType=image.content_type)
+
+        with ZipFile(str(docx_path), 'w', ZIP_DEFLATED) as z:
+            z.writestr('[Content_Types].xml', _to_xml(content_types))
+            for name, part in template.parts.items():
+                z.writestr(name, part)
+            z.writestr(template.rels_name, _to_xml(rels))
+            for rId, partname, image in self.media.values():
+                z.writestr(partname, image.blob)
+
+            info = ZipInfo(template.document_name, localtime()[:6])
+            info.compress_type = ZIP_DEFLATED
+            with z.open(info, 'w') as f:
+                f.write(template.document_head)
+                for block in self.body:
+                    if isinstance(block, _Table):
+                        f.write((''.join(block) + '</w:tbl>').encode('utf-8'))
+                    elif isinstance(block, list):
+                        f.write((''.join(block) + '</w:p>').encode('utf-8'))
+                    else:
+                        f.write(block.encode('utf-8'))
+                f.write(template.document_tail)
+
+    def _row(self, table, cells):
+        """Add a row to the table (the empty cells have an empty paragraph)"""
+        cells = cells[:table.n_col]
+        table.append('<w:tr>' + ''.join(
+            table.cell + '<w:p>' + x + '</w:p></w:tc>' for x in cells) +
+            (table.cell + '<w:p/></w:tc>') * (table.n_col - len(cells)) +
+            '</w:tr>')
+
+    def _add_image(self, image):
+        """Add the image to the package (only once, as python-docx) and return
+        the id of its relationship and the image which was added first (its
+        name is used for all the copies, as python-docx)"""
+        key = sha1(image.blob).hexdigest()
+        if key not in self.media:
+            n = 1
+            while n in self.media_numbers:
+                n += 1
+            self.media_numbers.add(n)
+
+            n_rel = 1
+            while 'rId' + str(n_rel) in self.rel_ids:
+                n_rel += 1
+            rId = 'rId' + str(n_rel)
+            self.rel_ids.add(rId)
+
+            self.media[key] = (rId, 'word/media/image{}.{}'.format(n, image.ext),
+                               image)
+
+        rId, partname, image = self.media[key]
+        return rId, image
+
+
+def get_template(ref_docx):
+    """Return the template for this reference docx, reading it only if it
+    changed since the last call.
+
+    Parameters
+    ----------
+    ref_docx : path to file
+        docx used as reference
+
+    Returns
+    -------
+    instance of Template
+        parts of the reference docx (shared, do not modify them)
+    """
+    ref_docx = Path(ref_docx).resolve()
+    mtime = ref_docx.stat().st_mtime
+
+    with _TEMPLATES_LOCK:
+        t_mtime, template = _TEMPLATES.get(ref_docx, (None, None))
+        if t_mtime != mtime:
+            template = Template(ref_docx)
+            _TEMPLATES[ref_docx] = (mtime, template)
+
+    return template
+
+
+class _Table(list):
+    """xml of a table, where the rows are added one by one. It also has the
+    xml of the start of each cell and the number of columns."""
+
+
+def _paragraph_xml(style_id):
+    if style_id is None:
+        return '<w:p>'
+    return '<w:p><w:pPr><w:pStyle w:val=' + quoteattr(style_id) + '/></w:pPr>'
+
+
+def _run_xml(text, bold=False, italic=False, superscript=False,
+             subscript=False, line_break=False):
+    """xml of one run, where tabs and new lines are converted as in
+    python-docx"""
+    xml = ['<w:r>', ]
+    if bold or italic or superscript or subscript:
+        xml.append('<w:rPr>')
+        if bold:
+            xml.append('<w:b/>')
+        if italic:
+            xml.append('<w:i/>')
+        if subscript:
+            xml.append('<w:vertAlign w:val="subscript"/>')
+        elif superscript:
+            xml.append('<w:vertAlign w:val="superscript"/>')
+        xml.append('</w:rPr>')
+
+    if text:
+        for i, tabs in enumerate(text.replace('\r', '\n').split('\n')):
+            if i > 0:
+                xml.append('<w:br/>')
+            for j, one_text in enumerate(tabs.split('\t')):
+                if j > 0:
+                    xml.append('<w:tab/>')
+                if one_text:
+                    xml.append(_text_xml(one_text))
+
+    if line_break:
+        xml.append('<w:br/>')
+    xml.append('</w:r>')
+    return ''.join(xml)
+
+
+def _text_xml(text):
+    if len(text.strip()) < len(text):
+        return '<w:t xml:space="preserve">' + escape(text) + '</w:t>'
+    return '<w:t>' + escape(text) + '</w:t>'
+
+
+def _to_xml(root):
+    return tostring(root, encoding='UTF-8', xml_declaration=True,
+                    standalone=True)
+
+
+def _relative(name, source):
+    """Target of a relationship from the source part to a part"""
+    base = dirname(source)
+    if base:
+        return name[len(base) + 1:]
+    return name
+
+
+def _rels_name(name):
+    """Name of the part with the relationships of a part"""
+    return join(dirname(name), '_rels', name.split('/')[-1] + '.rels')
+
+
+def _rels_targets(rels_name, rels):
+    """Names of the parts related to a part (only the internal ones)"""
+    base = dirname(dirname(rels_name))
+    targets = []
+    for rel in rels:
+        if rel.get('TargetMode') == 'External':
+            continue
+        target = rel.get('Target')
+        if target.startswith('/'):
+            targets.append(normpath(target).lstrip('/'))
+        else:
+            targets.append(normpath(join(base, target)).lstrip('/'))
+    return targets
+
+
+def _main_document(package_rels):
+    for rel in fromstring(package_rels):
+        if rel.get('Type') == R + '/officeDocument':
+            return normpath(rel.get('Target')).lstrip('/')
@@ -0,0 +1,35 @@
+"""Regular expressions used to convert the markdown files, compiled only once
+when the package is imported.
+"""
+from re import compile
+
+CITATION_SEPARATOR = '; '  # this is how references are separated in md ',; '
+
+# prepare_bib
+ENTRY_START = compile(r'@([a-z]+){([\w]*),')
+BIB_FIELD = compile(r'\n([a-z]*) = {(.*)}')
+
+# prepare_md: sections
+SECTION = compile(r'\n## ([\w ]+)\n')
+WHITESPACE = compile(r'\s+')
+
+# prepare_md: figures and tables
+FIGURE_LINK = compile(r'### Figure (\[\+[\w]*\])')
+FIGURE_INDEX = compile(r'### Fig(ure|\.) (\[\+(\w+)\])')
+TABLE_INDEX = compile(r'### Table (\[\+\w+\])')
+LABEL = compile(r'\[\+\w+\]')
+
+# prepare_md: citations, acronyms and references
+CITATION = compile(r'(\[?@[@\w+0-9' + CITATION_SEPARATOR + r']+\]?)')
+CITATION_ITEM = compile(r'[' + CITATION_SEPARATOR + ']+')
+ACRONYM = compile(r'\[\$([a-zA-Z]+)\]')
+REFERENCE_DIV = compile(r'<div class="[\w-]+">')
+
+# prepare_md: cross-references between main and review
+CROSSREF = compile(r'@\[[0-9a-z.]+\]')
+ITALICS = compile(r'\*(.+?)\*')
+BOLD = compile(r'(?<!\\)%')
+
+# prepare_docx
+RUN_FORMAT = compile(r'(?<!\\)([%|\*|_|\^|~])')
+ESCAPED_FORMAT = compile(r'\\([%~\*\^])')
@@ -1,8 +1,18 @@
-from json import dump
-from re import split, findall
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from hashlib import sha1
+from itertools import chain, islice
+from json import dumps
+from multiprocessing import get_context
+from os import replace
+from re import compile, escape
 
 import latexcodec  # it's necessary to import it here
 
+from .patterns import BIB_FIELD, ENTRY_START
+from .utils import report
+
 
 TYPES = {'article': "article-journal",
          'book': 'book',
@@ -47,54 +57,335 @@ LATEX_SYMBOLS = {'$\\alpha$': 'α',
                  '$\\zeta$': 'ζ',
                  }
 
+# increase it when fix_entry changes, so that the cache is not used
+CACHE_VERSION = 3
+# number of entries sent at once to the process pool (libraries with fewer
+# entries are converted without the process pool)
+BLOCK_SIZE = 200
+
+LATEX_PATTERN = compile('|'.join(escape(x) for x in LATEX_SYMBOLS))
+
 
-def fix_biblio(biblio_orig):
+def fix_biblio(biblio_orig, jobs=1):
     """fix bibliography by keeping only useful fields.
 
     Parameters
     ----------
     orig_bib_file : path to .bib file
         directory with optional information
+    jobs : int
+        number of processes to convert the entries
 
     Returns
     -------
     path to file
-        bib file with a simpler structure.
+        bib file with a simpler structure (.jsonl, with the index in .idx).
     """
-    biblio = biblio_orig.with_suffix('.json')
+    biblio = biblio_orig.with_suffix('.jsonl')
+    index = biblio.with_suffix('.idx')
 
-    if not biblio.exists() or biblio_orig.stat().st_mtime > biblio.stat().st_mtime:
-        prepare_bib(biblio_orig, biblio)
+    if (not biblio.exists() or not index.exists() or
+            biblio_orig.stat().st_mtime > biblio.stat().st_mtime):
+        prepare_bib(biblio_orig, biblio, jobs)
 
     return biblio
 
 
-def prepare_bib(old_bib, new_bib):
-    with old_bib.open(errors='ignore') as f:
-        bib_orig = f.read()
+def prepare_bib(old_bib, new_bib, jobs=1):
+    """Convert the bib file to json, one entry at a time.
 
-    for latex_name, symbol in LATEX_SYMBOLS.items():
-        bib_orig = bib_orig.replace(latex_name, symbol)
-
-    keys = findall('@([a-z]+){([\w]*),', bib_orig)
-    entries = split('@[a-z]+{[\w]*,', bib_orig)[1:]  # the first one is the autogenerated script by Mendeley
+    Parameters
+    ----------
+    old_bib : path to file
+        .bib file (exported from mendeley)
+    new_bib : path to file
+        .jsonl file to write (the index is written to .idx)
+    jobs : int
+        number of processes to convert the entries (if larger than 1 and the
+        library has more than BLOCK_SIZE entries, the entries which are not in
+        the cache are converted in blocks in a process pool, but the output is
+        the same)
+
+    Notes
+    -----
+    Neither the .bib file nor the .jsonl file are ever fully in memory. The
+    .jsonl file contains one entry per line and the .idx file contains the
+    position of each entry in the .jsonl file, so that only the cited entries
+    need to be read (see md2docx.library). If the same key is used twice,
+    only the first entry is kept.
+
+    The files are written to temporary files first, so that they are not
+    incomplete if the conversion fails.
+
+    The cache (.cache, next to the json file) has the hash of the text of
+    each bibtex entry and the position of the converted entry in the previous
+    .jsonl file. Only the entries which were added or modified are converted
+    again, the others are copied from the previous .jsonl file one at a time.
+    The cache is not used if the previous .jsonl file is missing or it was
+    modified.
+
+    The index and the cache are written one entry at a time as well, so the
+    memory used depends on the number of entries (the keys, and the hashes
+    and positions of the cache) but never on their content.
+    """
+    tmp_bib = new_bib.with_suffix('.jsonl.tmp')
+    index_file = new_bib.with_suffix('.idx')
+    tmp_index = index_file.with_suffix('.idx.tmp')
+    cache_file = new_bib.with_suffix('.cache')
+    tmp_cache = cache_file.with_suffix('.cache.tmp')
+
+    cache = _read_cache(cache_file, new_bib)
+    n_entries = 0
+    n_converted = 0
+
+    offset = 0
+    with ExitStack() as stack:
+        f = stack.enter_context(old_bib.open(errors='ignore'))
+        f_jsonl = stack.enter_context(tmp_bib.open('wb'))
+        f_index = stack.enter_context(tmp_index.open('w'))
+        f_cache = stack.enter_context(tmp_cache.open('w'))
+        if cache:
+            f_previous = stack.enter_context(new_bib.open('rb'))
+
+        # the index is the same json as library.write_index, written one
+        # entry at a time
+        f_index.write('{')
+        f_cache.write(str(CACHE_VERSION) + '\n')
+        for entry_hash, key, j_entry in _convert_entries(
+                _unique_entries(f, old_bib), cache, jobs):
+
+            if j_entry is None:
+                position = cache[entry_hash]
+                f_previous.seek(position >> 32)
+                line = f_previous.read(position & 0xffffffff)
+            else:
+                n_converted += 1
+                line = (j_entry + '\n').encode('utf-8')
+
+            f_jsonl.write(line)
+            f_index.write((',' if n_entries else '') + dumps(key) +
+                          ':[{},{}]'.format(offset, len(line)))
+            f_cache.write('{} {} {}\n'.format(entry_hash.hex(), offset,
+                                               len(line)))
+            offset += len(line)
+            n_entries += 1
+        f_index.write('}')
+
+    replace(str(tmp_bib), str(new_bib))
+    replace(str(tmp_index), str(index_file))
+
+    # the last line of the cache identifies the .jsonl file it refers to
+    jsonl_stat = new_bib.stat()
+    with tmp_cache.open('a') as f_cache:
+        f_cache.write('jsonl {} {}\n'.format(jsonl_stat.st_size,
+                                             jsonl_stat.st_mtime_ns))
+    replace(str(tmp_cache), str(cache_file))
+
+    report('converted {} of {} entries in {}'.format(n_converted, n_entries,
+                                                      str(old_bib)))
+
+
+def _unique_entries(f, old_bib):
+    """Entries with the hash of their text, skipping duplicate keys"""
+    seen = set()
+    for key, entry in read_entries(f):
+        if key[1] in seen:
+            report('WARNING: duplicate key ' + key[1] + ' in ' + str(old_bib))
+            continue
+        seen.add(key[1])
+
+        entry_hash = sha1('\0'.join(key + (entry, )).encode()).digest()
+        yield entry_hash, key, entry
+
+
+def _convert_entries(entries, cache, jobs):
+    """Convert the entries which are not in the cache.
 
-    assert len(keys) == len(entries)
+    Parameters
+    ----------
+    entries : iterator of tuple
+        hash, key and text of each entry
+    cache : dict
+        hashes of the entries which are already converted
+    jobs : int
+        number of processes
+
+    Yields
+    ------
+    str
+        hash of the entry
+    str
+        key of the entry
+    str or None
+        converted entry as json (on one line) or None if it's in the cache
+
+    Notes
+    -----
+    The entries are yielded in the same order as they are read. With more than
+    one job, blocks of entries are sent to the process pool and at most
+    2 * jobs blocks are read in advance, so that memory stays bounded.
+
+    The entries are converted in this process if there is only one job or if
+    there are at most BLOCK_SIZE entries. Starting the pool (with spawn, so
+    each process imports md2docx) takes about 0.1-0.2 s, which is the time to
+    convert about 200 entries in one process, so the pool is faster only for
+    libraries with several hundred entries or more.
+    """
+    if jobs > 1:
+        blocks = _blocks(entries, BLOCK_SIZE)
+        first_blocks = list(islice(blocks, 2))
+        if len(first_blocks) > 1:
+            yield from _convert_in_pool(chain(first_blocks, blocks), cache,
+                                        jobs)
+            return
+        entries = chain.from_iterable(first_blocks)
+
+    for entry_hash, key, entry in entries:
+        if entry_hash in cache:
+            yield entry_hash, key[1], None
+        else:
+            yield entry_hash, key[1], dumps(fix_entry(key, entry),
+                                            separators=(',', ':'))
+
+
+def _convert_in_pool(blocks, cache, jobs):
+    """Convert the blocks of entries in a process pool, in the same order"""
+    pool = None
+    pending = deque()
+    try:
+        for block in blocks:
+            to_convert = [(key, entry) for entry_hash, key, entry in block
+                          if entry_hash not in cache]
+            if to_convert:
+                if pool is None:
+                    pool = ProcessPoolExecutor(jobs, mp_context=get_context('spawn'))
+                converted = pool.submit(_fix_entries, to_convert)
+            else:
+                converted = None
+            pending.append((block, converted))
+
+            if len(pending) >= 2 * jobs:
+                yield from _merge_block(*pending.popleft(), cache)
+
+        while pending:
+            yield from _merge_block(*pending.popleft(), cache)
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def _blocks(entries, block_size):
+    block = []
+    for one_entry in entries:
+        block.append(one_entry)
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def _fix_entries(to_convert):
+    """Convert a block of entries (it runs in the process pool)"""
+    return [dumps(fix_entry(key, entry), separators=(',', ':'))
+            for key, entry in to_convert]
+
+
+def _merge_block(block, converted, cache):
+    """Yield the entries of one block, taking the converted entries from the
+    process pool in the original order"""
+    converted = iter(converted.result() if converted is not None else ())
+    for entry_hash, key, entry in block:
+        if entry_hash in cache:
+            yield entry_hash, key[1], None
+        else:
+            yield entry_hash, key[1], next(converted)
+
+
+def _read_cache(cache_file, jsonl_file):
+    """Read the position of the converted entries in the previous .jsonl
+    file.
 
-    j_entries = {}
-    for key, entry in zip(keys, entries):
-        j_entries[key[1]] = fix_entry(key, entry)
+    Returns
+    -------
+    dict
+        key is the hash of the bibtex entry, value is the position and the
+        length of the converted entry in the .jsonl file (in one int, with the
+        position in the upper bits, because it takes less memory than a
+        tuple). Empty if there is no cache, if it was written by a different
+        version of fix_entry or if the .jsonl file is not the one written with
+        the cache.
+    """
+    cache = {}
+    try:
+        jsonl_stat = jsonl_file.stat()
+        with cache_file.open() as f:
+            if f.readline() != str(CACHE_VERSION) + '\n':
+                return {}
+            for line in f:
+                entry_hash, offset, length = line.split()
+                if entry_hash == 'jsonl':
+                    if (int(offset), int(length)) == (jsonl_stat.st_size,
+                                                      jsonl_stat.st_mtime_ns):
+                        return cache
+                    return {}
+                cache[bytes.fromhex(entry_hash)] = int(offset) << 32 | int(length)
+
+    except (FileNotFoundError, ValueError):
+        pass
+
+    return {}  # incomplete cache
+
+
+def read_entries(f):
+    """Read the entries of a bib file one by one
 
-    with new_bib.open('w') as f:
-        # dump(j_entries, f, separators=(',', ':'))
-        dump(j_entries, f, indent=2)
+    Parameters
+    ----------
+    f : file object
+        .bib file opened for reading
+
+    Yields
+    ------
+    tuple of str
+        type of the entry and key
+    str
+        text of the entry, after the key
+
+    Notes
+    -----
+    The text before the first entry is the autogenerated script by Mendeley,
+    so it's ignored.
+    """
+    key = None
+    lines = []
+    for line in f:
+        start = 0
+        if '@' in line:
+            for m in ENTRY_START.finditer(line):
+                if key is not None:
+                    lines.append(line[start:m.start()])
+                    yield key, ''.join(lines)
+                key = m.groups()
+                lines = []
+                start = m.end()
+
+        if key is not None:
+            lines.append(line[start:])
+
+    if key is not None:
+        yield key, ''.join(lines)
 
 
 def fix_entry(key, entry):
     j_entry = {'id': key[1],
                'type': TYPES[key[0]]}
 
-    for field, value in findall('\n([a-z]*) = {(.*)}', entry):
+    for field, value in BIB_FIELD.findall(entry):
+        if '$' in value:
+            value = LATEX_PATTERN.sub(lambda m: LATEX_SYMBOLS[m.group()], value)
+
         if field in ('author', 'editor'):
             author_keys = []
             for one_author in value.split(' and '):
@@ -1,40 +1,68 @@
+from copy import deepcopy
 from docx import Document
-from re import split, findall, sub
-
-from .journal import Journal
-
-
-def convert_to_docx(output_dir, tmp_dir, md_file, args):
-
-    md_path = tmp_dir / md_file
-    if not md_path.exists():
+from pathlib import Path
+from threading import Lock
+
+from .document import Blank, Heading, Image, Run, Table, parse_runs
+from .journal import get_journal
+from .ooxml import OoxmlWriter
+
+_DOCUMENTS = {}
+_DOCUMENTS_LOCK = Lock()
+
+
+def convert_to_docx(output_dir, doc, md_file, args):
+    """Write the manuscript to docx
+
+    Parameters
+    ----------
+    output_dir : path to dir
+        directory where to write the docx
+    doc : instance of Document
+        structure of the manuscript (None if the markdown file does not exist)
+    md_file : str
+        name of the markdown file
+    args : arguments
+        arguments to the function
+
+    Notes
+    -----
+    With --fast_docx, the xml is written directly (OoxmlWriter) instead of
+    using python-docx (DocxWriter). The two docx have the same content
+    (elements, styles and media) but they are not byte-identical.
+    """
+    if doc is None:
         return
 
-    j = Journal(args.journal_json)
+    j = get_journal(args.journal_json)
 
-    document = Document(str(args.ref_docx))
+    if args.fast_docx:
+        document = OoxmlWriter(args.ref_docx)
+    else:
+        document = DocxWriter(args.ref_docx)
 
-    docx_path = output_dir / md_path.with_suffix('.docx').name
+    docx_path = output_dir / Path(md_file).with_suffix('.docx').name
 
     first_fig = True
     first_table = True
 
-    with md_path.open(encoding='utf-8') as f:
+    p = None
+    table = None
 
-        p = None
+    for section in doc.sections:
 
-        for md in f.read().split('\n'):
+        if section.name is not None:
+            if j.has_newpage(section.name):
+                document.page_break()
+            document.heading(section.name, 1)
 
-            if md.startswith('# '):
-                document.add_heading(md[2:], 0)
+        for block in section.blocks:
 
-            elif md.startswith('## '):
-                section_name = md[3:]
-                if j.has_newpage(section_name):
-                    document.add_page_break()
-                document.add_heading(md[3:], 1)
+            if isinstance(block, Heading):
+                md = block.lines[0]
 
-            elif md.startswith('### '):
+                if block.level == 1 and j.has_newpage(block.text):
+                    document.page_break()
 
                 if md.startswith('### Table '):
                     if first_table:
@@ -42,7 +70,7 @@ def convert_to_docx(output_dir, tmp_dir, md_file, args):
                         first_table = False
 
                     else:
-                        document.add_page_break()
+                        document.page_break()
 
                 cond_f0 = j.embed_figures() or args.embed
                 cond_f1 = md.startswith('### Figure ')
@@ -52,93 +80,133 @@ def convert_to_docx(output_dir, tmp_dir, md_file, args):
                         first_fig = False
 
                     else:
-                        document.add_page_break()
+                        document.page_break()
 
-                document.add_heading(md[4:], 2)
+                document.heading(block.text, block.level)
 
-            elif md.startswith('![]('):
-                path_to_img = md[4:-1]  # TODO: cleaner way to select path
-                document.add_picture(path_to_img)
+                # link to the png of the figure
+                for md in block.lines[1:]:
+                    document.picture(md[4:-1])
 
-            elif len(md) > 0 and md[0] == '^' and md[-1] == '^':  # table header
-                n_col = md.count('^') - 1
-                table = document.add_table(rows=1, cols=n_col)
-                table.autofit = True
-                row_cells = table.rows[0].cells
-                for one_cell, txt in zip(row_cells, md.split('^')[1:-1]):
-                    one_cell.paragraphs[0].add_run(_remove_slash(txt.strip())).bold = True
+            elif isinstance(block, Image):
+                document.picture(block.path)
 
-            elif len(md) > 0 and md[0] == '|' and md[-1] == '|':
-                row_cells = table.add_row().cells
+            elif isinstance(block, Table):
+                header = block.header
+                if header is not None:
+                    table = document.table(header)
 
-                for one_cell, txt in zip(row_cells, md.split('|')[1:-1]):
-                    one_cell.text = _remove_slash(txt.strip())
+                for row in block.rows:
+                    document.row(table, row)
 
-            elif md.strip() == '':  # empty line, i.e. end of the paragraph
+            elif isinstance(block, Blank):  # end of the paragraph
                 p = None
 
             else:
-                if p is None:
-                    if md.startswith('>'):
-                        style = 'Reviewer'
-                        md = md[2:]  # remove "> " at the beginning
+                # the lines can be split or become empty (cross-references)
+                for md in '\n'.join(block.lines).split('\n'):
+                    if md.strip() == '':  # empty line, i.e. end of the paragraph
+                        p = None
+                        continue
+
+                    if p is None:
+                        if md.startswith('>'):
+                            style = 'Reviewer'
+                            md = md[2:]  # remove "> " at the beginning
+                        else:
+                            style = None
+                        p = document.paragraph(style)
+                        document.runs(p, parse_runs(md))
                     else:
-                        style = None
-                    p = document.add_paragraph(style=style)
-                else:
-                    p.add_run(' ')
-
-                _add_run(p, md)
-
-    document.save(str(docx_path))
-
-
-def _add_run(p, md):
-
-    runs = split('(?<!\\\)[%|\*|_|\^|~]', md)
-    values = findall('(?<!\\\)[%|\*|_|\^|~]', md)
-    values.append('')
-
-    italics = False
-    bold = False
-    underline = False
-    superscript = False
-    subscript = False
-
-    for one_run, one_value in zip(runs, values):
-
-        one_run = _remove_slash(one_run)
-
-        if one_run.endswith('\\'):
-            LINE_BREAK = True
-            one_run = one_run[:-1]
-        else:
-            LINE_BREAK = False
-
-        r = p.add_run(one_run)
-
-        if italics:
-            r.italic = True
-        if bold:
-            r.bold = True
-        if underline:
-            r.underline = True
-        if superscript:
-            r.font.superscript = True
-        if subscript:
-            r.font.subscript = True
-
-        if one_value == '%':
-            bold = ~bold
-        if one_value == '*':
-            italics = ~italics
-        if one_value == '^':
-            superscript = ~superscript
-        if one_value == '~':
-            subscript = ~subscript
-
-        if LINE_BREAK:
-            r.add_break()
-
-def _remove_slash(s):
-    return sub('\\\([%~\*\^])', '\g<1>', s)
+                        document.runs(p, [Run(' '), ] + parse_runs(md))
+
+    document.save(docx_path)
+
+
+class DocxWriter:
+    """Write the docx with python-docx.
+
+    Parameters
+    ----------
+    ref_docx : path to file
+        docx used as reference (for the styles and the page layout)
+    """
+    def __init__(self, ref_docx):
+        self.document = get_document(ref_docx)
+
+    def page_break(self):
+        self.document.add_page_break()
+
+    def heading(self, text, level):
+        self.document.add_heading(text, level)
+
+    def picture(self, path):
+        self.document.add_picture(path)
+
+    def table(self, header):
+        """Add a table, with the header in bold, and return it"""
+        table = self.document.add_table(rows=1, cols=len(header))
+        table.autofit = True
+        row_cells = table.rows[0].cells
+        for one_cell, txt in zip(row_cells, header):
+            one_cell.paragraphs[0].add_run(txt).bold = True
+        return table
+
+    def row(self, table, row):
+        row_cells = table.add_row().cells
+        for one_cell, txt in zip(row_cells, row):
+            one_cell.text = txt
+
+    def paragraph(self, style):
+        return self.document.add_paragraph(style=style)
+
+    def runs(self, p, runs):
+        for run in runs:
+            r = p.add_run(run.text)
+
+            if run.italic:
+                r.italic = True
+            if run.bold:
+                r.bold = True
+            if run.superscript:
+                r.font.superscript = True
+            if run.subscript:
+                r.font.subscript = True
+
+            if run.line_break:
+                r.add_break()
+
+    def save(self, docx_path):
+        self.document.save(str(docx_path))
+
+
+def get_document(ref_docx):
+    """Return a new python-docx document based on the reference docx, which is
+    parsed only if it changed since the last call.
+
+    Parameters
+    ----------
+    ref_docx : path to file
+        docx used as reference
+
+    Returns
+    -------
+    instance of docx.Document
+        copy of the reference document, which can be modified
+
+    Notes
+    -----
+    Copying the parsed document is faster than opening the docx, which reads
+    the zip file and parses all the parts (styles, numbering, theme, settings)
+    again.
+    """
+    ref_docx = Path(ref_docx).resolve()
+    mtime = ref_docx.stat().st_mtime
+
+    with _DOCUMENTS_LOCK:
+        d_mtime, document = _DOCUMENTS.get(ref_docx, (None, None))
+        if d_mtime != mtime:
+            document = Document(str(ref_docx))
+            _DOCUMENTS[ref_docx] = (mtime, document)
+
+        return deepcopy(document)
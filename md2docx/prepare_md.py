@@ -1,33 +1,65 @@
 """Work on markdown file and rearrange it if necessary
 """
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import sha256
 from json import load, dump
-from os import devnull
+from os import close, replace, stat, unlink
 from pathlib import Path
-from re import sub, search, findall, finditer, split
-from subprocess import run
-
-from .journal import Journal
-from .utils import (loc_dir,
-                    node_dir,
-                    )
+from shutil import copyfile
+from tempfile import mkstemp
+from threading import Lock
+
+from .citeproc import get_worker
+from .document import Figure, Heading, parse_lines, parse_md
+from .inkscape import export_png
+from .journal import get_journal
+from .library import get_library, write_subset
+from .manifest import hash_inputs
+from .patterns import (ACRONYM,
+                       BOLD,
+                       CITATION,
+                       CITATION_ITEM,
+                       CROSSREF,
+                       FIGURE_INDEX,
+                       FIGURE_LINK,
+                       ITALICS,
+                       LABEL,
+                       REFERENCE_DIV,
+                       TABLE_INDEX,
+                       WHITESPACE,
+                       )
+from .timing import propagate, stage
+from .utils import cache_dir, report
 SRC_DIR = 'src'
 IMG_DIR = 'img'
-OUT_DIR = 'output'
 CROSSREF_JSON = 'crossref.json'
+CITEPROC_JSON = 'citeproc.json'
+CITED_LIBRARY = 'library.jsonl'
 
 
 def warn(citation_item):
-    print("WARNING: Reference '{}' not found in the bibliography."
-          .format(citation_item.key))
+    report("WARNING: Reference '{}' not found in the bibliography."
+           .format(citation_item.key))
 
 
 BIBLIO_TITLE = '## References'
 DPI = 300
-CITATION_SEPARATOR = '; '  # this is how references are separated in md ',; '
+BACKGROUND = '#ffffff'  # use white background
+
+_ACRONYMS = {}
+_ACRONYMS_LOCK = Lock()
+_PARSED = {}
+_PARSED_LOCK = Lock()
+_EXPANDED = {}
+_EXPANDED_LOCK = Lock()
+_PNG_LOCKS = {}
+_PNG_LOCKS_LOCK = Lock()
+_CITATIONS = {}
+_CITATIONS_LOCK = Lock()
 
 
-def preproc_md(article_dir, tmp_dir, md_file, args):
+def preproc_md(article_dir, out_dir, md_file, args):
     """
 
     Notes
@@ -36,6 +68,13 @@ def preproc_md(article_dir, tmp_dir, md_file, args):
     requires it, 2) you pass the 'embed' option, 3) it's the
     reply-to-reviewer
 
+    The markdown file is parsed only once and all the steps change the
+    structure of the document. The parsed document and the document with the
+    acronyms are kept, so that they are shared by the journals (when the
+    sections are in the same order) and by the next builds. The citations are formatted afterwards for all
+    the markdown files at once (add_references) and then postproc_md
+    completes the document.
+
     TODO
     ----
     automatic affiliations for authors
@@ -47,46 +86,75 @@ def preproc_md(article_dir, tmp_dir, md_file, args):
     TODO
     ----
     tables should follow order of text
+
+    Returns
+    -------
+    instance of Document
+        structure of the manuscript (None if the markdown file does not exist)
+    tuple of list
+        2 lists with the names of the svg files and the png files (None if the
+        markdown file does not exist)
     """
     md_path = article_dir / SRC_DIR / md_file
     if not md_path.exists():
-        return
-    out_path = tmp_dir / md_file
+        return None, None
 
     is_main = md_file == 'main.md'
-    is_review = md_file == 'review.md'
 
-    with md_path.open() as f:
-        md = f.read()
+    doc = _parse_md_file(md_path)
 
-    j = Journal(args.journal_json)
+    j = get_journal(args.journal_json)
 
     # reorder, because this affects references, acronyms and figure/table order
     if is_main:
-        md = organize_md(md, j)
+        with stage('organize_md'):
+            organize_md(doc, j)
 
-    md = _make_acronyms(md, args.acronyms)
+    with stage('make_acronyms'):
+        doc = _make_acronyms_once(md_path, doc, args.acronyms)
 
-    md = include_figures(article_dir, md, j, args, is_main)
+    with stage('include_figures'):
+        figure_name = include_figures(article_dir, out_dir, doc, j, args,
+                                      is_main)
 
-    md = add_references(md, tmp_dir, args)
+    return doc, figure_name
 
-    if is_main:
-        count_text(md, j)
 
-    with out_path.open('w') as f:
-        f.write(md)
+def postproc_md(tmp_dir, md_file, doc, args):
+    """Count the words and prepare the cross-references in the main text.
 
-    if is_main:
-        _get_main_ref(tmp_dir)
+    Parameters
+    ----------
+    tmp_dir : path to dir
+        directory with temporary files
+    md_file : str
+        name of the markdown file
+    doc : instance of Document
+        structure of the manuscript, with formatted citations (None if the
+        markdown file does not exist)
+    args : arguments
+        arguments to the function
 
-    if is_review:
-        _set_review_ref(tmp_dir)
+    Notes
+    -----
+    The markdown file is written to tmp_dir only with --debug or --only_md.
+    """
+    if doc is None:
+        return
 
+    if md_file == 'main.md':
+        with stage('count_text'):
+            count_text(doc, get_journal(args.journal_json))
+        with stage('get_main_ref'):
+            _get_main_ref(tmp_dir, doc)
 
-def count_text(md, j):
+    if md_file != 'review.md':  # review.md is written by set_review_ref
+        _write_tmp_md(tmp_dir, md_file, doc, args)
 
-    md_title, md_sections = _read_section_by_section(md)
+
+def count_text(doc, j):
+
+    md_sections = {x.name: x for x in doc.sections[1:]}
 
     for limit in j.json['wordcount']:
         count = 0
@@ -95,63 +163,55 @@ def count_text(md, j):
             section_names.append(section)
 
             try:
-                section_text = md_sections[section]
+                section_text = md_sections[section].to_md()
             except KeyError:
-                print(section + ' is missing')
+                report(section + ' is missing')
                 break
 
             if limit['limit']['type']:
-                count += len(findall('\s+', section_text))
+                count += len(WHITESPACE.findall(section_text))
             else:
                 raise NotImplementedError
 
         if count == 0:
             continue
         if count > limit['limit']['number']:
-            print('{0} has {1} words (max: {2}) -> WARNING'
-                  ''.format('+'.join(section_names), count, limit['limit']['number']))
+            report('{0} has {1} words (max: {2}) -> WARNING'
+                   ''.format('+'.join(section_names), count, limit['limit']['number']))
         else:
-            print('{0} has {1} words (max: {2})'
-                  ''.format('+'.join(section_names), count, limit['limit']['number']))
-
+            report('{0} has {1} words (max: {2})'
+                   ''.format('+'.join(section_names), count, limit['limit']['number']))
 
-def _read_section_by_section(md):
-    """we need to do it twice, 1) when we reorder the text and 2) when we count
-    the words"""
-    md_section_names = findall('\n## ([\w ]+)\n', md)
 
-    md_parts = split('\n## [\w ]+\n', md)
-    md_title = md_parts[0]
-    md_sections = dict(zip(md_section_names, md_parts[1:]))
-    return md_title, md_sections
+def organize_md(doc, j):
+    md_title = doc.sections[0]
+    md_sections = {x.name: x for x in doc.sections[1:]}
 
-
-def organize_md(md, j):
-    md_title, md_sections = _read_section_by_section(md)
-
-    md = [md_title, ]
+    sections = [md_title, ]
     for sect in j.sections:
         try:
-            md.append('\n## ' + sect + '\n' + md_sections.pop(sect))
+            sections.append(md_sections.pop(sect))
         except KeyError:
             if j.is_necessary(sect):
-                print('missing section ' + sect)
+                report('missing section ' + sect)
 
     if md_sections:
-        print('unused sections: ' + ', '.join(list(md_sections)))
+        report('unused sections: ' + ', '.join(list(md_sections)))
 
-    return ''.join(md)
+    doc.sections = sections
 
 
-def include_figures(article_dir, s, j, args, is_main):
+def include_figures(article_dir, out_dir, doc, j, args, is_main):
     """Include a link to figures in the manuscript
 
     Parameters
     ----------
     article_dir : path
         path to directory
-    s : str
-        text of the manuscript
+    out_dir : path to dir
+        directory that contains the output (where the png are written)
+    doc : instance of Document
+        structure of the manuscript (it's modified in place)
     j : instance of Journal
         information about the journal
     args : arguments
@@ -161,8 +221,8 @@ def include_figures(article_dir, s, j, args, is_main):
 
     Returns
     -------
-    s : str
-        text of the manuscript
+    figure_name : tuple of list
+        2 lists with the names of the svg files and the png files
 
     TODO
     ----
@@ -172,39 +232,57 @@ def include_figures(article_dir, s, j, args, is_main):
             s = sub('### (?!Figure \[\+)(.*)', '**\g<1>**', s)
     """
     img_dir = article_dir / IMG_DIR
-    out_dir = article_dir / OUT_DIR
 
     if j.embed_figures() or args.embed or not is_main:
-        s = sub('### Figure (\[\+[\w]*\])',
-                '\g<0>\n![](' + (out_dir / 'figure_').as_posix() + '\g<1>.png' + ')\n',
-                s)
-    else:
-        s = sub('### Figure (\[\+[\w]*\])',
-                '\g<0>\n',
-                s)
+        for block in doc.blocks():
+            if isinstance(block, Figure):
+                fig_ref = FIGURE_LINK.match(block.lines[0]).group(1)
+                block.lines.append('![](' + (out_dir / 'figure_').as_posix() +
+                                   fig_ref + '.png' + ')')
 
     # ADD INDICES FOR FIGURES AND TABLES
-    s, figure_name = _make_index(s, is_main)
+    figure_name = _make_index(doc, is_main)
     if not args.skip_inkscape:
         _svg2png(figure_name, img_dir, out_dir, args)
 
-    return s
+    return figure_name
+
 
+def restore_figures(article_dir, out_dir, figure_name, args):
+    """Convert the figures again if the png are missing (because they were
+    converted to tiff), when the markdown file was not processed again.
+
+    Parameters
+    ----------
+    article_dir : path
+        path to directory
+    out_dir : path to dir
+        directory that contains the output
+    figure_name : tuple of list
+        2 lists with the names of the svg files and the png files
+    args : arguments
+        arguments to the function
+    """
+    img_dir = article_dir / IMG_DIR
 
-def _make_index(s, is_main):
+    missing = [(i_svg, i_png) for i_svg, i_png in zip(*figure_name)
+               if not (out_dir / i_png).exists()]
+    if missing and not args.skip_inkscape:
+        _svg2png(tuple(zip(*missing)), img_dir, out_dir, args)
+
+
+def _make_index(doc, is_main):
     """Make indices for figures.
 
     Parameters
     ----------
-    s : str
-        the whole article
+    doc : instance of Document
+        the whole article (it's modified in place)
     is_main : bool
         if it's false, i.e. a review, add "R" before table and figure names
 
     Returns
     -------
-    str
-        the whole article, with the correct indeces for figures, tables
     figure_name : tuple of list
         2 lists with the names of the svg files and the png files
 
@@ -216,9 +294,12 @@ def _make_index(s, is_main):
 
     It uses roman numerals for tables
     """
-    all_fig = finditer('### Fig(ure|\.) (\[\+(\w+)\])', s)
+    headings = [x.lines[0] for x in doc.blocks() if isinstance(x, Heading)]
+
+    index = {}
     figure_svg = []
     figure_png = []
+    all_fig = [m for m in map(FIGURE_INDEX.match, headings) if m is not None]
     for i, fig in enumerate(all_fig):
 
         fig_ref = fig.group(2)
@@ -229,13 +310,15 @@ def _make_index(s, is_main):
         else:
             fig_idx = 'R' + str(i + 1)
 
-        s = s.replace(fig_ref, fig_idx)
+        index.setdefault(fig_ref, fig_idx)
         figure_svg.append(fig_code + '.svg')
         figure_png.append('figure_' + fig_idx + '.png')
 
     figure_name = (figure_svg, figure_png)
 
-    all_table = finditer('### Table (\[\+\w+\])', s)
+    # tables whose name is also the name of a figure are not counted
+    all_table = [m for m in map(TABLE_INDEX.match, headings)
+                 if m is not None and m.group(1) not in index]
     for i, table in enumerate(all_table):
         table_ref = table.group(1)
 
@@ -244,9 +327,13 @@ def _make_index(s, is_main):
         else:
             table_idx = 'R' + _int_to_roman(i + 1)
 
-        s = s.replace(table_ref, table_idx)
+        index.setdefault(table_ref, table_idx)
 
-    return s, figure_name
+    # replace all the references to figures and tables in one pass
+    doc.map_lines(lambda line: LABEL.sub(
+        lambda m: index.get(m.group(), m.group()), line))
+
+    return figure_name
 
 
 def _svg2png(figure_name, img_dir, out_dir, args):
@@ -271,29 +358,101 @@ def _svg2png(figure_name, img_dir, out_dir, args):
     CerebCortex: max with = 86mm, 180mm
     JNeurosci: max width = 85mm, 116mm, 176mm
 
-    relies on inkscape being installed
+    relies on inkscape being installed. Figures are converted in parallel
+    (as many as --jobs) and inkscape is not called if the same svg was
+    already converted (see _cached_png). With --inkscape_shell, the figures
+    are sent to inkscape processes in shell mode, which are reused for the
+    whole build.
     """
     if args.inkscape_path is not None:
         inkscape = str(Path(args.inkscape_path) / 'inkscape')
     else:
         inkscape = 'inkscape'
 
+    svg_files = []
+    png_files = []
     for i_svg, i_png in zip(*figure_name):
         svg_file = img_dir / i_svg
         if not svg_file.exists():
             raise FileNotFoundError(str(svg_file))
 
-        png_file = out_dir / i_png
+        svg_files.append(svg_file)
+        png_files.append(out_dir / i_png)
+
+    if args.inkscape_shell:
+        n_shells = args.jobs
+    else:
+        n_shells = 0
+
+    with ThreadPoolExecutor(args.jobs) as pool:
+        list(pool.map(propagate(partial(_one_svg2png, inkscape, n_shells)),
+                      svg_files, png_files))
+
+
+def _one_svg2png(inkscape, n_shells, svg_file, png_file):
+    """Convert one svg file to png, unless it is already in the cache.
+
+    Parameters
+    ----------
+    inkscape : str
+        inkscape executable
+    n_shells : int
+        number of inkscape in shell mode (0 to start inkscape for each figure)
+    svg_file : path to file
+        svg image
+    png_file : path to file
+        png image to write
+    """
+    cached_png = _cached_png(svg_file)
 
-        cmd = [
-            inkscape,
-            str(svg_file),
-            '--export-dpi=' + str(DPI),
-            '--export-background=#ffffff',  # use white background
-            '--export-filename=' + str(png_file),
-            ]
-        print(' '.join(cmd))
-        run(cmd, stdout=open(devnull, "w"), stderr=open(devnull, "w"))
+    # the same svg (such as for another journal) is converted only once
+    with _PNG_LOCKS_LOCK:
+        png_lock = _PNG_LOCKS.setdefault(cached_png, Lock())
+
+    with png_lock:
+        if not cached_png.exists():
+            # write to a temporary file, so that the cache is never incomplete
+            fd, tmp_png = mkstemp(suffix='.png', dir=str(cached_png.parent))
+            close(fd)
+
+            export_png(inkscape, svg_file, tmp_png, DPI, BACKGROUND, n_shells)
+
+            if stat(tmp_png).st_size == 0:
+                unlink(tmp_png)
+                report('WARNING: inkscape could not convert ' + str(svg_file))
+                return
+            replace(tmp_png, str(cached_png))
+
+    copyfile(str(cached_png), str(png_file))
+
+
+def _cached_png(svg_file):
+    """Path to the png in the cache, based on the content of the svg and on
+    the conversion options.
+
+    Parameters
+    ----------
+    svg_file : path to file
+        svg image
+
+    Returns
+    -------
+    path to file
+        png image in the cache (it might not exist yet)
+
+    Notes
+    -----
+    Images linked (not embedded) inside the svg are not part of the key, so
+    remove the cache directory if you change only those.
+    """
+    h = sha256()
+    h.update(svg_file.read_bytes())
+    h.update(str(DPI).encode())
+    h.update(BACKGROUND.encode())
+
+    png_cache = cache_dir / 'png'
+    png_cache.mkdir(parents=True, exist_ok=True)
+    return png_cache / (h.hexdigest() + '.png')
 
 
 def _int_to_roman(i):
@@ -311,113 +470,267 @@ def _int_to_roman(i):
     return ''.join(result)
 
 
-def add_references(md, tmp_dir, args):
-    """
-    Remember that this function is run for main, review, and editor.
+def add_references(docs, tmp_dir, args):
+    """Format the citations of main, review, and editor with one call to
+    citeproc.js
+
+    Parameters
+    ----------
+    docs : dict
+        structure of each manuscript, with the name of the markdown file as
+        key. The citations and the references are added in place.
+    tmp_dir : path to dir
+        directory with temporary files
+    args : arguments
+        arguments to the function
+
+    Notes
+    -----
+    The citations are sent to citeproc.js through a pipe and citeproc.js keeps
+    separate numbering for each file. The citations are written to tmp_dir
+    only with --debug.
+
+    The hash of the citations (with the library and the csl) and the output
+    of citeproc.js are stored in tmp_dir/citeproc.json, so that citeproc.js
+    is not run again for the files whose citations did not change (also in a
+    new process, with --incremental). The same values are kept in memory, for
+    --watch.
     """
-    citations_to_do = tmp_dir / 'citations.json'
-    biblio = Path(args.library).with_suffix('.json')
+    biblio = Path(args.library).resolve()
+
+    md_parts = {md_file: [_split_citations(x) for x in doc.lines()]
+                for md_file, doc in docs.items()}
+    citations = {md_file: _read_citations(x for line in md_parts[md_file]
+                                          for x in line[1::2])
+                 for md_file in docs}
+
+    to_do = {}
+    formatted = {}
+    stored = None
+    for md_file in docs:
+        # citeproc is not run again if the citations did not change (tmp_dir
+        # is different for each article and journal, which can use the same
+        # library)
+        key = hash_inputs([biblio, Path(args.csl)], [citations[md_file]])
+        with _CITATIONS_LOCK:
+            previous = _CITATIONS.get((tmp_dir, md_file))
+        if previous is None:
+            if stored is None:
+                stored = _read_citeproc_json(tmp_dir)
+            previous = stored.get(md_file)
+        if previous is not None and previous[0] == key:
+            report('citations in ' + md_file + ' did not change')
+            formatted[md_file] = previous[1]
+        else:
+            _check_citation_keys(citations[md_file], biblio)
+            to_do[md_file] = key
 
-    _prepare_node_input(md, citations_to_do)
+    if to_do:
+        with stage('citeproc'):
+            replies = _process_node([citations[x] for x in to_do], biblio, args)
+        for (md_file, key), reply in zip(to_do.items(), replies):
+            formatted[md_file] = reply
+            with _CITATIONS_LOCK:
+                _CITATIONS[(tmp_dir, md_file)] = (key, reply)
+        _write_citeproc_json(tmp_dir, to_do, formatted)
 
-    _check_citation_keys(citations_to_do, biblio)
-    _process_node(tmp_dir, biblio, args)
+    if args.debug:
+        for md_file in docs:
+            _write_node_files(tmp_dir / Path(md_file).stem, citations[md_file],
+                              formatted[md_file])
 
-    md = _read_node_output(md, tmp_dir)
+    for md_file, doc in docs.items():
+        _read_node_output(doc, md_parts[md_file], citations[md_file],
+                          formatted[md_file])
+
+
+def _read_citeproc_json(tmp_dir):
+    """Hash of the citations and output of citeproc.js of the previous run
+
+    Returns
+    -------
+    dict
+        for each markdown file, the hash and the output of citeproc.js (empty
+        if the file is missing or incomplete)
+    """
+    try:
+        with (tmp_dir / CITEPROC_JSON).open(encoding='utf-8') as f:
+            return {k: tuple(v) for k, v in load(f).items()}
+    except (FileNotFoundError, ValueError):
+        return {}
 
-    return md
 
+def _write_citeproc_json(tmp_dir, keys, formatted):
+    """Store the hash of the citations and the output of citeproc.js of the
+    files which were formatted, keeping the other files"""
+    stored = _read_citeproc_json(tmp_dir)
+    stored.update((md_file, (key, formatted[md_file]))
+                  for md_file, key in keys.items())
 
-def _check_citation_keys(citations_json, library_json):
+    tmp_json = tmp_dir / (CITEPROC_JSON + '.tmp')
+    with tmp_json.open('w', encoding='utf-8') as f:
+        dump(stored, f)
+    replace(str(tmp_json), str(tmp_dir / CITEPROC_JSON))
+
+
+def _check_citation_keys(citations, library_jsonl):
     """Check that all the citation keys are present in the library.
     Otherwise citeproc.js fails but it's hard to know which citation is missing
     """
-    with citations_json.open() as f:
-        citations = load(f)
-
-    with library_json.open() as f:
-        library = load(f)
+    library = get_library(library_jsonl)
 
     to_cite = {x0['id'] for x1 in citations for x0 in x1['citationItems']}
 
-    not_in_lib = to_cite - set(library)
+    not_in_lib = {x for x in to_cite if x not in library}
     if not_in_lib:
         raise ValueError('Citation key not found in library: ' + ', '.join(not_in_lib))
 
 
-def _prepare_node_input(md, citations_to_do):
-    """Read citations from md file and write them to json for node.js
+def _write_node_files(cite_dir, citations, formatted):
+    """Write the input and the output of citeproc.js (for debugging)
+
+    Parameters
+    ----------
+    cite_dir : instance of Path
+        directory where to write the files
+    citations : list of dict
+        citations in the format of citeproc.js
+    formatted : dict
+        output of citeproc.js, with 'citations' and 'references'
+    """
+    cite_dir.mkdir(exist_ok=True)
+
+    with (cite_dir / 'citations.json').open('w') as f:
+        dump(citations, f, indent=2, sort_keys=True)
+
+    with (cite_dir / 'formattedCitations.json').open('w') as f:
+        dump(formatted['citations'], f, indent=4)
+
+    with (cite_dir / 'formattedReferences.txt').open('w') as f:
+        f.write(formatted['references'])
+
+
+def _split_citations(md):
+    """Split the text of the manuscript at each citation, so that the text is
+    read only once.
 
     Parameters
     ----------
     md : str
         text of the manuscript
-    citations_to_do : instance of Path
-        json file where to write citations from md
+
+    Returns
+    -------
+    list of str
+        parts of the text, where the odd elements are the citations (such as
+        '[@Smith2010; @Doe2005]') and the even elements are the text between
+        citations
     """
-    md_citations = findall('(\[?@[@\w+0-9' + CITATION_SEPARATOR + ']+\]?)', md)
+    return CITATION.split(md)
+
 
-    j_citations = []
+def _read_citations(md_citations):
+    """Read citations from md file
+
+    Parameters
+    ----------
+    md_citations : iterable of str
+        citations in the text of the manuscript (the odd elements of
+        _split_citations)
+
+    Returns
+    -------
+    list of dict
+        citations in the format of citeproc.js (without duplicates, in the
+        order in which they first appear)
+    """
+    # remove duplicate keys (because citeproc.js cannot handle them)
+    j_citations = {}
     for v in md_citations:
+        if v in j_citations:
+            continue
         items = []
-        for x in split('[' + CITATION_SEPARATOR + ']+', v):
+        for x in CITATION_ITEM.split(v):
             items.append({'id': x.strip('[@] ')})
-        j_cit = {'citationID': v,
-                 'citationItems': items,
-                 'properties': {}}
-        j_citations.append(j_cit)
+        j_citations[v] = {'citationID': v,
+                          'citationItems': items,
+                          'properties': {}}
 
-    # remove duplicate keys (because citeproc.js cannot handle them)
-    citationsID = []
-    all_cit = []
-    for cit in j_citations:
-        if cit['citationID'] not in citationsID:
-            citationsID.append(cit['citationID'])
-            all_cit.append(cit)
-    j_citations = all_cit
+    return list(j_citations.values())
 
-    with citations_to_do.open('w') as f:
-        dump(j_citations, f, indent=2, sort_keys=True)
 
+def write_cited_library(article_dir, tmp_dir, md_files, library_jsonl):
+    """Write a library with only the references which are cited in the
+    markdown files, so that citeproc.js reads only those.
 
-def _process_node(tmp_dir, biblio, args):
+    Parameters
+    ----------
+    article_dir : path
+        path to directory
+    tmp_dir : path to dir
+        directory with temporary files
+    md_files : list of str
+        names of the markdown files in src/
+    library_jsonl : path to file
+        .jsonl library written by prepare_bib
 
-    if args.node_path is not None:
-        node = str(Path(args.node_path) / 'node')
-    else:
-        node = 'node'
+    Returns
+    -------
+    path to file
+        .jsonl library in tmp_dir (with .idx). It's not written again if the
+        cited references did not change.
 
-    cmd = [node,
-           'processcite.js',
-           str(tmp_dir),
-           str(biblio),
-           str(args.csl),
-           str(loc_dir)]
+    Notes
+    -----
+    The keys which are not in the library are not in the subset either, so
+    _check_citation_keys reports them as usual.
+    """
+    keys = set()
+    for md_file in md_files:
+        md_path = article_dir / SRC_DIR / md_file
+        if md_path.exists():
+            md = md_path.read_text()
+            md_citations = _split_citations(md)[1::2]
+            keys.update(x['id'] for cit in _read_citations(md_citations)
+                        for x in cit['citationItems'])
 
-    print(' '.join(cmd))
-    run(cmd, cwd=str(node_dir))
+    library = get_library(library_jsonl)
+    cited_jsonl = tmp_dir / CITED_LIBRARY
+    write_subset(library, [x for x in keys if x in library], cited_jsonl)
 
+    return cited_jsonl
 
-def _read_node_output(md, tmp_dir):
 
-    citations_to_do = tmp_dir / 'citations.json'
-    citations_formatted = tmp_dir / 'formattedCitations.json'
-    references_formatted = tmp_dir / 'formattedReferences.txt'
+def _process_node(citations, biblio, args):
+    """Format the citations with citeproc.js. The node process is started
+    only once and it formats main, review, and editor in one call.
+    """
+    worker = get_worker(biblio, args.csl, args.node_path)
+    return worker.process(citations)
 
-    with citations_to_do.open('r') as f:
-        cite_pre = load(f)
 
-    with citations_formatted.open('r') as f:
-        cite_post = load(f)
+def _read_node_output(doc, md_parts, cite_pre, formatted):
+    """Add the formatted citations and references to the manuscript.
 
-    for i_pre, i_post in zip(cite_pre, cite_post):
-        md = md.replace(i_pre['citationID'], i_post)
+    Parameters
+    ----------
+    doc : instance of Document
+        structure of the manuscript (it's modified in place)
+    md_parts : list of list of str
+        each line of the manuscript, split by _split_citations
+    cite_pre : list of dict
+        citations in the format of citeproc.js
+    formatted : dict
+        output of citeproc.js, with 'citations' and 'references'
+    """
+    cite_post = {i_pre['citationID']: i_post
+                 for i_pre, i_post in zip(cite_pre, formatted['citations'])}
 
-    md = md.replace(' <sup>', '^')
-    md = md.replace('</sup>', '^')
+    # the lines were already split, in the same order
+    md_lines = iter([_replace_citations(x, cite_post) for x in md_parts])
+    doc.map_lines(lambda line: next(md_lines))
 
-    with references_formatted.open('r') as f:
-        ref_str = f.read()
+    ref_str = formatted['references']
 
     ref_str = ref_str.replace('<b>', '%')
     ref_str = ref_str.replace('</b>', '%')
@@ -425,66 +738,215 @@ def _read_node_output(md, tmp_dir):
     ref_str = ref_str.replace('</i>', '*')
     ref_str = ref_str.replace('&#38;', '&')
 
-    ref_str = sub('<div class=\"[\w-]+\">', '', ref_str)
-    ref_str = sub('</div>', '', ref_str)
+    ref_str = REFERENCE_DIV.sub('', ref_str)
+    ref_str = ref_str.replace('</div>', '')
     references = [line.strip() for line in ref_str.split('\n') if line.strip()]
-    references.insert(0, BIBLIO_TITLE)
 
-    md_biblio = '\n\n'.join(references)
+    _add_bibliography(doc, references)
 
-    return md.replace(BIBLIO_TITLE, md_biblio)
 
+def _replace_citations(md_parts, cite_post):
+    """Replace each citation with the formatted one, in one pass over the text
 
-def _make_acronyms(line, acronym_file):
-    """change all the acronyms.
+    Parameters
+    ----------
+    md_parts : list of str
+        text split by _split_citations
+    cite_post : dict
+        formatted citation, with the citation in the text as key
+
+    Returns
+    -------
+    str
+        text with the formatted citations
+    """
+    md_parts = md_parts.copy()
+    md_parts[1::2] = [cite_post.get(x, x) for x in md_parts[1::2]]
+    md = ''.join(md_parts)
+
+    md = md.replace(' <sup>', '^')
+    md = md.replace('</sup>', '^')
+    return md
+
+
+def _add_bibliography(doc, references):
+    """Add the references (one paragraph each) after "## References"."""
+    md_biblio = []
+    for one_ref in references:
+        md_biblio.extend(['', one_ref])
+
+    for section in doc.sections:
+        if section.name is not None and '## ' + section.name == BIBLIO_TITLE:
+            section.blocks[0:0] = parse_lines(md_biblio)
+
+        # "## References" can also be a heading inside a section
+        for i in reversed(range(len(section.blocks))):
+            block = section.blocks[i]
+            if isinstance(block, Heading) and block.lines == [BIBLIO_TITLE, ]:
+                section.blocks[i + 1:i + 1] = parse_lines(md_biblio)
+
+
+def _load_acronyms(acronym_file):
+    """Read the acronyms, only if the file changed since the last call.
 
     Parameters
     ----------
-    l : str
-        string to change
     acronym_file : path to file
         json file with acronyms
 
     Returns
     -------
-    str
-        string with acronyms
+    dict
+        acronyms (do not modify it, it's shared between calls)
     """
-    with open(acronym_file, 'r') as r:
-        acronym = load(r)
-
-    full_acronym = deepcopy(acronym)
-
-    while True:
-        m = search('\[\$[a-zA-Z]+\]', line)
-        if m is None:
-            break
-        key = m.group()[2:-1]
-        l0 = line[:m.start()]
-        l1 = line[m.end():]
-        if acronym[key] is not None:  # first time
-            line = l0 + acronym[key] + ' (' + key + ')' + l1
-            acronym[key] = None
-        else:
-            line = l0 + key + l1
+    acronym_file = Path(acronym_file).resolve()
+    mtime = acronym_file.stat().st_mtime
+
+    with _ACRONYMS_LOCK:
+        a_mtime, acronym = _ACRONYMS.get(acronym_file, (None, None))
+        if a_mtime != mtime:
+            with acronym_file.open('r') as r:
+                acronym = load(r)
+            _ACRONYMS[acronym_file] = (mtime, acronym)
+
+    return acronym
+
+
+def _parse_md_file(md_path):
+    """Parse the markdown file, only if the file changed since the last call.
+
+    Parameters
+    ----------
+    md_path : path to file
+        markdown file
+
+    Returns
+    -------
+    instance of Document
+        structure of the manuscript (a copy, which can be modified)
+    """
+    md_path = Path(md_path).resolve()
+    mtime = md_path.stat().st_mtime
+
+    with _PARSED_LOCK:
+        p_mtime, doc = _PARSED.get(md_path, (None, None))
+        if p_mtime != mtime:
+            with md_path.open() as f:
+                doc = parse_md(f.read())
+            _PARSED[md_path] = (mtime, doc)
+
+    return doc.copy()
+
+
+def _make_acronyms_once(md_path, doc, acronym_file):
+    """Change all the acronyms, unless the same markdown file with the
+    sections in the same order was already done (such as for another
+    journal).
+
+    Parameters
+    ----------
+    md_path : path to file
+        markdown file of the document
+    doc : instance of Document
+        structure of the manuscript (after organize_md)
+    acronym_file : path to file
+        json file with acronyms
+
+    Returns
+    -------
+    instance of Document
+        structure of the manuscript with the acronyms (a copy, which can be
+        modified)
+
+    Notes
+    -----
+    The order of the sections is part of the key, because the first time an
+    acronym is used, it's written in full.
+    """
+    md_path = Path(md_path).resolve()
+    acronym_file = Path(acronym_file).resolve()
+    key = (md_path, acronym_file, tuple(x.name for x in doc.sections))
+    mtimes = (md_path.stat().st_mtime, acronym_file.stat().st_mtime)
+
+    with _EXPANDED_LOCK:
+        e_mtimes, expanded = _EXPANDED.get(key, (None, None))
+        if e_mtimes != mtimes:
+            _make_acronyms(doc, acronym_file)
+            expanded = doc
+            _EXPANDED[key] = (mtimes, expanded)
+
+    return expanded.copy()
+
+
+def _make_acronyms(doc, acronym_file):
+    """change all the acronyms.
+
+    Parameters
+    ----------
+    doc : instance of Document
+        structure of the manuscript (it's modified in place)
+    acronym_file : path to file
+        json file with acronyms
+
+    Notes
+    -----
+    The first time an acronym is used, it's written in full. Each line is
+    read only once and the pieces are joined at the end.
+    """
+    acronym = _load_acronyms(acronym_file)
+
+    used = set()
+    doc.map_lines(partial(_expand_acronyms, acronym=acronym, used=used))
 
     # ADD ACRONYMS at the end
     s = []
     for key in sorted(acronym, key=lambda x: x.lower()):
-        if acronym[key] is None:
-            s.append(key + ': ' + full_acronym[key])
-    line = line.replace('[ACRONYMS]', '; '.join(s))
+        if key in used:
+            s.append(key + ': ' + acronym[key])
+    doc.map_lines(lambda line: line.replace('[ACRONYMS]', '; '.join(s)))
+
+
+def _expand_acronyms(md, acronym, used):
+    """Write the acronyms in full the first time they are used
+
+    Parameters
+    ----------
+    md : str
+        string to change
+    acronym : dict
+        acronyms, with the full text
+    used : set
+        acronyms which were already used (it's updated)
 
-    return line
+    Returns
+    -------
+    str
+        string with acronyms
+    """
+    md_parts = []
+    start = 0
+    for m in ACRONYM.finditer(md):
+        key = m.group(1)
+        md_parts.append(md[start:m.start()])
+        if key not in used:  # first time
+            md_parts.append(acronym[key] + ' (' + key + ')')
+            used.add(key)
+        else:
+            md_parts.append(key)
+        start = m.end()
+    md_parts.append(md[start:])
+    return ''.join(md_parts)
 
 
-def _get_main_ref(tmp_dir):
+def _get_main_ref(tmp_dir, doc):
     """Get references from the main text
 
     Parameters
     ----------
     tmp_dir : path to dir
         directory with temporary files
+    doc : instance of Document
+        structure of the main manuscript (it's modified in place)
 
     Notes
     -----
@@ -492,24 +954,36 @@ def _get_main_ref(tmp_dir):
     which keys should be looked up in reply-to-reviewers, then it reads the
     text from the main manuscript.
 
-    The only tricky part is join(main_s.splot(key)[1::2]). It splits the
-    main text based on the key and it takes every other string (those
-    between keys). Then it joins them using [...] if necessary.
+    The only tricky part is collecting the quotes. It takes the text between
+    the first and the second occurrence of a key, between the third and the
+    fourth, and so on. Then it joins them using [...] if necessary.
     """
-    md_path = tmp_dir / 'main.md'
     crossref_json = tmp_dir / CROSSREF_JSON
 
-    with md_path.open('r') as r:
-        main_s = r.read()  # read the whole file
+    main_s = doc.to_md()  # quotes can span several lines
+
+    # text between each pair of the same key (or until the end of the text,
+    # if the key is not closed), read in one pass
+    quotes = {}
+    opened = {}
+    for m in CROSSREF.finditer(main_s):
+        key = m.group()
+        if key in opened:
+            quotes[key].append(main_s[opened.pop(key):m.start()])
+        else:
+            quotes.setdefault(key, [])
+            opened[key] = m.end()
+    for key, start in opened.items():
+        quotes[key].append(main_s[start:])
 
     # we create a dict of the key and complete values.
     review_sub = {}
-    for key in set(findall('@\[[0-9a-z.]+\]', main_s)):
-        line = ' [...]\n'.join(main_s.split(key)[1::2])
+    for key, quote in quotes.items():
+        line = ' [...]\n'.join(quote)
         # remove italics already in the string (but not boldface)
-        line = sub('\*(.+?)\*', '\g<1>', line)
+        line = ITALICS.sub('\g<1>', line)
         # corner case, when one key is in the text of another key
-        review_sub[key] = sub('@\[[0-9a-z.]+\]', '', line)
+        review_sub[key] = CROSSREF.sub('', line)
 
     # use italics for cross-references (review.md should use @[X] and italics is added automatically)
     for key, value in review_sub.items():
@@ -519,33 +993,42 @@ def _get_main_ref(tmp_dir):
         dump(review_sub, f)
 
     # remove markers used for review (and bold which is used only to highlight)
-    main_s = sub('@\[[0-9a-z.]+\]', '', main_s)
-    main_s = sub(r'(?<!\\)%', '', main_s)
+    doc.map_lines(lambda line: BOLD.sub('', CROSSREF.sub('', line)))
 
-    with md_path.open('w') as w:
-        w.write(main_s)  # write the whole file
 
-
-def _set_review_ref(tmp_dir):
+def set_review_ref(tmp_dir, doc, args):
     """Set references to the review text
 
     Parameters
     ----------
     tmp_dir : path to dir
         directory with temporary files
+    doc : instance of Document
+        structure of the review (it's modified in place, None if there is no
+        review.md)
+    args : arguments
+        arguments to the function
+
+    Notes
+    -----
+    It needs to run after postproc_md on both main.md and review.md
     """
-    review_path = tmp_dir / 'review.md'
+    if doc is None:
+        return
     crossref_json = tmp_dir / CROSSREF_JSON
 
-    with review_path.open('r') as r:
-        review_s = r.read()  # read the whole file
-
     with crossref_json.open('r') as f:
         review_sub = load(f)
 
-    # we create a dict of the key and complete values.
-    for key, value in review_sub.items():
-        review_s = review_s.replace(key, value)
+    # replace all the keys in one pass
+    doc.map_lines(lambda line: CROSSREF.sub(
+        lambda m: review_sub.get(m.group(), m.group()), line))
+
+    _write_tmp_md(tmp_dir, 'review.md', doc, args)
+
 
-    with review_path.open('w') as w:
-        w.write(review_s)  # write the whole file
+def _write_tmp_md(tmp_dir, md_file, doc, args):
+    """Write the manuscript in markdown, only for debugging"""
+    if args.debug or args.only_md:
+        with (tmp_dir / md_file).open('w') as f:
+            f.write(doc.to_md())
@@ -1,8 +1,162 @@
+"""Convert the docx to pdf with libreoffice. Each libreoffice process uses its
+own user profile, so that several documents can be converted at the same time
+(libreoffice does not convert anything if another process is using the same
+profile). The profiles are locked, so that they are not shared by different
+python processes either (such as two md2docx running at the same time).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from queue import Queue
 from subprocess import run, DEVNULL
+from tempfile import TemporaryDirectory
+from threading import Lock
+try:
+    from fcntl import flock, LOCK_EX, LOCK_NB
+except ImportError:  # windows
+    flock = None
 
+from .timing import external, propagate
+from .utils import cache_dir, report
 
-def convert_to_pdf(out_dir, md_file):
-    docx_path = (out_dir / md_file).with_suffix('.docx')
-    if docx_path.exists():
-        run(['libreoffice', '--headless', '--convert-to', 'pdf',
-             docx_path.name], cwd=out_dir, stdout=DEVNULL)
+LIBREOFFICE = 'libreoffice'
+PROFILE_DIR = cache_dir / 'libreoffice'
+
+_CONVERTERS = {}
+_CONVERTERS_LOCK = Lock()
+
+
+class PdfConverter:
+    """Run libreoffice with a pool of user profiles.
+
+    Parameters
+    ----------
+    libreoffice : str
+        libreoffice executable
+    n_profiles : int
+        number of libreoffice processes which can run at the same time
+
+    Notes
+    -----
+    The profiles are kept in the cache directory, so libreoffice creates them
+    only the first time (which takes longer than the conversion itself). A
+    profile is used only when all the profiles of this converter are busy
+    and it's locked (profile_N.lock) until the process exits. On windows, the
+    profiles are in a temporary directory, which is removed at the end.
+    """
+    def __init__(self, libreoffice, n_profiles):
+        self.libreoffice = libreoffice
+        self.n_profiles = n_profiles
+        self.profiles = Queue()
+        self.lock = Lock()
+        self.n_used = 0  # profiles which are locked by this converter
+        self._lock_files = []  # open, to keep the lock on the profiles
+        self._tmp_dir = None
+        if flock is None:
+            self._tmp_dir = TemporaryDirectory(prefix='md2docx_libreoffice_')
+
+    def convert(self, docx_files):
+        """Convert docx files to pdf (in the same directory), dividing them
+        among the profiles which are free.
+
+        Parameters
+        ----------
+        docx_files : list of path to file
+            docx files to convert
+        """
+        groups = {}
+        for docx_file in docx_files:
+            groups.setdefault(docx_file.parent, []).append(docx_file)
+
+        # each libreoffice converts one batch of files in the same directory
+        batches = []
+        for files in groups.values():
+            n_batches = min(self.n_profiles, len(files))
+            batches.extend(files[i::n_batches] for i in range(n_batches))
+
+        with ThreadPoolExecutor(self.n_profiles) as pool:
+            list(pool.map(propagate(self._convert_batch), batches))
+
+    def _get_profile(self):
+        """Return a free profile, locking a new one if all the profiles are
+        busy (or wait for a free one, if there are already n_profiles)"""
+        with self.lock:
+            if self.profiles.empty() and self.n_used < self.n_profiles:
+                self.n_used += 1
+                return self._lock_profile()
+        return self.profiles.get()
+
+    def _lock_profile(self):
+        """Lock the first profile which is not used by another process"""
+        if self._tmp_dir is not None:
+            return Path(self._tmp_dir.name) / ('profile_' + str(self.n_used))
+
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        i = 0
+        while True:
+            profile = PROFILE_DIR / ('profile_' + str(i))
+            lock_file = profile.with_suffix('.lock').open('w')
+            try:
+                flock(lock_file, LOCK_EX | LOCK_NB)
+            except OSError:  # used by another process
+                lock_file.close()
+                i += 1
+            else:
+                self._lock_files.append(lock_file)
+                return profile
+
+    def _convert_batch(self, docx_files):
+        # a pdf from a previous run would hide that the conversion failed
+        for docx_file in docx_files:
+            try:
+                docx_file.with_suffix('.pdf').unlink()
+            except FileNotFoundError:
+                pass
+
+        profile = self._get_profile()  # wait for a free profile
+        try:
+            out_dir = docx_files[0].parent
+            with external('libreoffice'):
+                run([self.libreoffice,
+                     '-env:UserInstallation=' + profile.as_uri(), '--headless',
+                     '--convert-to', 'pdf', '--outdir', str(out_dir)] +
+                    [x.name for x in docx_files], cwd=str(out_dir),
+                    stdout=DEVNULL)
+        finally:
+            self.profiles.put(profile)
+
+        for docx_file in docx_files:
+            if not docx_file.with_suffix('.pdf').exists():
+                report('WARNING: libreoffice could not convert ' + str(docx_file))
+
+
+def convert_to_pdf(docx_files, jobs=1, libreoffice_path=None):
+    """Convert docx files to pdf with libreoffice.
+
+    Parameters
+    ----------
+    docx_files : list of path to file
+        docx files to convert (the files which do not exist are skipped)
+    jobs : int
+        number of libreoffice processes which can run at the same time
+    libreoffice_path : str
+        path to directory containing libreoffice (if None, it should be on
+        PATH)
+    """
+    if libreoffice_path is not None:
+        libreoffice = str(Path(libreoffice_path) / LIBREOFFICE)
+    else:
+        libreoffice = LIBREOFFICE
+
+    docx_files = [x for x in docx_files if x.exists()]
+    if docx_files:
+        _get_converter(libreoffice, jobs).convert(docx_files)
+
+
+def _get_converter(libreoffice, n_profiles):
+    """Return the converter with this number of profiles. It's kept, so that
+    the documents converted by different tasks share the same profiles."""
+    with _CONVERTERS_LOCK:
+        key = (libreoffice, n_profiles)
+        if key not in _CONVERTERS:
+            _CONVERTERS[key] = PdfConverter(libreoffice, n_profiles)
+        return _CONVERTERS[key]
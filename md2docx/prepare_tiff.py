@@ -0,0 +1,47 @@
+"""Convert the figures from png to tiff, for the journals which require tiff.
+"""
+from os import replace
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# lossless compression of tiff (name in PIL)
+COMPRESSION = {
+    'none': 'raw',
+    'lzw': 'tiff_lzw',
+    'deflate': 'tiff_adobe_deflate',
+    }
+
+
+def convert_to_tiff(png_file, compression='none'):
+    """Convert one png to tiff (in the same directory).
+
+    Parameters
+    ----------
+    png_file : path to file
+        png image
+    compression : str
+        compression of the tiff ('none', 'lzw' or 'deflate')
+
+    Returns
+    -------
+    path to file
+        tiff image
+
+    Notes
+    -----
+    The tiff is written to a temporary file first, so that an incomplete
+    tiff is never left in the output directory.
+    """
+    if Image is None:
+        raise ImportError('cannot convert png to tiff, install Pillow')
+
+    tiff_file = png_file.with_suffix('.tiff')
+    tmp_file = png_file.with_suffix('.tiff.tmp')
+    with Image.open(str(png_file)) as img:
+        img.save(str(tmp_file), format='TIFF',
+                 compression=COMPRESSION[compression])
+    replace(str(tmp_file), str(tiff_file))
+
+    return tiff_file
@@ -0,0 +1,160 @@
+"""Run the steps of the conversion in parallel, as soon as the steps they
+depend on are completed.
+"""
+from concurrent.futures import (FIRST_COMPLETED,
+                                ProcessPoolExecutor,
+                                ThreadPoolExecutor,
+                                wait,
+                                )
+from multiprocessing import get_context
+from threading import Lock
+
+from .timing import collect, propagate, skipped, timed
+
+_POOLS = {}
+_POOLS_LOCK = Lock()
+
+
+class Task:
+    """One step of the conversion.
+
+    Parameters
+    ----------
+    name : str
+        unique name of the task
+    func : function
+        function to run
+    args : tuple or function
+        arguments to pass to the function, or a function returning the
+        arguments when the task starts (for arguments which are computed by
+        the tasks it depends on)
+    depends : tuple of str
+        names of the tasks which need to be completed before this one
+    in_process : bool
+        run the task in a separate process (only for tasks which are CPU-bound
+        and whose arguments can be pickled)
+    step : instance of Step
+        if the step is current, the task is not run
+    record : bool
+        record the step once the task is completed (so that it can be skipped
+        next time)
+    """
+    def __init__(self, name, func, args=(), depends=(), in_process=False,
+                 step=None, record=True):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.depends = tuple(depends)
+        self.in_process = in_process
+        self.step = step
+        self.record = record
+
+
+def run_tasks(tasks, jobs=1):
+    """Run tasks in a thread pool or a process pool, following the graph of
+    their dependencies.
+
+    Parameters
+    ----------
+    tasks : list of instances of Task
+        tasks to run
+    jobs : int
+        maximum number of tasks running at the same time in each pool
+
+    Returns
+    -------
+    dict
+        result of each task, with the name of the task as key
+
+    Raises
+    ------
+    ValueError
+        if a task depends on an unknown task or if the dependencies are
+        circular
+
+    Notes
+    -----
+    If one of the tasks fails, no new task is started and the exception is
+    raised again once the running tasks are completed.
+
+    Tasks whose step is current are skipped and their result is None.
+
+    Each task is a stage of md2docx.timing (when the stages are recorded).
+    """
+    todo = {task.name: task for task in tasks}
+    for task in tasks:
+        unknown = set(task.depends) - set(todo)
+        if unknown:
+            raise ValueError(task.name + ' depends on unknown tasks: ' +
+                             ', '.join(sorted(unknown)))
+
+    threads, processes = _get_pools(jobs)
+
+    done = {}
+    running = {}
+    error = None
+
+    while (todo and error is None) or running:
+        ready = error is None
+        while ready:  # skipped tasks can make other tasks ready
+            ready = False
+            for name, task in list(todo.items()):
+                if all(x in done for x in task.depends):
+                    ready = True
+                    del todo[name]
+                    if task.step is not None and task.step.is_current():
+                        done[name] = None
+                        skipped(name)
+                    else:
+                        args = task.args() if callable(task.args) else task.args
+                        func = timed(name, task.func)
+                        if task.in_process:
+                            pool = processes
+                        else:
+                            # the stages of the caller (such as the build)
+                            # also count the external programs of the task
+                            pool = threads
+                            func = propagate(func)
+                        running[pool.submit(func, *args)] = task
+
+        if not running:
+            if todo and error is None:
+                raise ValueError('circular dependencies between ' +
+                                 ', '.join(sorted(todo)))
+            break
+
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            task = running.pop(future)
+            try:
+                done[task.name] = collect(future.result())
+            except Exception as err:
+                if error is None:
+                    error = err
+                continue
+            if task.step is not None and task.record:
+                task.step.record()
+
+    if error is not None:
+        raise error
+
+    return done
+
+
+def _get_pools(jobs):
+    """Return the thread pool and the process pool with this number of
+    workers. The pools are kept open, so that the processes are started only
+    once (for example, when watching for changes).
+
+    Notes
+    -----
+    The process pool uses spawn, because forking while other threads hold
+    locks is not safe.
+    """
+    with _POOLS_LOCK:
+        if jobs not in _POOLS:
+            _POOLS[jobs] = (
+                ThreadPoolExecutor(jobs),
+                ProcessPoolExecutor(jobs, mp_context=get_context('spawn')),
+                )
+        return _POOLS[jobs]
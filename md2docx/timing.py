@@ -0,0 +1,256 @@
+"""Record how long each stage of the build takes, to find out which stages
+are slow. With --profile, the stages are written to a json file in the Chrome
+trace format (open it in chrome://tracing or https://ui.perfetto.dev).
+
+Each stage has the wall time and:
+
+- cpu_ms: CPU time of the thread which runs the stage
+- subprocess_ms: time waiting for external programs (inkscape, node,
+  libreoffice), also from the threads started by the stage
+- peak_rss_mb: peak memory of the process which runs the stage
+
+subprocess_ms is the sum of the time of each external program, so it can be
+larger than the wall time of the stage when the programs run in parallel
+(such as several inkscape or libreoffice). The tasks which run in another
+process are separate stages and they are not added to the stages of the
+main process.
+
+With --profile_python, the python code of the tasks is also profiled with
+cProfile (one task at a time in each process, so use --jobs 1 to profile all
+the tasks).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from cProfile import Profile
+from functools import partial
+from json import dump
+from os import getpid
+from pstats import Stats
+from sys import platform
+from threading import Lock, get_ident
+from time import perf_counter, thread_time, time
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:  # windows
+    getrusage = None
+
+_OPTIONS = {'enabled': False, 'python': False}
+_EVENTS = []
+_EVENTS_LOCK = Lock()
+_PYTHON_STATS = []
+_PROFILE_LOCK = Lock()  # only one cProfile can run at the same time
+
+_STAGE = ContextVar('stage', default=None)
+
+
+class _Stage:
+    """Stage which is running, where the time in subprocesses is added"""
+    __slots__ = ('parent', 'subprocess')
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.subprocess = 0
+
+
+class _RemoteResult:
+    """Result of a task run in another process, with the events recorded
+    there"""
+    def __init__(self, result, events, python_stats):
+        self.result = result
+        self.events = events
+        self.python_stats = python_stats
+
+
+class _ProfileStats:
+    """Statistics of cProfile, in the format read by pstats.Stats"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def enable(python=False):
+    """Start recording the stages.
+
+    Parameters
+    ----------
+    python : bool
+        profile the python code of the tasks with cProfile
+    """
+    _OPTIONS['enabled'] = True
+    _OPTIONS['python'] = python
+
+
+def is_enabled():
+    return _OPTIONS['enabled']
+
+
+@contextmanager
+def stage(name, profile=False, **values):
+    """Record the time spent in one stage.
+
+    Parameters
+    ----------
+    name : str
+        name of the stage (such as the name of the task)
+    profile : bool
+        profile the python code of the stage (if enabled with python=True)
+    **values
+        other values to store with the stage
+    """
+    if not _OPTIONS['enabled']:
+        yield
+        return
+
+    current = _Stage(_STAGE.get())
+    token = _STAGE.set(current)
+
+    prof = None
+    if profile and _OPTIONS['python'] and _PROFILE_LOCK.acquire(False):
+        prof = Profile()
+        prof.enable()
+
+    start = time()
+    t0 = perf_counter()
+    cpu0 = thread_time()
+    try:
+        yield
+
+    finally:
+        duration = perf_counter() - t0
+        cpu = thread_time() - cpu0
+        _STAGE.reset(token)
+
+        if prof is not None:
+            prof.disable()
+            prof.create_stats()
+            _PYTHON_STATS.append(prof.stats)
+            _PROFILE_LOCK.release()
+
+        values.update(cpu_ms=round(cpu * 1e3, 3),
+                      subprocess_ms=round(current.subprocess * 1e3, 3),
+                      peak_rss_mb=_peak_rss())
+        _add_event({'name': name, 'cat': 'stage', 'ph': 'X',
+                    'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+                    'pid': getpid(), 'tid': get_ident(), 'args': values})
+
+
+@contextmanager
+def external(program):
+    """Record the time waiting for an external program, which is added to
+    the stages which are running.
+
+    Parameters
+    ----------
+    program : str
+        name of the program
+    """
+    if not _OPTIONS['enabled']:
+        yield
+        return
+
+    start = time()
+    t0 = perf_counter()
+    try:
+        yield
+
+    finally:
+        duration = perf_counter() - t0
+        with _EVENTS_LOCK:
+            current = _STAGE.get()
+            while current is not None:
+                current.subprocess += duration
+                current = current.parent
+        _add_event({'name': program, 'cat': 'subprocess', 'ph': 'X',
+                    'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+                    'pid': getpid(), 'tid': get_ident(), 'args': {}})
+
+
+def skipped(name):
+    """Record that a stage was skipped (because it's current)"""
+    if _OPTIONS['enabled']:
+        _add_event({'name': name, 'cat': 'stage', 'ph': 'i', 's': 't',
+                    'ts': int(time() * 1e6), 'pid': getpid(),
+                    'tid': get_ident(), 'args': {'skipped': True}})
+
+
+def propagate(func):
+    """Return a function which runs func in the current stage (for functions
+    which run in other threads, so that their subprocesses are counted) and
+    with the current name of the build (see utils.build_name)"""
+    context = copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+def timed(name, func):
+    """Return a function which runs func as a stage (also in other
+    processes). Its result should be passed to collect."""
+    if not _OPTIONS['enabled']:
+        return func
+    return partial(_run_stage, name, getpid(), dict(_OPTIONS), func)
+
+
+def collect(result):
+    """Result of the function returned by timed, keeping the events recorded
+    in other processes"""
+    if isinstance(result, _RemoteResult):
+        with _EVENTS_LOCK:
+            _EVENTS.extend(result.events)
+            _PYTHON_STATS.extend(result.python_stats)
+        return result.result
+    return result
+
+
+def write_trace(trace_json):
+    """Write the stages to a json file in the Chrome trace format"""
+    with _EVENTS_LOCK:
+        events = sorted(_EVENTS, key=lambda x: x['ts'])
+
+    with open(str(trace_json), 'w') as f:
+        dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, indent=1)
+
+
+def write_python_profile(prof_file):
+    """Write the statistics of cProfile (read them with pstats)"""
+    with _EVENTS_LOCK:
+        python_stats = list(_PYTHON_STATS)
+
+    if python_stats:
+        Stats(*[_ProfileStats(x) for x in python_stats]).dump_stats(str(prof_file))
+
+
+def _run_stage(name, pid, options, func, *args):
+    if getpid() == pid:
+        with stage(name, profile=True):
+            return func(*args)
+
+    # in a worker process, the events are sent back with the result
+    _OPTIONS.update(options)
+    with _EVENTS_LOCK:
+        _EVENTS.clear()
+        _PYTHON_STATS.clear()
+
+    with stage(name, profile=True):
+        result = func(*args)
+
+    with _EVENTS_LOCK:
+        return _RemoteResult(result, list(_EVENTS), list(_PYTHON_STATS))
+
+
+def _add_event(event):
+    with _EVENTS_LOCK:
+        _EVENTS.append(event)
+
+
+def _peak_rss():
+    """Peak memory of this process in MB (None if not available)"""
+    if getrusage is None:
+        return None
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    if platform == 'darwin':  # in bytes, not kB
+        peak /= 1024
+    return round(peak / 1024, 1)
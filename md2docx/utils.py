@@ -1,4 +1,6 @@
-from os import getcwd
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import environ, getcwd
 from pathlib import Path
 
 cur_dir = Path(getcwd())
@@ -11,3 +13,34 @@ ref_dir = var_dir / 'docx'
 loc_dir = var_dir / 'locale'
 node_dir = var_dir / 'nodejs'
 journals_dir = var_dir / 'journals'
+
+cache_dir = Path(environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'md2docx'
+
+_BUILD_NAME = ContextVar('build_name', default=None)
+
+
+@contextmanager
+def build_name(name):
+    """Prefix the messages of report with the name of the build (such as the
+    journal), when several builds run at the same time. Use
+    timing.propagate to keep the name in other threads.
+
+    Parameters
+    ----------
+    name : str
+        name of the build
+    """
+    token = _BUILD_NAME.set(name)
+    try:
+        yield
+    finally:
+        _BUILD_NAME.reset(token)
+
+
+def report(message):
+    """Print a message of the build, with the name of the build (if any)"""
+    name = _BUILD_NAME.get()
+    if name is not None:
+        message = name + ': ' + message
+    # one write, so that the lines of different threads are not mixed
+    print(message + '\n', end='')
@@ -1,76 +1,144 @@
 var path = require('path');
 var fs = require('fs');
+var readline = require('readline');
 var CSL = require('./citeproc_commonjs.js');
 
-// input files (+ 'locales-en-US.xml')
+// usage (BIBFILE is either a json object or the .jsonl + .idx written by
+// prepare_bib):
+//   node processcite.js WORKDIR BIBFILE CSLFILE LOCALEDIR
+//     format WORKDIR/citations.json once and exit
+//   node processcite.js --worker BIBFILE CSLFILE LOCALEDIR
+//     keep engine, style, locale and bibliography in memory. Each line of
+//     stdin is the json list of citations of one document, each line of
+//     stdout is the reply ({"citations": [...], "references": "..."})
 workDir = process.argv[2];
 bibFile = process.argv[3];
 cslFile = process.argv[4];
 localeDir = process.argv[5];
 
-citationsFile = path.format({dir: workDir, base: 'citations.json'});
-
-// output files 
-outFile = path.format({dir: workDir, base: 'formattedCitations.json'});
-refFile = path.format({dir: workDir, base: 'formattedReferences.txt'});
-
 // read in files
 var CSLStyle = fs.readFileSync(cslFile, 'utf8');
-var bib = JSON.parse(fs.readFileSync(bibFile, 'utf8'));
-var citations_j = JSON.parse(fs.readFileSync(citationsFile, 'utf8'));
+var retrieveEntry;
+
+if (path.extname(bibFile) == '.jsonl') {
+ // library written by prepare_bib: read only the index and then read each
+ // entry only when it's cited
+ var bibIndex = JSON.parse(fs.readFileSync(bibFile.slice(0, -6) + '.idx', 'utf8'));
+ var bibFd = fs.openSync(bibFile, 'r');
+ var bib = {};
+
+ retrieveEntry = function(id){
+	if (!(id in bib) && id in bibIndex) {
+	 var buf = Buffer.alloc(bibIndex[id][1]);
+	 fs.readSync(bibFd, buf, 0, bibIndex[id][1], bibIndex[id][0]);
+	 bib[id] = JSON.parse(buf.toString('utf8'));
+	}
+	return bib[id];
+ };
+
+} else {
+ var bib = JSON.parse(fs.readFileSync(bibFile, 'utf8'));
+
+ retrieveEntry = function(id){
+	return bib[id];
+ };
+}
 
 // prepare CSL engine
 citeprocSys = {
  retrieveLocale: function (lang){
-	localesFile = path.format({dir: localeDir, 
+	localesFile = path.format({dir: localeDir,
 	                           base: 'locales-' + lang + '.xml'});
 	return fs.readFileSync(localesFile, 'utf8');
  },
- retrieveItem: function(id){
-	return bib[id];
- }
+ retrieveItem: retrieveEntry
 };
 
 var citeproc = new CSL.Engine(citeprocSys, CSLStyle);
 
 
-// output citations
-var j_format = [];
-var preCitat = [];
-var postCitat = [];
-var items = [];
+function formatCitations(citations_j) {
 
-for (let i0 in citations_j) {
+ // start from an empty state, so that each file has its own numbering
+ citeproc.restoreProcessorState([]);
+
+ // output citations
+ var j_format = [];
+ var preCitat = [];
+ var postCitat = [];
+ var items = [];
+
+ for (let i0 in citations_j) {
 	var cit_items = citations_j[i0]['citationItems'];
 	for (let i1 in cit_items) {
 	 items.push(cit_items[i1]['id']);
+  };
  };
-};
 
-citeproc.updateItems(items);
+ citeproc.updateItems(items);
 
-for (let item in citations_j) {
-try {
- postCitat.push([citations_j[item]['citationID'], 0]);
-} catch (err) {
- console.error(citations_j[item]['citationID'])
-};
+ for (let item in citations_j) {
+ try {
+  postCitat.push([citations_j[item]['citationID'], 0]);
+ } catch (err) {
+  console.error(citations_j[item]['citationID'])
+ };
+ }
+
+ for (let item in citations_j) {
+ try {
+  postCitat.shift();
+  var result = citeproc.appendCitationCluster(citations_j[item], preCitat, postCitat);
+  j_format.push(result[0][1]);
+  preCitat.push([result[0][2], 0]);
+
+
+ } catch (err) {
+  console.error(citations_j[item]['citationID'])
+ };
+ }
+
+ // output references
+ var out_bib = citeproc.makeBibliography()
+ return {'citations': j_format, 'references': out_bib[1].join('')};
 }
 
-for (let item in citations_j) {
-try {
- postCitat.shift();
- var result = citeproc.appendCitationCluster(citations_j[item], preCitat, postCitat);
- j_format.push(result[0][1]);
- preCitat.push([result[0][2], 0]);
 
+function processDir(workDir) {
 
-} catch (err) {
- console.error(citations_j[item]['citationID'])
-};
+ // input files (+ 'locales-en-US.xml')
+ var citationsFile = path.format({dir: workDir, base: 'citations.json'});
+
+ // output files
+ var outFile = path.format({dir: workDir, base: 'formattedCitations.json'});
+ var refFile = path.format({dir: workDir, base: 'formattedReferences.txt'});
+
+ var citations_j = JSON.parse(fs.readFileSync(citationsFile, 'utf8'));
+ var formatted = formatCitations(citations_j);
+
+ fs.writeFileSync(outFile, JSON.stringify(formatted['citations'], null, 4));
+ fs.writeFileSync(refFile, formatted['references']);
 }
-fs.writeFileSync(outFile, JSON.stringify(j_format, null, 4));
 
-// output references
-var out_bib = citeproc.makeBibliography()
-fs.writeFileSync(refFile, out_bib[1].join(''));
+
+if (workDir == '--worker') {
+ // stdout is reserved for replies, send citeproc warnings to stderr
+ console.log = console.error;
+
+ var rl = readline.createInterface({input: process.stdin, terminal: false});
+ rl.on('line', function (line) {
+	if (line.trim() == '') {
+	 return;
+	}
+	// one line per document, with the list of citations
+	try {
+	 var formatted = formatCitations(JSON.parse(line));
+	 process.stdout.write(JSON.stringify(formatted) + '\n');
+	} catch (err) {
+	 process.stdout.write(JSON.stringify({'error': err.toString()}) + '\n');
+	}
+ });
+
+} else {
+ processDir(workDir);
+}
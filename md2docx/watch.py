@@ -0,0 +1,89 @@
+"""Keep md2docx running and build the documents again when the sources change.
+"""
+from time import sleep
+
+from .build import build
+from .prepare_bib import fix_biblio
+from .prepare_md import SRC_DIR, IMG_DIR
+from .timing import stage
+
+INTERVAL = 0.2  # in s
+
+
+def watch(article_dir, bib_file, args):
+    """Build the documents every time one of the sources changes.
+
+    Parameters
+    ----------
+    article_dir : path to dir
+        directory with src/ and img/
+    bib_file : path to file
+        original .bib file (args.library is the converted json)
+    args : arguments
+        arguments to md2docx
+
+    Notes
+    -----
+    It watches src/, img/, the .bib library, the journal json, the csl and
+    the acronyms. The builds are incremental and the python process keeps the
+    journal, the acronyms, the reference docx, the citeproc worker, and the
+    worker pools in memory, so only the documents affected by the change are
+    converted again. Stop it with Ctrl+C.
+    """
+    args.incremental = True
+
+    previous = None
+    try:
+        while True:
+            current = _snapshot(article_dir, bib_file, args)
+            if current != previous:
+                if previous is not None:
+                    print('changed: ' + ', '.join(_changed(previous, current)))
+                previous = current
+
+                try:
+                    with stage('prepare_bib'):
+                        args.library = fix_biblio(bib_file, args.jobs)
+                    with stage('build'):
+                        build(article_dir, args)
+                except Exception as err:  # report error and keep on watching
+                    print('ERROR: ' + type(err).__name__ + ': ' + str(err))
+                print('watching for changes (Ctrl+C to stop)')
+
+            sleep(INTERVAL)
+
+    except KeyboardInterrupt:
+        pass
+
+
+def _snapshot(article_dir, bib_file, args):
+    """Modification time and size of all the files which are watched
+
+    Returns
+    -------
+    dict
+        key is path to the file, value is a tuple of modification time in ns
+        and size in bytes
+    """
+    files = []
+    for sub_dir in (SRC_DIR, IMG_DIR):
+        files.extend(x for x in (article_dir / sub_dir).glob('*') if x.is_file())
+    files.extend(article_dir / x for x in (bib_file, args.journal_json,
+                                           args.csl, args.acronyms))
+
+    snapshot = {}
+    for one_file in files:
+        try:
+            st = one_file.stat()
+        except FileNotFoundError:
+            continue
+        snapshot[one_file] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+
+def _changed(previous, current):
+    """Names of the files which were added, removed or modified"""
+    changed = set(previous) ^ set(current)
+    changed |= {x for x in set(previous) & set(current)
+                if previous[x] != current[x]}
+    return sorted(x.name for x in changed)
@@ -25,10 +25,16 @@ setup(
         'Topic :: Scientific/Engineering :: Visualization',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
     keywords='writing docx markdown journals',
     packages=find_packages(),
+    python_requires='>=3.7',  # contextvars (md2docx.timing)
     install_requires=['python-docx', 'latexcodec'],
     package_data={
         'md2docx': ['VERSION',
@@ -43,6 +49,7 @@ setup(
     entry_points={
         'console_scripts': [
             'md2docx=md2docx.main:main',
+            'md2docx_batch=md2docx.main:batch',
             'prepare_bib=md2docx.main:prepare_bib',
         ],
     },
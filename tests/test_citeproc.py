@@ -0,0 +1,67 @@
+"""Format citations with the stub of node (benchmarks/stubs), which runs as
+a worker like processcite.js."""
+from os import utime
+from pathlib import Path
+
+from md2docx.citeproc import close_workers, get_worker
+from md2docx.prepare_bib import prepare_bib
+from md2docx.utils import csl_dir
+
+STUBS_DIR = Path(__file__).resolve().parents[1] / 'benchmarks' / 'stubs'
+BIB = '''@article{Smith2020,
+author = {Smith, John},
+title = {{Sleep spindles}},
+journal = {Neuron},
+year = {2020}
+}
+@article{Lee2021,
+author = {Lee, Maria},
+title = {{Cortical oscillations}},
+journal = {Sleep},
+year = {2021}
+}
+'''
+CITATIONS = [[{'citationItems': [{'id': 'Smith2020'}, {'id': 'Lee2021'}],
+               'properties': {'noteIndex': 0}}]]
+
+
+def _make_library(tmp_path):
+    bib_file = tmp_path / 'library.bib'
+    bib_file.write_text(BIB)
+    biblio = tmp_path / 'library.jsonl'
+    prepare_bib(bib_file, biblio)
+    return biblio
+
+
+def test_restart_after_exit(tmp_path):
+    biblio = _make_library(tmp_path)
+    csl = csl_dir / 'cell.csl'
+    try:
+        worker = get_worker(biblio, csl, str(STUBS_DIR))
+        reply = worker.process(CITATIONS)[0]
+        assert reply['citations'] == ['<sup>1,2</sup>']
+
+        worker.proc.kill()
+        worker.proc.wait()
+        new_worker = get_worker(biblio, csl, str(STUBS_DIR))
+        assert new_worker is not worker
+        assert new_worker.process(CITATIONS) == [reply]
+        assert get_worker(biblio, csl, str(STUBS_DIR)) is new_worker
+    finally:
+        close_workers()
+
+
+def test_restart_after_library_change(tmp_path):
+    biblio = _make_library(tmp_path)
+    csl = csl_dir / 'cell.csl'
+    try:
+        worker = get_worker(biblio, csl, str(STUBS_DIR))
+        stat = biblio.stat()
+        utime(str(biblio), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        new_worker = get_worker(biblio, csl, str(STUBS_DIR))
+        assert new_worker is not worker
+        assert worker.proc.poll() is not None  # the old worker was stopped
+        assert len(new_worker.process(CITATIONS)) == 1
+    finally:
+        close_workers()
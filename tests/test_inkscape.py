@@ -0,0 +1,47 @@
+"""Convert svg to png with the stub of inkscape (benchmarks/stubs), which can
+crash in shell mode."""
+from pathlib import Path
+
+from md2docx.inkscape import _get_pool, close_shells, export_png
+
+STUBS_DIR = Path(__file__).resolve().parents[1] / 'benchmarks' / 'stubs'
+INKSCAPE = str(STUBS_DIR / 'inkscape')
+
+
+def _make_svg(svg_dir, n_files):
+    svg_files = []
+    for i in range(n_files):
+        svg_files.append(svg_dir / 'fig{}.svg'.format(i))
+        svg_files[-1].write_text('<svg xmlns="http://www.w3.org/2000/svg" '
+                                 'width="{}" height="50"/>\n'.format(40 + i))
+    return svg_files
+
+
+def test_shell(tmp_path):
+    svg_files = _make_svg(tmp_path, 3)
+    try:
+        for svg_file in svg_files:
+            export_png(INKSCAPE, svg_file, svg_file.with_suffix('.png'), 96,
+                       'white', n_shells=1)
+        assert _get_pool(INKSCAPE, 1).available
+    finally:
+        close_shells()
+
+    for svg_file in svg_files:
+        assert svg_file.with_suffix('.png').stat().st_size > 0
+
+
+def test_shell_crash(tmp_path, monkeypatch):
+    monkeypatch.setenv('INKSCAPE_STUB_CRASH', '2')
+    svg_files = _make_svg(tmp_path, 5)
+    try:
+        for svg_file in svg_files:
+            export_png(INKSCAPE, svg_file, svg_file.with_suffix('.png'), 96,
+                       'white', n_shells=1)
+        # the shell crashed on the third figure, then one inkscape per figure
+        assert not _get_pool(INKSCAPE, 1).available
+    finally:
+        close_shells()
+
+    for svg_file in svg_files:
+        assert svg_file.with_suffix('.png').stat().st_size > 0
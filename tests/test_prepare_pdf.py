@@ -0,0 +1,47 @@
+"""Convert docx to pdf with the stub of libreoffice (benchmarks/stubs), which
+fails if two processes use the same profile at the same time."""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from md2docx import prepare_pdf
+from md2docx.prepare_pdf import PdfConverter, convert_to_pdf
+
+STUBS_DIR = Path(__file__).resolve().parents[1] / 'benchmarks' / 'stubs'
+
+
+def _make_docx(docx_dir, n_files):
+    docx_dir.mkdir()
+    docx_files = []
+    for i in range(n_files):
+        docx_files.append(docx_dir / 'doc{}.docx'.format(i))
+        docx_files[-1].write_bytes(b'docx' * (i + 1))
+    return docx_files
+
+
+def test_libreoffice_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(prepare_pdf, 'PROFILE_DIR', tmp_path / 'profiles')
+    docx_files = _make_docx(tmp_path / 'output', 3)
+
+    convert_to_pdf(docx_files + [tmp_path / 'missing.docx', ], jobs=2,
+                   libreoffice_path=str(STUBS_DIR))
+
+    for docx_file in docx_files:
+        assert docx_file.with_suffix('.pdf').exists()
+    assert not (tmp_path / 'missing.pdf').exists()
+
+
+def test_shared_profile(tmp_path, monkeypatch):
+    monkeypatch.setattr(prepare_pdf, 'PROFILE_DIR', tmp_path / 'profiles')
+    monkeypatch.setenv('LIBREOFFICE_STUB_DELAY', '0.2')
+    converter = PdfConverter(str(STUBS_DIR / 'libreoffice'), 1)
+    batches = [_make_docx(tmp_path / name, 4) for name in ('main', 'review')]
+
+    # the two conversions wait for each other, because they share the profile
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(converter.convert, batches))
+
+    for docx_file in batches[0] + batches[1]:
+        assert docx_file.with_suffix('.pdf').exists()
+    assert converter.n_used == 1
+    assert sorted(x.name for x in (tmp_path / 'profiles').iterdir()) == [
+        'profile_0', 'profile_0.lock']